@@ -0,0 +1 @@
+When authCacheTimeout is set, repository servers cache the roles granted to each set of credentials and the ACLs of each role for that many seconds. Identical auth tokens no longer need to be re-authenticated on every call. Changes to users, roles, ACLs or entitlements made through the server flush these caches. Changes made by other server processes are seen once the cached entries expire.
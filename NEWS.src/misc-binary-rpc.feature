@@ -0,0 +1 @@
+Conary clients and servers now negotiate a binary RPC encoding (application/x-conary-rpc) in place of XML-RPC. Strings and containers are length-prefixed, so no escaping or XML parsing is needed. Clients list the encoding in Accept, and servers which understand it reply with it. Once a server has answered in binary, the client sends its requests in binary too. Older clients and servers keep using XML-RPC.
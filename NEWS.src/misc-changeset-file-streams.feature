@@ -0,0 +1,3 @@
+When building relative changesets the repository now fetches only the file
+streams of files which changed, and streams of new files are copied into
+the changeset without being thawed.
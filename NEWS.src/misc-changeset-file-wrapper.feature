@@ -0,0 +1 @@
+Changeset downloads which are a single cached changeset or contents file are handed to the web server through wsgi.file_wrapper, so servers which support it can send them with sendfile, and changesets without contents store references are no longer parsed entry by entry while being sent.
@@ -0,0 +1 @@
+Changesets written for update jobs, restarts and the system model trove cache now end with an offset index, letting file contents be read in any order without rescanning the changeset.
@@ -0,0 +1,7 @@
+Repository connections are now kept alive in a pool shared by XML-RPC
+calls and changeset and file downloads, up to four per server, and SSL
+sessions are resumed when new connections to a server are needed. Other
+ConaryURLOpener users still close their connections unless they pass
+persist=True. Requests other than GET, HEAD and the other idempotent
+methods are no longer sent again when the server closes the connection
+without answering.
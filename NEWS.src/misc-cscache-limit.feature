@@ -0,0 +1 @@
+The proxy changeset cache can be limited in size with the new changesetCacheLimit option; least recently used changesets are removed once it is exceeded, and cache write, hit and eviction byte counts are reported through the proxy counters.
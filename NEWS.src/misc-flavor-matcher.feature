@@ -0,0 +1,3 @@
+Flavor preference filtering in trove sources now scores candidate flavors
+against a precompiled FlavorMatcher instead of thawing and comparing each
+candidate dependency set individually.
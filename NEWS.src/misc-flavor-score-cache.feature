@@ -0,0 +1 @@
+Flavor and dependency set scores are now cached by the frozen forms of both sides, so scoring the same pairs again (as happens throughout findTroves and update planning) no longer thaws and rescores them. Dependency sets also keep their frozen form until they are modified.
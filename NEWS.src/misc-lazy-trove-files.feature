@@ -0,0 +1,4 @@
+Troves built from absolute trove change sets now keep their file list in
+frozen form and only decode it when individual file entries are needed;
+iterating over, counting, copying and verifying the files of such troves
+works directly from the frozen buffer.
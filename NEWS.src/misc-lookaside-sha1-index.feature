@@ -0,0 +1,3 @@
+The lookaside cache now remembers the sha1 of the repository sources it
+holds, so cooks and commits no longer rehash unchanged source files and
+archives every time they are used.
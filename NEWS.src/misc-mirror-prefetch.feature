@@ -0,0 +1,4 @@
+The mirror script now fetches the changesets for the next bundles from
+the source repository while the current bundle is committed to the
+targets. The new prefetchSize mirror configuration option limits how
+much changeset data is fetched ahead (256MB by default).
@@ -0,0 +1,3 @@
+Cooking a package now compresses the built files with one thread per
+CPU when the changeset is written or committed; the resulting changeset
+is unchanged.
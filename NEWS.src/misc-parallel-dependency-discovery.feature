@@ -0,0 +1,3 @@
+Dependency discovery now inspects packaged files (ELF, Java and other
+file magic) with a pool of processes, and runs the per-file perl
+requirements scanner in parallel, on machines with more than one CPU.
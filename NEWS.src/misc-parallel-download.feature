@@ -0,0 +1 @@
+Changesets and file contents which come from several repositories are now downloaded in parallel; the new downloadThreads configuration option limits how many repositories are contacted at once. downloadRateLimit applies to all of those downloads together.
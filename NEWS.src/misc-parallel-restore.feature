@@ -0,0 +1 @@
+The new parallelRestore configuration option makes Conary uncompress the regular files being installed on a pool of worker threads (one per processor). Files in the same directory are handled by the same worker. Files are still renamed into place and recorded in the update journal in the same order as before.
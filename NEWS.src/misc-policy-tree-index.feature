@@ -0,0 +1,3 @@
+Policies which walk the destdir now share the directory listings of
+earlier walks, reusing each one until its directory changes, instead of
+listing every directory and stat'ing every file once per policy.
@@ -0,0 +1 @@
+Proxies now fetch a missing file from the upstream repository only once when several requests for it arrive together; the other requests wait for that fetch and are served from the cache.
@@ -0,0 +1 @@
+Regular file contents saved in rollbacks are now kept in a store indexed by sha1 in the rollback directory, which is shared by all rollbacks, instead of being copied into each rollback changeset. Contents which are part of several rollbacks are written and stored only once, and are removed when the last rollback using them is removed. Rollbacks created this way can't be applied by older versions of Conary.
@@ -0,0 +1 @@
+Repository servers write each changeset to the temporary download file as soon as it has been generated, instead of building all of the requested changesets first, and keep trove changesets frozen while building recursive group changesets. This greatly reduces memory use for large getChangeSet requests.
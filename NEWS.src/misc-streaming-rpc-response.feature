@@ -0,0 +1 @@
+Large RPC responses are now serialized and deflated incrementally, and sent with chunked transfer encoding instead of being built in memory first. Server memory use no longer grows with the size of responses such as getNewTroveList.
@@ -0,0 +1 @@
+The system model trove cache no longer stores pickles; dependency, dependency solution, timestamp and include file caches use a binary format with interned strings and are only decoded the first time they are used. Caches written by older versions are rebuilt.
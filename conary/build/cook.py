@@ -206,6 +206,12 @@ class CookCallback(client_callbacks.ChangesetCallback, callbacks.CookCallback):
         lookaside.ChangesetCallback.__init__(self, *args, **kw)
 
 
+def _parallelJobs():
+    try:
+        return os.sysconf('SC_NPROCESSORS_ONLN')
+    except (ValueError, OSError):
+        return 1
+
 def _signTrove(trv, fingerprint):
     if fingerprint is not None:
         trv.addDigitalSignature(fingerprint)
@@ -1561,6 +1567,9 @@ def _createPackageChangeSet(repos, db, cfg, bldList, loader, recipeObj,
     _doCopyForwardMetadata(troveList, recipeObj)
 
     changeSet = changeset.CreateFromFilesystem(packageList)
+    # the contents of the destdir get compressed when the changeset is
+    # written or committed; spread that over all of the processors
+    changeSet.compressionJobs = _parallelJobs()
 
     for packageName in grpMap:
         changeSet.addPrimaryTrove(packageName, targetVersion, flavor)
@@ -23,6 +23,7 @@ import base64
 import cookielib
 import errno
 import os
+import re
 import socket
 import time
 import urllib
@@ -444,6 +445,120 @@ class FileFinder(object):
         return inFile
 
 
+class Sha1Index(object):
+    """
+    Persistent record of the sha1s of the files in the lookaside cache,
+    so sources which have not changed since they were last hashed do not
+    have to be read again every time they are used. Entries are keyed by
+    path and are only trusted while the inode, size, mtime and ctime of
+    the file are the same as when it was hashed.
+
+    New entries are appended to the index. Entries which were replaced
+    later in the file or whose files are gone are dropped when the index
+    is loaded, and the file is rewritten once they make up half of it.
+    """
+
+    fileName = '.sha1index'
+    _sha1Re = re.compile('^[0-9a-f]{40}$')
+    # files modified this recently could change again without their
+    # mtime or ctime changing, so they are never recorded
+    racyWindow = 1
+
+    def __init__(self, basePath):
+        self.indexPath = os.path.join(basePath, self.fileName)
+        self.entries = None
+
+    def _load(self):
+        self.entries = {}
+        try:
+            f = open(self.indexPath)
+        except IOError:
+            return
+
+        lines = 0
+        for line in f:
+            lines += 1
+            try:
+                # a line torn by an interrupted append has no newline, or
+                # has the next entry joined to it
+                if not line.endswith('\n'):
+                    raise ValueError
+                ino, size, mtime, ctime, sha1, path = line[:-1].split(' ', 5)
+                if not self._sha1Re.match(sha1):
+                    raise ValueError
+                self.entries[path] = ((int(ino), int(size), int(mtime),
+                                       int(ctime)),
+                                      sha1helper.sha1FromString(sha1))
+            except ValueError:
+                # ignore damaged entries; those files just get hashed again
+                pass
+        f.close()
+
+        for path in self.entries.keys():
+            if not os.path.exists(path):
+                del self.entries[path]
+
+        if lines - len(self.entries) >= max(len(self.entries), 1):
+            self._save()
+
+    @staticmethod
+    def _format(path, key, sha1):
+        return '%d %d %d %d %s %s\n' % (key + (sha1helper.sha1ToString(sha1),
+                                                path))
+
+    def _save(self):
+        try:
+            f = util.AtomicFile(self.indexPath, chmod=0644)
+            for path, (key, sha1) in sorted(self.entries.iteritems()):
+                f.write(self._format(path, key, sha1))
+            f.commit()
+        except (IOError, OSError):
+            # the cache still works if the index can't be written
+            pass
+
+    def _append(self, path, key, sha1):
+        try:
+            f = open(self.indexPath, 'a+')
+            try:
+                # don't join the entry to a line torn by an earlier append
+                f.seek(0, 2)
+                if f.tell():
+                    f.seek(-1, 2)
+                    if f.read(1) != '\n':
+                        f.write('\n')
+                f.write(self._format(path, key, sha1))
+            finally:
+                f.close()
+        except (IOError, OSError):
+            pass
+
+    def sha1FileBin(self, path):
+        """
+        Returns the binary sha1 of the file at path, hashing the file only
+        if it has changed since it was last hashed.
+        """
+        if self.entries is None:
+            self._load()
+
+        sb = os.stat(path)
+        key = (sb.st_ino, sb.st_size, int(sb.st_mtime), int(sb.st_ctime))
+        entry = self.entries.get(path)
+        if entry and entry[0] == key:
+            return entry[1]
+
+        sha1 = sha1helper.sha1FileBin(path)
+        if (max(sb.st_mtime, sb.st_ctime) < time.time() - self.racyWindow
+                and '\n' not in path):
+            self.entries[path] = (key, sha1)
+            self._append(path, key, sha1)
+        elif entry:
+            # the entry in the index no longer matches the file, so it
+            # is ignored from now on
+            del self.entries[path]
+
+        return sha1
+
+
 class RepositoryCache(object):
 
     def __init__(self, repos, refreshFilter=None, cfg=None):
@@ -453,6 +568,7 @@ class RepositoryCache(object):
         self.cacheMap = {}
         self.quiet = False
         self._basePath = self.downloadRatedLimit = None
+        self._sha1Index = None
         self.setConfig(cfg)
 
     def setQuiet(self, quiet):
@@ -461,6 +577,8 @@ class RepositoryCache(object):
     def setConfig(self, cfg):
         if cfg:
             self.quiet = cfg.quiet
+            if cfg.lookaside != self._basePath:
+                self._sha1Index = None
             self._basePath = cfg.lookaside
             self.downloadRateLimit = cfg.downloadRateLimit
 
@@ -472,6 +590,11 @@ class RepositoryCache(object):
 
     basePath = property(_getBasePath)
 
+    def _getSha1Index(self):
+        if self._sha1Index is None:
+            self._sha1Index = Sha1Index(self.basePath)
+        return self._sha1Index
+
     def addFileHash(self, filePath, troveName, troveVersion, pathId, path,
                     fileId, fileVersion, sha1, mode):
         self.nameMap[filePath] = (troveName, troveVersion, pathId, path,
@@ -495,7 +618,7 @@ class RepositoryCache(object):
         sha1Cached = None
         cachedMode = None
         if os.path.exists(cachePath):
-            sha1Cached = sha1helper.sha1FileBin(cachePath)
+            sha1Cached = self._getSha1Index().sha1FileBin(cachePath)
         if sha1Cached != sha1:
             if sha1Cached:
                 log.info('%s sha1 %s != %s; fetching new...', url.filePath(),
@@ -19,6 +19,7 @@ Module used after C{%(destdir)s} has been finalized to create the
 initial packaging.  Also contains error reporting.
 """
 import codecs
+import cPickle
 import imp
 import itertools
 import os
@@ -46,6 +47,11 @@ except ImportError:
     except ImportError:
         ElementTree = None
 
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
 
 # Helper class
 class _DatabaseDepCache(object):
@@ -1918,6 +1924,21 @@ class ComponentProvides(policy.Policy):
 def _getTargetDepFlag(macros):
     return 'target-%s' % macros.target
 
+def _computeMagic(args):
+    """
+    Worker for L{_dependency._prefetchMagic}. Returns the pickled magic of
+    each of the paths, or C{None} for those which the caller should look
+    at itself.
+    """
+    basedir, paths = args
+    ret = []
+    for path in paths:
+        try:
+            ret.append(cPickle.dumps(magic.magic(path, basedir), 2))
+        except Exception:
+            ret.append(None)
+    return ret
+
 class _dependency(policy.Policy):
     """
     Internal class for shared code between Provides and Requires
@@ -1947,6 +1968,64 @@ class _dependency(policy.Policy):
                 l.append(re.compile(ignoreFlags))
         policy.Policy.updateArgs(self, **keywords)
 
+    # paths to look at before a pool of processes is worth starting
+    magicPrefetchMinimum = 64
+    magicPrefetchChunk = 16
+
+    def do(self):
+        self._prefetch()
+        policy.Policy.do(self)
+
+    def _prefetch(self):
+        self._prefetchMagic()
+
+    def _policyPaths(self):
+        return [ x for x in sorted(self.recipe.autopkg.pathMap)
+                 if self._pathAllowed(x) ]
+
+    @staticmethod
+    def _parallelJobs():
+        try:
+            return os.sysconf('SC_NPROCESSORS_ONLN')
+        except (ValueError, OSError):
+            return 1
+
+    def _prefetchMagic(self):
+        """
+        Look at the magic of all the files this policy will handle using a
+        pool of processes, so that doFile finds it already cached.
+        Inspecting ELF files and Java classes is CPU bound and dominates
+        dependency discovery for large packages. Results are stored in
+        path order, so they are the same as if doFile had looked.
+        """
+        magicCache = self.recipe.magic
+        if (multiprocessing is None
+                or not isinstance(magicCache, magic.magicCache)):
+            return
+        jobs = self._parallelJobs()
+        if jobs < 2:
+            return
+        paths = [ x for x in self._policyPaths() if x not in magicCache ]
+        if len(paths) < self.magicPrefetchMinimum:
+            return
+
+        size = self.magicPrefetchChunk
+        chunks = [ (magicCache.basedir, paths[i:i + size])
+                   for i in range(0, len(paths), size) ]
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.imap(_computeMagic, chunks)
+            for (basedir, chunk), pickled in itertools.izip(chunks, results):
+                for path, m in itertools.izip(chunk, pickled):
+                    if m is not None:
+                        magicCache[path] = cPickle.loads(m)
+            pool.close()
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+        pool.join()
+
     def preProcess(self):
         self.CILPolicyRE = re.compile(r'.*mono/.*/policy.*/policy.*\.config$')
         self.legalCharsRE = re.compile('[.0-9A-Za-z_+-/]')
@@ -3416,6 +3495,8 @@ class Requires(_addInfo, _dependency):
         self.rubyInvocation = None
         self.rubyLoadPath = None
         self.perlReqs = None
+        # perl requirements found by _prefetchPerlReqs, by full path
+        self.perlReqsResults = {}
         self.perlPath = None
         self.perlIncArgs = None
         self._CILPolicyProvides = {}
@@ -3554,6 +3635,14 @@ class Requires(_addInfo, _dependency):
         self.exceptDeps= exceptDeps
         _dependency.preProcess(self)
 
+    def do(self):
+        # _addInfo comes first and would otherwise pick up Policy.do
+        _dependency.do(self)
+
+    def _prefetch(self):
+        _dependency._prefetch(self)
+        self._prefetchPerlReqs()
+
     def postProcess(self):
         self._delPythonRequiresModuleFinder()
 
@@ -4080,63 +4169,64 @@ class Requires(_addInfo, _dependency):
         else:
             self.perlIncArgs = ' '.join('-I'+x for x in perlIncPath)
 
+    def _initPerlReqs(self):
+        self._fetchPerl()
+        if not self.perlPath:
+            # no perl == bootstrap, but print warning
+            self.info('Unable to find perl interpreter,'
+                       ' disabling perl: requirements')
+            self.perlReqs = False
+            return
+        # get the base directory where conary lives.  In a checked
+        # out version, this would be .../conary/conary/build/package.py
+        # chop off the last 3 directories to find where
+        # .../conary/Scandeps and .../conary/scripts/perlreqs.pl live
+        basedir = '/'.join(sys.modules[__name__].__file__.split('/')[:-3])
+        scandeps = '/'.join((basedir, 'conary/ScanDeps'))
+        if (os.path.exists(scandeps) and
+            os.path.exists('%s/scripts/perlreqs.pl' % basedir)):
+            perlreqs = '%s/scripts/perlreqs.pl' % basedir
+        else:
+            # we assume that conary is installed in
+            # $prefix/$libdir/python?.?/site-packages.  Use this
+            # assumption to find the prefix for
+            # /usr/lib/conary and /usr/libexec/conary
+            regexp = re.compile(r'(.*)/lib(64){0,1}/python[1-9].[0-9]/site-packages')
+            match = regexp.match(basedir)
+            if not match:
+                # our regexp didn't work.  fall back to hardcoded
+                # paths
+                prefix = '/usr'
+            else:
+                prefix = match.group(1)
+            # ScanDeps is not architecture specific
+            scandeps = '%s/lib/conary/ScanDeps' %prefix
+            if not os.path.exists(scandeps):
+                # but it might have been moved to lib64 for multilib
+                scandeps = '%s/lib64/conary/ScanDeps' %prefix
+            perlreqs = '%s/libexec/conary/perlreqs.pl' %prefix
+        self.perlReqs = '%s -I%s %s %s' %(
+            self.perlPath, scandeps, self.perlIncArgs, perlreqs)
+
     def _getPerlReqs(self, path, fullpath):
         if self.perlReqs is None:
-            self._fetchPerl()
-            if not self.perlPath:
-                # no perl == bootstrap, but print warning
-                self.info('Unable to find perl interpreter,'
-                           ' disabling perl: requirements')
-                self.perlReqs = False
-                return []
-            # get the base directory where conary lives.  In a checked
-            # out version, this would be .../conary/conary/build/package.py
-            # chop off the last 3 directories to find where
-            # .../conary/Scandeps and .../conary/scripts/perlreqs.pl live
-            basedir = '/'.join(sys.modules[__name__].__file__.split('/')[:-3])
-            scandeps = '/'.join((basedir, 'conary/ScanDeps'))
-            if (os.path.exists(scandeps) and
-                os.path.exists('%s/scripts/perlreqs.pl' % basedir)):
-                perlreqs = '%s/scripts/perlreqs.pl' % basedir
-            else:
-                # we assume that conary is installed in
-                # $prefix/$libdir/python?.?/site-packages.  Use this
-                # assumption to find the prefix for
-                # /usr/lib/conary and /usr/libexec/conary
-                regexp = re.compile(r'(.*)/lib(64){0,1}/python[1-9].[0-9]/site-packages')
-                match = regexp.match(basedir)
-                if not match:
-                    # our regexp didn't work.  fall back to hardcoded
-                    # paths
-                    prefix = '/usr'
-                else:
-                    prefix = match.group(1)
-                # ScanDeps is not architecture specific
-                scandeps = '%s/lib/conary/ScanDeps' %prefix
-                if not os.path.exists(scandeps):
-                    # but it might have been moved to lib64 for multilib
-                    scandeps = '%s/lib64/conary/ScanDeps' %prefix
-                perlreqs = '%s/libexec/conary/perlreqs.pl' %prefix
-            self.perlReqs = '%s -I%s %s %s' %(
-                self.perlPath, scandeps, self.perlIncArgs, perlreqs)
+            self._initPerlReqs()
         if self.perlReqs is False:
             return []
-
-        cwd = os.getcwd()
-        os.chdir(os.path.dirname(fullpath))
-        try:
-            p = os.popen('%s %s' %(self.perlReqs, fullpath))
-        finally:
-            try:
-                os.chdir(cwd)
-            except:
-                pass
-        reqlist = [x.strip().split('//') for x in p.readlines()]
+        if fullpath in self.perlReqsResults:
+            return self.perlReqsResults.pop(fullpath)
+        return self._runPerlReqs(fullpath)
+
+    def _runPerlReqs(self, fullpath):
+        proc = subprocess.Popen('%s %s' %(self.perlReqs, fullpath),
+                                shell=True, cwd=os.path.dirname(fullpath),
+                                stdout=subprocess.PIPE, close_fds=True)
+        stdout = proc.communicate()[0]
+        reqlist = [x.strip().split('//') for x in stdout.splitlines()]
         # make sure that the command completed successfully
-        rc = p.close()
-        if rc:
+        if proc.returncode:
             # make sure that perl didn't blow up
-            assert(os.WIFEXITED(rc))
+            assert(proc.returncode > 0)
             # Apparantly ScanDeps could not handle this input
             return []
 
@@ -4149,6 +4239,32 @@ class Requires(_addInfo, _dependency):
 
         return reqlist
 
+    def _prefetchPerlReqs(self):
+        """
+        Run the perl requirements scanner, which takes a process per
+        file, for all the perl files at once before doFile asks for it.
+        """
+        jobs = self._parallelJobs()
+        if jobs < 2:
+            return
+        fullpaths = []
+        for path in self._policyPaths():
+            pkgs = self.recipe.autopkg.findComponents(path)
+            if not pkgs:
+                continue
+            f = pkgs[0].getFile(path)
+            if self._isPerl(path, self.recipe.magic[path], f):
+                fullpaths.append(self.recipe.macros.destdir + path)
+        if len(fullpaths) < 2:
+            return
+        if self.perlReqs is None:
+            self._initPerlReqs()
+        if not self.perlReqs:
+            return
+        for idx, reqlist in util.iterParallel(self._runPerlReqs,
+                [ (x,) for x in fullpaths ], jobs):
+            self.perlReqsResults[fullpaths[idx]] = reqlist
+
     def _markManualRequirement(self, info, path, pkgFiles, m):
         flags = []
         if self._checkInclusion(info, path):
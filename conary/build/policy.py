@@ -22,7 +22,9 @@ Base classes and data used for all policy
 import imp
 import itertools
 import os
+import stat
 import sys
+import time
 import types
 
 from conary.lib import util, log, graph, sha1helper
@@ -441,16 +443,20 @@ class Policy(BasePolicy):
             self.invariantsubtrees.extend(self.subtrees)
         if not self.invariantsubtrees:
             self.invariantsubtrees.append('/')
+        treeIndex = getattr(self.recipe, '_policyTreeIndex', None)
+        if treeIndex is None:
+            treeIndex = self.recipe._policyTreeIndex = TreeIndex()
         for self.currentsubtree in self.invariantsubtrees:
             fullpath = (self.rootdir+self.currentsubtree) %self.macros
             dirs = util.braceGlob(fullpath)
             for d in dirs:
                 if self.recursive:
-                    os.path.walk(d, self.walkDir, None)
+                    treeIndex.walk(d, self.walkDir, None)
                 else:
                     # only one level
-                    if os.path.isdir(d):
-                        self.walkDir(None, d, os.listdir(d))
+                    names = treeIndex.listdir(d)
+                    if names is not None:
+                        self.walkDir(None, d, names)
 
     def walkDir(self, ignore, dirname, names):
         # chop off bit not useful for comparison
@@ -564,6 +570,110 @@ class Policy(BasePolicy):
                 res = True
         return res
 
+class TreeIndex(object):
+    """
+    Directory listings of the trees walked by policies, shared by all
+    of a recipe's policies so that each walk does not have to list every
+    directory and stat every entry in it again.
+
+    A listing is reused as long as its directory's mtime is unchanged.
+    Filesystems with coarse timestamps may not move the mtime for a
+    change made in the same tick as the listing, so listings of
+    directories changed within C{racyWindow} seconds of being listed are
+    not kept. A walk lists a directory again after calling C{func} for it
+    if C{func} changed it, so directories which C{func} creates are
+    walked just as C{os.path.walk} would walk them.
+    """
+    racyWindow = 1
+
+    def __init__(self):
+        # dirname -> ((st_ino, st_mtime), names, subdirs)
+        self.dirs = {}
+
+    def _list(self, dirname, sb):
+        key = (sb.st_ino, sb.st_mtime)
+        entry = self.dirs.get(dirname)
+        if entry is not None and entry[0] == key:
+            return entry[1], entry[2]
+
+        listedAt = time.time()
+        try:
+            names = os.listdir(dirname)
+        except OSError:
+            self.dirs.pop(dirname, None)
+            return None
+        subdirs = set()
+        for name in names:
+            try:
+                mode = os.lstat(os.path.join(dirname, name)).st_mode
+            except OSError:
+                continue
+            if stat.S_ISDIR(mode):
+                subdirs.add(name)
+        if sb.st_mtime < listedAt - self.racyWindow:
+            self.dirs[dirname] = (key, names, subdirs)
+        else:
+            self.dirs.pop(dirname, None)
+        return names, subdirs
+
+    def listdir(self, dirname):
+        """
+        Like C{os.listdir}, but returns C{None} if C{dirname} is not a
+        directory.
+        """
+        try:
+            sb = os.stat(dirname)
+        except OSError:
+            return None
+        if not stat.S_ISDIR(sb.st_mode):
+            return None
+        listing = self._list(dirname, sb)
+        if listing is None:
+            return None
+        return list(listing[0])
+
+    def walk(self, top, func, arg):
+        """
+        Like C{os.path.walk}: calls C{func(arg, dirname, names)} for
+        C{top} and each directory below it, not following symlinks.
+        """
+        try:
+            sb = os.stat(top)
+        except OSError:
+            return
+        if stat.S_ISDIR(sb.st_mode):
+            self._walk(top, sb, func, arg)
+
+    def _walk(self, dirname, sb, func, arg):
+        listing = self._list(dirname, sb)
+        if listing is None:
+            return
+        # func may prune names, just as with os.path.walk
+        names = list(listing[0])
+        func(arg, dirname, names)
+        # func may also have created directories here; the listing is
+        # only reused if the directory is unchanged
+        try:
+            sb = os.stat(dirname)
+        except OSError:
+            return
+        listing = self._list(dirname, sb)
+        if listing is None:
+            return
+        subdirs = listing[1]
+        for name in names:
+            if name not in subdirs:
+                continue
+            path = os.path.join(dirname, name)
+            # func may also have changed the tree
+            try:
+                sb = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISDIR(sb.st_mode):
+                self._walk(path, sb, func, arg)
+
+
 class UserGroupBasePolicy(Policy):
     def updateArgs(self, *args, **kwargs):
         self.error("Do not directly invoke %s" % self.__class__.__name__)
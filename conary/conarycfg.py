@@ -604,6 +604,8 @@ class ConaryContext(ConfigSection):
                                             '/etc/conary/mirrors',))
     modelPath             =  '/etc/conary/system-model'
     name                  =  None
+    parallelRestore       = (CfgBool, False, "Uncompress the files being "
+            "installed using one thread per processor")
     quiet                 =  CfgBool
     pinTroves             =  CfgRegExpList
     policyDirs            =  (CfgPathList, ('/usr/lib/conary/policy',
@@ -627,6 +629,8 @@ class ConaryContext(ConfigSection):
     downloadRetryTrim     =  (CfgBytes('k'), 1000000,
             "If a download is reattempted, trim this many kilobytes off the "
             "end of what was previously downloaded. 0 disables this feature.")
+    downloadThreads       = (CfgInt, 4, "Maximum number of repositories "
+            "to download changesets and file contents from at the same time")
     # The first keyring in the list is writable, and is used for storing the
     # keys that are not present on the system-wide keyring. Always expect
     # Conary to write to the first keyring.
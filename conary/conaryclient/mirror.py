@@ -120,6 +120,9 @@ class MirrorFileConfiguration(cfg.SectionedConfigFile):
             "Split jobs that would commit two versions of a trove at once. "
             "Needed for compatibility with older repositories.")
     noPGP = (cfg.CfgBool, False)
+    prefetchSize = (conarycfg.CfgInt, 256 * 1024 * 1024,
+            "Size in bytes of the changesets which may be fetched from the "
+            "source ahead of the commits to the targets.")
 
     _allowNewSections = True
     _defaultSectionType = MirrorConfigurationSection
@@ -492,8 +495,8 @@ def displayJobList(jobList):
     return displayBundle([(0, x) for x in jobList])
 
 # mirroring stuff when we are running into PathIdConflict errors
-def splitJobList(jobList, src, targetSet, hidden = False, callback = ChangesetCallback()):
-    log.debug("Changeset Key conflict detected; splitting job further...")
+# split a job list whose changeset has key conflicts by package
+def _splitJobList(jobList):
     jobs = {}
     for job in jobList:
         name = job[0]
@@ -501,20 +504,7 @@ def splitJobList(jobList, src, targetSet, hidden = False, callback = ChangesetCa
             name = name.split(':')[0]
         l = jobs.setdefault(name, [])
         l.append(job)
-    i = 0
-    for smallJobList in jobs.itervalues():
-        (outFd, tmpName) = util.mkstemp()
-        os.close(outFd)
-        log.debug("jobsplit %d of %d %s" % (
-            i + 1, len(jobs), displayBundle([(0,x) for x in smallJobList])))
-        src.createChangeSetFile(smallJobList, tmpName, recurse = False,
-                                callback = callback, mirrorMode = True)
-        _parallel(targetSet, TargetRepository.commitChangeSetFile,
-                tmpName, hidden=hidden, callback=callback)
-        os.unlink(tmpName)
-        callback.done()
-        i += 1
-    return
+    return jobs.values()
 
 
 # filter a trove tuple based on cfg
@@ -637,6 +627,153 @@ def _parallel(targets, classMethod, *args, **kwargs):
     return ret
 
 
+def _fetchChangeSetFile(src, jobList, callback):
+    (outFd, tmpName) = util.mkstemp()
+    os.close(outFd)
+    try:
+        src.createChangeSetFile(jobList, tmpName, recurse = False,
+                                callback = callback, mirrorMode = True)
+    except:
+        os.unlink(tmpName)
+        raise
+    return tmpName
+
+def _removeFiles(fileList):
+    for fileName in fileList:
+        try:
+            os.unlink(fileName)
+        except OSError:
+            pass
+
+
+class BundleFetcher(object):
+    """
+    Fetches the changesets for a list of bundles from the source repository
+    in a background thread, so the next bundles are downloaded while the
+    current one is committed to the targets. Iterating over the fetcher
+    yields (bundle, fileList) in bundle order; fileList has more than one
+    changeset file when a bundle had to be split because of key conflicts.
+    The files are removed when the next bundle is requested.
+
+    Fetching stops while the changesets waiting to be committed add up to
+    maxBytes or more; the next bundle is always fetched while the current
+    one is being committed, however large it is.
+    """
+
+    def __init__(self, src, bundles, maxBytes, callback):
+        self.src = src
+        self.bundles = bundles
+        self.maxBytes = maxBytes
+        self.callback = copy.copy(callback)
+        self.cond = threading.Condition()
+        # (bundle, fileList, size) tuples fetched but not yet handed out
+        self.ready = []
+        self.current = None
+        self.inFlight = 0
+        self.error = None
+        self.stopped = False
+        self.thread = threading.Thread(target = self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _fetch(self, i, bundle):
+        jobList = [ x[1] for x in bundle ]
+        log.debug("getting (%d of %d) %s" % (i + 1, len(self.bundles),
+                                             displayBundle(bundle)))
+        try:
+            return [ _fetchChangeSetFile(self.src, jobList, self.callback) ]
+        except changeset.ChangeSetKeyConflictError:
+            pass
+
+        log.debug("Changeset Key conflict detected; splitting job further...")
+        jobs = _splitJobList(jobList)
+        fileList = []
+        try:
+            for j, smallJobList in enumerate(jobs):
+                log.debug("jobsplit %d of %d %s" % (j + 1, len(jobs),
+                          displayBundle([ (0, x) for x in smallJobList ])))
+                fileList.append(_fetchChangeSetFile(self.src, smallJobList,
+                                                    self.callback))
+        except:
+            _removeFiles(fileList)
+            raise
+        return fileList
+
+    def _run(self):
+        try:
+            for i, bundle in enumerate(self.bundles):
+                self.cond.acquire()
+                try:
+                    while (not self.stopped and self.ready and
+                           self.inFlight >= self.maxBytes):
+                        self.cond.wait()
+                    if self.stopped:
+                        return
+                finally:
+                    self.cond.release()
+
+                fileList = self._fetch(i, bundle)
+                size = sum(os.stat(x).st_size for x in fileList)
+
+                self.cond.acquire()
+                try:
+                    if self.stopped:
+                        _removeFiles(fileList)
+                        return
+                    self.ready.append((bundle, fileList, size))
+                    self.inFlight += size
+                    self.cond.notify()
+                finally:
+                    self.cond.release()
+        except:
+            self.cond.acquire()
+            self.error = util.SavedException()
+            self.cond.notify()
+            self.cond.release()
+
+    def _finishCurrent(self):
+        if self.current is None:
+            return
+        fileList, size = self.current
+        self.current = None
+        _removeFiles(fileList)
+        self.cond.acquire()
+        self.inFlight -= size
+        self.cond.notify()
+        self.cond.release()
+
+    def __iter__(self):
+        for i in xrange(len(self.bundles)):
+            self._finishCurrent()
+            self.cond.acquire()
+            try:
+                while not self.ready and self.error is None:
+                    self.cond.wait()
+                if not self.ready:
+                    # bundles fetched before the error have been handed
+                    # out already, so the commits stay in order
+                    self.error.throw()
+                bundle, fileList, size = self.ready.pop(0)
+                # the fetch thread may be waiting for the queue to drain
+                self.cond.notify()
+            finally:
+                self.cond.release()
+            self.current = (fileList, size)
+            yield bundle, fileList
+        self._finishCurrent()
+
+    def close(self):
+        self.cond.acquire()
+        self.stopped = True
+        self.cond.notify()
+        self.cond.release()
+        self.thread.join()
+        self._finishCurrent()
+        for bundle, fileList, size in self.ready:
+            _removeFiles(fileList)
+        self.ready = []
+
+
 # mirror new trove info for troves we have already mirrored.
 def mirrorTroveInfo(src, targets, mark, cfg, resync=False):
     if resync:
@@ -1002,31 +1139,28 @@ def mirrorRepository(sourceRepos, targetRepos, cfg,
         target = list(targetSet)[0]
         bundles = buildBundles(sourceRepos, target, troveList,
                 cfg.absoluteChangesets, cfg.splitNodes)
-        for i, bundle in enumerate(bundles):
-            jobList = [ x[1] for x in bundle ]
-            # XXX it's a shame we can't give a hint as to what server to use
-            # to avoid having to open the changeset and read in bits of it
-            if test:
+        if test:
+            for i, bundle in enumerate(bundles):
+                jobList = [ x[1] for x in bundle ]
                 log.debug("test mode: not mirroring (%d of %d) %s" % (i + 1, len(bundles), jobList))
                 updateCount += len(bundle)
-                continue
-            (outFd, tmpName) = util.mkstemp()
-            os.close(outFd)
-            log.debug("getting (%d of %d) %s" % (i + 1, len(bundles), displayBundle(bundle)))
-            try:
-                sourceRepos.createChangeSetFile(jobList, tmpName, recurse = False,
-                                                callback = callback, mirrorMode = True)
-            except changeset.ChangeSetKeyConflictError:
-                splitJobList(jobList, sourceRepos, targetSet, hidden=hidden,
-                             callback=callback)
-            else:
-                _parallel(targetSet, TargetRepository.commitChangeSetFile,
-                        tmpName, hidden=hidden, callback=callback)
+        else:
+            # changesets for the next bundles are fetched while the
+            # current one is committed; commits still happen in order
+            fetcher = BundleFetcher(sourceRepos, bundles, cfg.prefetchSize,
+                                    callback)
             try:
-                os.unlink(tmpName)
-            except OSError:
-                pass
-            callback.done()
+                for bundle, fileList in fetcher:
+                    # XXX it's a shame we can't give a hint as to what
+                    # server to use to avoid having to open the changeset
+                    # and read in bits of it
+                    for tmpName in fileList:
+                        _parallel(targetSet,
+                                  TargetRepository.commitChangeSetFile,
+                                  tmpName, hidden=hidden, callback=callback)
+                    callback.done()
+            finally:
+                fetcher.close()
         updateCount += len(bundle)
         # compute the max mark of the bundles we comitted
         mark = max([min([x[0] for x in bundle]) for bundle in bundles])
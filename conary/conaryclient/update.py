@@ -2971,6 +2971,7 @@ conary erase '%s=%s[%s]'
             commitFlags.replaceModifiedConfigFiles = replaceModifiedConfigFiles
             commitFlags.justDatabase = justDatabase
             commitFlags.localRollbacks = localRollbacks
+            commitFlags.parallelRestore = self.cfg.parallelRestore
             commitFlags.test = test
             commitFlags.keepJournal = keepJournal
             commitFlags.skipCapsuleOps = skipCapsuleOps
@@ -3624,7 +3625,7 @@ conary erase '%s=%s[%s]'
 
             # Dump the changeset to disk
             path = os.path.join(destDir, "%04d.ccs" % i)
-            newCs.writeToFile(path)
+            newCs.writeToFile(path, withIndex = True)
             csFiles.append(path)
 
         uJob.setJobsChangesetList(csFiles)
@@ -4140,7 +4141,7 @@ def _storeJobInfo(remainingJobs, updJob):
         else:
             cs.reset()
             csFileName = os.path.join(restartDir, '%d.ccs' % idx)
-            cs.writeToFile(csFileName)
+            cs.writeToFile(csFileName, withIndex = True)
         csIndex.write("%s %s\n" % (csFileName, int(incFConts)))
 
     csIndex.close()
@@ -835,7 +835,7 @@ def UnknownDependencyFactory(intTag):
 
 class DependencySet(object):
 
-    __slots__ = ( '_members', '_hash' )
+    __slots__ = ( '_members', '_hash', '_frozen' )
 
     def _getMembers(self):
         m = self._members
@@ -861,14 +861,14 @@ class DependencySet(object):
 
     def addDep(self, depClass, dep):
         assert(isinstance(dep, Dependency))
-        self._hash = None
+        self._hash = self._frozen = None
 
         tag = depClass.tag
         c = self.members.setdefault(tag, depClass())
         c.addDep(dep)
 
     def addDeps(self, depClass, deps):
-        self._hash = None
+        self._hash = self._frozen = None
         tag = depClass.tag
         c = self.members.setdefault(tag, depClass())
 
@@ -913,7 +913,7 @@ class DependencySet(object):
         return depClass.tag in self.members
 
     def removeDeps(self, depClass, deps, missingOkay = False):
-        self._hash = None
+        self._hash = self._frozen = None
 
         if missingOkay and depClass.tag not in self.members:
             return
@@ -931,14 +931,14 @@ class DependencySet(object):
             del self.members[depClass.tag]
 
     def removeDepsByClass(self, depClass):
-        self._hash = None
+        self._hash = self._frozen = None
         self.members.pop(depClass.tag, None)
 
     def addEmptyDepClass(self, depClass):
         """ adds an empty dependency class, which for flavors has
             different semantics when merging than not having a dependency
             class.  See mergeFlavors """
-        self._hash = None
+        self._hash = self._frozen = None
         tag = depClass.tag
         assert(tag not in self.members)
         self.members[tag] = depClass()
@@ -982,7 +982,7 @@ class DependencySet(object):
             return
         assert(isinstance(other, self.__class__)
                 or isinstance(self, other.__class__))
-        self._hash = None
+        self._hash = self._frozen = None
         a = self.addDep
         for tag, members in other.members.iteritems():
             c = members.__class__
@@ -1038,6 +1038,19 @@ class DependencySet(object):
         # right now if we enforced that. We test for DependencySet
         # instead of self.__class__
         assert(isinstance(other, DependencySet))
+        # the score only depends on the frozen forms, which lets us
+        # avoid thawing (and rescoring) the same pairs over and over
+        key = (self.freeze(), other.freeze())
+        score = scoreCache.get(key, None)
+        if score is None:
+            score = self._score(other)
+            if len(scoreCache) >= SCORE_CACHE_SIZE:
+                scoreCache.clear()
+            scoreCache[key] = score
+
+        return score
+
+    def _score(self, other):
         score = 0
         for tag in other.members:
             # ignore empty dep classes when scoring
@@ -1134,8 +1147,10 @@ class DependencySet(object):
     def freeze(self, skipSet = None):
         if type(self._members) == str:
             return self._members
-        else:
-            return dep_freeze.depSetFreeze(self.members)
+        elif self._frozen is None:
+            self._frozen = dep_freeze.depSetFreeze(self.members)
+
+        return self._frozen
 
     def isEmpty(self):
         return not(self._members)
@@ -1158,7 +1173,7 @@ class DependencySet(object):
         else:
             self._members = ''
 
-        self._hash = None
+        self._hash = self._frozen = None
 
     thaw = __init__
 
@@ -1184,8 +1199,16 @@ class Flavor(DependencySet):
 
     @api.developerApi
     def stronglySatisfies(self, other):
-        return self.toStrongFlavor().score(
-                    other.toStrongFlavor()) is not False
+        key = (self.freeze(), other.freeze())
+        satisfies = strongScoreCache.get(key, None)
+        if satisfies is None:
+            satisfies = self.toStrongFlavor().score(
+                            other.toStrongFlavor()) is not False
+            if len(strongScoreCache) >= SCORE_CACHE_SIZE:
+                strongScoreCache.clear()
+            strongScoreCache[key] = satisfies
+
+        return satisfies
 
 def ThawDependencySet(frz):
     return DependencySet(frz)
@@ -1881,9 +1904,139 @@ class DependencyMatcher(object):
     def clear(self):
         self.depMap.clear()
 
+class FlavorMatcher(object):
+    """
+    Scores lists of flavors against a single flavor.
+
+    Both sides are compiled into bitmasks over a process-wide vocabulary of
+    (dependency class, name, flag) bits, one mask per flag sense. Scoring a
+    candidate then takes a handful of integer operations instead of walking
+    the dependency classes of both flavors, and frozen flavors never need
+    to be thawed. The results are identical to DependencySet.score().
+    """
+
+    def __init__(self, flavor):
+        self.flavor = flavor
+        self._compiled = _compileDepSet(flavor, False)
+
+    def scoreRequirements(self, flavorList):
+        """
+        Returns [ self.flavor.score(x) for x in flavorList ]
+        """
+        provides = self._compiled
+        return [ _scoreCompiled(provides, _compileDepSet(x, False))
+                 for x in flavorList ]
+
+    def scoreProviders(self, flavorList, strong = False):
+        """
+        Returns [ x.score(self.flavor) for x in flavorList ], using
+        x.toStrongFlavor() instead of x if strong is True.
+        """
+        requires = self._compiled
+        return [ _scoreCompiled(_compileDepSet(x, strong), requires)
+                 for x in flavorList ]
+
+def _depSetBit(key):
+    bit = _depSetBits.get(key, None)
+    if bit is None:
+        bit = _depSetBits.setdefault(key, 1 << _depSetBitCounter.next())
+    return bit
+
+def _compileDepSet(depSet, strong):
+    """
+    Returns (senseMasks, depMask, flaglessMask, significantMask,
+    significantCount) for depSet. senseMasks is indexed by flag sense,
+    with the union of all the flags at FLAG_SENSE_UNSPECIFIED.
+    """
+    key = (depSet.freeze(), strong)
+    compiled = compiledDepSetCache.get(key, None)
+    if compiled is not None:
+        return compiled
+
+    senseMasks = [ 0 ] * 5
+    depMask = flaglessMask = significantMask = 0
+    significantCount = 0
+    for tag, name, flags in depSet.iterRawDeps():
+        depBit = _depSetBit((tag, name))
+        depMask |= depBit
+        if not flags:
+            flaglessMask |= depBit
+        if dependencyClasses[tag].depNameSignificant:
+            significantMask |= depBit
+            significantCount += 1
+
+        for flag in flags:
+            kind = flag[0:2]
+            if kind == '~!':
+                flag, sense = flag[2:], FLAG_SENSE_PREFERNOT
+            elif kind[0] == '!':
+                flag, sense = flag[1:], FLAG_SENSE_DISALLOWED
+            elif kind[0] == '~':
+                flag, sense = flag[1:], FLAG_SENSE_PREFERRED
+            else:
+                sense = FLAG_SENSE_REQUIRED
+            if strong:
+                sense = toStrongMap[sense]
+            flagBit = _depSetBit((tag, name, flag))
+            senseMasks[sense] |= flagBit
+            senseMasks[FLAG_SENSE_UNSPECIFIED] |= flagBit
+
+    compiled = (tuple(senseMasks), depMask, flaglessMask, significantMask,
+                significantCount)
+    if len(compiledDepSetCache) >= SCORE_CACHE_SIZE:
+        compiledDepSetCache.clear()
+    compiledDepSetCache[key] = compiled
+    return compiled
+
+def _scoreCompiled(provides, requires):
+    provSenses, provDeps = provides[0:2]
+    (reqSenses, reqDeps, reqFlagless, reqSignificant,
+            reqSignificantCount) = requires
+
+    # a missing dependency only matches if its dependency class is defined
+    # by its flags and every flag it has allows it to be missing
+    missing = reqDeps & ~provDeps
+    if missing & (reqSignificant | reqFlagless):
+        return False
+
+    score = reqSignificantCount
+    unspecified = ~provSenses[FLAG_SENSE_UNSPECIFIED]
+    for reqSense in _flagSenses:
+        reqMask = reqSenses[reqSense]
+        if not reqMask:
+            continue
+        for provSense in _allFlagSenses:
+            if provSense == FLAG_SENSE_UNSPECIFIED:
+                common = reqMask & unspecified
+            else:
+                common = reqMask & provSenses[provSense]
+            if not common:
+                continue
+            thisScore = flavorScores[(provSense, reqSense)]
+            if thisScore is None:
+                return False
+            score += thisScore * bin(common).count('1')
+
+    return score
+
 
 dependencyCache = weakref.WeakValueDictionary()
 
+# results of DependencySet.score() and Flavor.stronglySatisfies(), keyed
+# by the frozen forms of both sides; emptied when they grow too large
+SCORE_CACHE_SIZE = 50000
+scoreCache = {}
+strongScoreCache = {}
+
+# FlavorMatcher state: the bit assigned to each (class, name) and
+# (class, name, flag), and the compiled form of each frozen dependency set
+_depSetBits = {}
+_depSetBitCounter = itertools.count()
+compiledDepSetCache = {}
+_flagSenses = (FLAG_SENSE_REQUIRED, FLAG_SENSE_PREFERRED,
+               FLAG_SENSE_PREFERNOT, FLAG_SENSE_DISALLOWED)
+_allFlagSenses = (FLAG_SENSE_UNSPECIFIED, ) + _flagSenses
+
 ident = '(?:[0-9A-Za-z_-]+)'
 flag = '(?:~?!?IDENT)'
 useFlag = '(?:!|~!)?FLAG(?:\.IDENT)?'
@@ -594,9 +594,14 @@ class RegularFile(File):
                 nameLookup=True, **kwargs):
 
         keepTempfile = kwargs.get('keepTempfile', False)
+        # (sha1, tmpname) of contents which were already uncompressed next
+        # to target by the caller (see local.update.ParallelRestore)
+        prepared = kwargs.pop('prepared', None)
         destTarget = target
 
-        if fileContents is not None:
+        if prepared is not None:
+            actualSha1, tmpname = prepared
+        elif fileContents is not None:
             # this is first to let us copy the contents of a file
             # onto itself; the unlink helps that to work
             src = fileContents.get()
@@ -630,6 +635,7 @@ class RegularFile(File):
                     os.unlink(tmpname)
                     raise
 
+        if fileContents is not None or prepared is not None:
             if keepTempfile:
                 # Make a hardlink "copy" for the caller to use
                 destTarget = tmpname + '.ptr'
@@ -22,8 +22,10 @@ import httplib
 import os
 import select
 import socket
+import threading
 import time
 import warnings
+import weakref
 
 from conary import constants
 from conary.lib import util
@@ -77,6 +79,10 @@ class Connection(object):
         self.doTunnel = bool(proxy) and self.doSSL
         # Cached HTTPConnection object
         self.cached = None
+        # Set while a ConnectionPool has handed this connection out
+        self.busy = False
+        # Shared cache of SSL sessions to resume, see ConnectionPool
+        self.sslSessions = None
 
     def close(self):
         if self.cached:
@@ -84,15 +90,41 @@ class Connection(object):
             self.cached = None
 
     def request(self, req):
+        try:
+            response = self._request(req)
+        except:
+            self.busy = False
+            raise
+        if response.will_close:
+            self.cached = None
+        if self.cached and not response.isclosed():
+            # Release the connection once the response has been read
+            response.onFinish = self._responseDone
+        else:
+            self.busy = False
+        return response
+
+    def _request(self, req):
+        if self.cached and self._isStale(self.cached):
+            self.cached.close()
+            self.cached = None
         if self.cached:
             # Try once to use the cached connection; if it fails to send the
-            # request then discard and try again.
+            # request then discard and try again. If the server closed it
+            # without answering, it may have done so just as the request
+            # arrived, or after acting on it, so only try again if repeating
+            # the request is harmless.
             try:
                 return self.requestOnce(self.cached, req)
             except http_error.RequestError, err:
                 err.wrapped.clear()
-                self.cached.close()
-                self.cached = None
+            except httplib.BadStatusLine:
+                if not req.isIdempotent():
+                    self.close()
+                    raise
+            self.cached.close()
+            self.cached = None
+            req.reset()
         # If a problem occurs before or during the sending of the request, then
         # throw a wrapper exception so that the caller knows it is safe to
         # retry. Once the request is sent retries must be done more carefully
@@ -118,10 +150,29 @@ class Connection(object):
 
         host, port = self.endpoint.hostport
         conn = httplib.HTTPConnection(host, port, strict=True)
+        conn.response_class = TrackedResponse
         conn.sock = wrapped
         conn.auto_open = False
         return conn
 
+    @staticmethod
+    def _isStale(conn):
+        """Check if the server has closed an idle kept-alive connection."""
+        if conn.sock is None:
+            return True
+        try:
+            # Nothing should arrive on an idle connection except EOF
+            return bool(select.select([conn.sock], [], [], 0)[0])
+        except (select.error, socket.error):
+            return True
+
+    def _responseDone(self, complete):
+        if not complete and self.cached:
+            # The rest of the response is still on the wire
+            self.cached.close()
+            self.cached = None
+        self.busy = False
+
     def connectSocket(self):
         """Open a connection to the proxy, or endpoint if no proxy."""
         host, port = self.local.hostport
@@ -171,7 +222,12 @@ class Connection(object):
         if self.caCerts:
             # If cert checking is requested use m2crypto
             if SSL:
-                return startSSLWithChecker(sock, self.caCerts, self.commonName)
+                if self.doTunnel or not self.proxy:
+                    peer = self.endpoint
+                else:
+                    peer = self.proxy
+                return startSSLWithChecker(sock, self.caCerts, self.commonName,
+                        self.sslSessions, (str(peer.hostport), self.commonName))
             else:
                 warnings.warn("m2crypto is not installed; server certificates "
                         "will not be validated!")
@@ -225,9 +281,13 @@ class Connection(object):
         return conn.getresponse()
 
 
-def startSSLWithChecker(sock, caCerts, commonName):
+def startSSLWithChecker(sock, caCerts, commonName, sessionCache=None,
+        sessionKey=None):
     """Start SSL on the given socket and do server certificate validation.
 
+    If C{sessionCache} is given, the session stored in it under
+    C{sessionKey} is resumed if possible, and the new session is stored back.
+
     Returns the new M2Crypto SSL Connection object.
     """
     ssl_ctx = SSL.Context('sslv23')
@@ -243,8 +303,138 @@ def startSSLWithChecker(sock, caCerts, commonName):
     sslSock = SSL.Connection(ssl_ctx, sock)
     sslSock.setup_ssl()
     sslSock.set_connect_state()
+    if sessionCache is not None and sessionKey in sessionCache:
+        sslSock.set_session(sessionCache[sessionKey])
     sslSock.connect_ssl()
     checker = SSL.Checker.Checker()
     if not checker(sslSock.get_peer_cert(), commonName):
         raise SSLVerificationError("post connection check failed")
+    if sessionCache is not None:
+        sessionCache[sessionKey] = sslSock.get_session()
     return sslSock
+
+
+class TrackedResponse(httplib.HTTPResponse):
+    """HTTP response which tells its connection when it is finished with.
+
+    C{onFinish} is called once, with C{True} if the whole response was read
+    and the connection can carry another request, or C{False} if the
+    response was closed or failed part way through, or its owner (see
+    L{setOwner}) went away before reading all of it.
+    """
+
+    onFinish = None
+    _reading = False
+    _ownerRef = None
+
+    def setOwner(self, owner):
+        """Treat the response as abandoned if C{owner} is garbage collected
+        before the response has been read to the end.
+
+        The response itself can't be watched that way, since the
+        HTTPConnection refers to it until it is complete.
+        """
+        self._ownerRef = weakref.ref(owner, self._ownerLost)
+
+    def _ownerLost(self, ref):
+        if ref is self._ownerRef:
+            self._finish(False)
+
+    def read(self, amt=None):
+        self._reading = True
+        try:
+            try:
+                data = httplib.HTTPResponse.read(self, amt)
+            except:
+                self._finish(False)
+                raise
+        finally:
+            self._reading = False
+        if self.fp is None:
+            self._finish(True)
+        return data
+
+    def close(self):
+        httplib.HTTPResponse.close(self)
+        if not self._reading:
+            self._finish(False)
+
+    def _finish(self, complete):
+        onFinish, self.onFinish = self.onFinish, None
+        if onFinish:
+            onFinish(complete)
+
+
+class ConnectionPool(object):
+    """Kept-alive connections shared by all the openers in a process.
+
+    Connections are keyed by connection class, endpoint, proxy and CA
+    certificates. Each is handed to one request at a time and becomes
+    available again once its response has been read. At most C{maxPerHost}
+    connections are kept for each key; when all of them are busy C{acquire}
+    returns C{None} and the caller should use a connection of its own.
+    Waiting instead could deadlock a thread which still holds a response
+    open, for instance a changeset being streamed.
+
+    SSL sessions are shared by all the connections in the pool, so new
+    connections to a server resume the session of an earlier one.
+    """
+
+    maxPerHost = 4
+
+    def __init__(self, maxPerHost=None):
+        if maxPerHost is not None:
+            self.maxPerHost = maxPerHost
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.connections = {}
+        self.sslSessions = {}
+
+    def acquire(self, key, factory):
+        """Return an idle connection for C{key}, making a new one with
+        C{factory} if there is room, or C{None} if there isn't."""
+        self.lock.acquire()
+        try:
+            if self.pid != os.getpid():
+                # Connections inherited across a fork are still used by the
+                # parent; forget them without closing them.
+                self._reset()
+            conns = self.connections.setdefault(key, [])
+            for conn in conns:
+                if not conn.busy:
+                    break
+            else:
+                if len(conns) >= self.maxPerHost:
+                    return None
+                conn = factory()
+                conn.sslSessions = self.sslSessions
+                conns.append(conn)
+            conn.busy = True
+            return conn
+        finally:
+            self.lock.release()
+
+    def close(self, keys=None):
+        """Close idle connections, either all of them or those for the
+        given keys."""
+        self.lock.acquire()
+        try:
+            if self.pid != os.getpid():
+                self._reset()
+            if keys is None:
+                keys = self.connections.keys()
+            for key in keys:
+                conns = self.connections.get(key, [])
+                for conn in conns[:]:
+                    if not conn.busy:
+                        conn.close()
+                        conns.remove(conn)
+        finally:
+            self.lock.release()
+
+
+# Pool used by openers which keep connections alive
+defaultPool = ConnectionPool()
@@ -43,7 +43,14 @@ class URLOpener(object):
     redirectAttempts = 5
 
     def __init__(self, proxyMap=None, caCerts=None, persist=False,
-            connectAttempts=None, followRedirects=False):
+            connectAttempts=None, followRedirects=False, connectionPool=None):
+        """
+        @param persist: Keep connections alive in C{connectionPool} so that
+            later requests to the same server, from this or any other opener
+            using the pool, don't have to connect again.
+        @param connectionPool: The L{ConnectionPool} used when C{persist} is
+            set. Defaults to the process-wide pool.
+        """
         if proxyMap is None:
             proxyMap = proxy_map.ProxyMap()
         self.proxyMap = proxyMap
@@ -52,8 +59,11 @@ class URLOpener(object):
         if connectAttempts:
             self.connectAttempts = connectAttempts
         self.followRedirects = followRedirects
+        if connectionPool is None:
+            connectionPool = conn_mod.defaultPool
+        self.connectionPool = connectionPool
 
-        self.connectionCache = {}
+        self.poolKeys = set()
         self.lastProxy = None
 
     def newRequest(self, url, data=None, method=None, headers=()):
@@ -124,7 +134,12 @@ class URLOpener(object):
         elif encoding == 'gzip':
             fp = util.GzipFile(fileobj=fp)
             fp.seek(0)
-        return ResponseWrapper(fp, response)
+        wrapper = ResponseWrapper(fp, response)
+        if isinstance(response, conn_mod.TrackedResponse):
+            # A response dropped before it was read to the end can't give its
+            # connection back for other requests
+            response.setOwner(wrapper)
+        return wrapper
 
     @staticmethod
     def _drain(response):
@@ -207,7 +222,11 @@ class URLOpener(object):
                         self._processSocketError(err)
                         lastError.replace(err)
                 except httplib.BadStatusLine:
-                    # closed connection without sending a response.
+                    # closed connection without sending a response. The
+                    # server may have acted on the request anyway, so only
+                    # send it again if that's harmless.
+                    if not req.isIdempotent():
+                        raise
                     lastError = util.SavedException()
                 except socket.error, err:
                     # Fatal error, but attach proxy information to it.
@@ -268,18 +287,29 @@ class URLOpener(object):
 
     def _requestOnce(self, req, proxy):
         """Issue a request to a a single destination."""
-        key = (req.url.scheme, req.url.hostport, proxy)
-        conn = self.connectionCache.get(key)
-        if conn is None:
-            conn = self.connectionFactory(req.url, proxy, self.caCerts)
-            if self.persist:
-                self.connectionCache[key] = conn
+        factory = lambda: self.connectionFactory(req.url, proxy, self.caCerts)
+        conn = None
+        if self.persist:
+            key = (self.connectionFactory, req.url.scheme, req.url.hostport,
+                    proxy, self.caCerts and tuple(self.caCerts))
+            self.poolKeys.add(key)
+            conn = self.connectionPool.acquire(key, factory)
 
-        if not self.persist:
+        if conn is None:
+            # Not kept alive, or all the pooled connections are busy
+            conn = factory()
             req.headers.setdefault('Connection', 'close')
 
         response = conn.request(req)
-        self._handleProxyErrors(response.status)
+        try:
+            self._handleProxyErrors(response.status)
+        except:
+            err = util.SavedException()
+            if isinstance(response, conn_mod.TrackedResponse):
+                # Nothing else will read this response, so don't keep the
+                # connection for it
+                response.close()
+            err.throw()
         return response
 
     def _handleProxyErrors(self, errcode):
@@ -311,9 +341,9 @@ class URLOpener(object):
             error.strerror = msgError
 
     def close(self):
-        for conn in self.connectionCache.values():
-            conn.close()
-        self.connectionCache.clear()
+        """Close the idle pooled connections this opener has used."""
+        self.connectionPool.close(self.poolKeys)
+        self.poolKeys.clear()
 
 
 class ResponseWrapper(object):
@@ -144,6 +144,11 @@ class HTTPHeaders(object):
 
 class Request(object):
 
+    # Methods which can be sent again without changing the outcome (RFC 2616
+    # section 9.1.2)
+    idempotentMethods = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS',
+        'TRACE'])
+
     def __init__(self, url, method='GET', headers=()):
         if isinstance(url, basestring):
             url = URL.parse(url)
@@ -186,6 +191,10 @@ class Request(object):
     def setAbortCheck(self, abortCheck):
         self.abortCheck = abortCheck
 
+    def isIdempotent(self):
+        """Return C{True} if sending the request more than once is harmless."""
+        return self.method in self.idempotentMethods
+
     def sendRequest(self, conn, isProxied=False):
         if isProxied:
             cleanUrl = self.url._replace(userpass=(None,None))
@@ -18,6 +18,7 @@
 import base64
 import bdb
 import bz2
+import datetime
 import debugger
 import errno
 import fnmatch
@@ -34,6 +35,7 @@ import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import types
 import urllib
@@ -546,6 +548,41 @@ def copyfile(sources, dest, verbose=True):
             log.info('copying %s to %s', source, dest)
         shutil.copy2(source, dest)
 
+class RateLimiter(object):
+    """
+    Limits the combined rate of any number of transfers, which may be
+    running in different threads, to rate bytes per second. Pass it to
+    copyfileobj() as the rateLimit. A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate or 0)
+        self.lock = threading.Lock()
+        # when the bytes accounted for so far may all have been sent
+        self.next = None
+
+    def limit(self, count):
+        """
+        Accounts for count bytes which were just transferred, sleeping as
+        long as it takes to keep the total within the rate.
+        """
+        if not self.rate:
+            return
+
+        self.lock.acquire()
+        try:
+            now = time.time()
+            # time spent idle doesn't allow bursts later on
+            if self.next is None or self.next < now:
+                self.next = now
+            self.next += count / self.rate
+            delay = self.next - now
+        finally:
+            self.lock.release()
+
+        if delay > 0:
+            time.sleep(delay)
+
 def copyfileobj(source, dest, callback = None, digest = None,
                 abortCheck = None, bufSize = 128*1024, rateLimit = None,
                 sizeLimit = None, total=0):
@@ -554,6 +591,12 @@ def copyfileobj(source, dest, callback = None, digest = None,
     else:
         write = dest.write
 
+    limiter = None
+    if isinstance(rateLimit, RateLimiter):
+        # shared with other transfers, which do their own accounting
+        limiter = rateLimit
+        rateLimit = limiter.rate
+
     if rateLimit is None:
         rateLimit = 0
 
@@ -614,7 +657,9 @@ def copyfileobj(source, dest, callback = None, digest = None,
         if copied == sizeLimit:
             break
 
-        if rateLimit > 0 and rate > rateLimit:
+        if limiter:
+            limiter.limit(len(buf))
+        elif rateLimit > 0 and rate > rateLimit:
             time.sleep((copied / rateLimit) - (copied / rate))
 
     return copied
@@ -1129,6 +1174,86 @@ class IterableQueue:
     def __init__(self):
         self.l = []
 
+def iterParallel(func, argsList, maxThreads):
+    """
+    Calls C{func(*args)} for each tuple in C{argsList} using at most
+    C{maxThreads} worker threads, yielding C{(index, result)} tuples as
+    the calls finish (C{index} is the position of the call in
+    C{argsList}). If a call raises an exception, no new calls are started
+    and the exception is reraised once the running calls have finished.
+
+    @param func: Function to call
+    @type func: callable
+    @param argsList: Arguments for each call
+    @type argsList: iterable of C{tuple}
+    @param maxThreads: Maximum number of concurrent calls
+    @type maxThreads: C{int}
+    @rtype: iterator
+    """
+    argsList = list(argsList)
+    if not argsList:
+        return
+
+    pending = list(enumerate(argsList))
+    pending.reverse()
+    results = []
+    cond = threading.Condition()
+    state = dict(running = 0, error = None)
+
+    def worker():
+        while True:
+            cond.acquire()
+            try:
+                if not pending or state['error']:
+                    state['running'] -= 1
+                    cond.notify()
+                    return
+                idx, args = pending.pop()
+            finally:
+                cond.release()
+
+            try:
+                rc = func(*args)
+            except:
+                cond.acquire()
+                state['error'] = SavedException()
+                cond.release()
+                continue
+
+            cond.acquire()
+            results.append((idx, rc))
+            cond.notify()
+            cond.release()
+
+    cond.acquire()
+    try:
+        for i in range(max(1, min(maxThreads, len(argsList)))):
+            thread = threading.Thread(target = worker)
+            thread.setDaemon(True)
+            state['running'] += 1
+            thread.start()
+
+        while True:
+            while not results and state['running']:
+                cond.wait()
+
+            if results:
+                rc = results.pop(0)
+                # don't hold the lock while the caller consumes the result
+                cond.release()
+                try:
+                    yield rc
+                finally:
+                    cond.acquire()
+            elif state['error']:
+                state['error'].throw()
+            else:
+                break
+    finally:
+        # if the caller stopped iterating early, don't start anything else
+        del pending[:]
+        cond.release()
+
 def lstat(path):
     """
     Return None if the path doesn't exist.
@@ -1631,6 +1756,35 @@ def splitExact(s, sep, maxsplit, pad=None):
     arr.extend(pad for x in range(maxsplit + 1 - arrLen))
     return arr
 
+def _iterDump(marshaller, value, flushParts=2048):
+    """
+    Marshals value with marshaller, yielding the output in pieces instead
+    of building it all at once. Arrays and structs are walked with the
+    marshaller's iterContainers generators, which write the framing of a
+    container and yield its members; everything else goes through the
+    marshaller's _dump().
+    """
+    parts = []
+    write = parts.append
+    containers = marshaller.iterContainers
+    stack = [ iter((value,)) ]
+    while stack:
+        for v in stack[-1]:
+            if len(parts) >= flushParts:
+                yield ''.join(parts)
+                del parts[:]
+
+            f = containers.get(type(v))
+            if f is not None:
+                stack.append(f(marshaller, v, write))
+                break
+            marshaller._dump(v, write)
+        else:
+            stack.pop()
+
+    if parts:
+        yield ''.join(parts)
+
 class XMLRPCMarshaller(xmlrpclib.Marshaller):
     """Marshaller for XMLRPC data"""
     dispatch = xmlrpclib.Marshaller.dispatch.copy()
@@ -1690,6 +1844,44 @@ class XMLRPCMarshaller(xmlrpclib.Marshaller):
     dispatch[ProtectedString] = dump_string
     dispatch[ProtectedTemplate] = dump_string
 
+    # generator versions of dump_array and dump_struct for iterdump()
+    def iter_array(self, value, write):
+        write("<value><array><data>\n")
+        for v in value:
+            yield v
+        write("</data></array></value>\n")
+
+    def iter_struct(self, value, write, escape=xmlrpclib.escape):
+        write("<value><struct>\n")
+        for k, v in value.items():
+            write("<member>\n")
+            if type(k) is not str:
+                if type(k) is unicode:
+                    k = k.encode(self.encoding)
+                else:
+                    raise TypeError, "dictionary key must be string"
+            write("<name>%s</name>\n" % escape(k))
+            yield v
+            write("</member>\n")
+        write("</struct></value>\n")
+
+    iterContainers = { tuple : iter_array, list : iter_array,
+                       dict : iter_struct }
+
+    def iterdump(self, values):
+        """Like dump(), but yields the output in pieces"""
+        if isinstance(values, xmlrpclib.Fault):
+            yield self.dumps(values)
+            return
+
+        yield "<params>\n"
+        for v in values:
+            yield "<param>\n"
+            for s in _iterDump(self, v):
+                yield s
+            yield "</param>\n"
+        yield "</params>\n"
+
 class XMLRPCUnmarshaller(xmlrpclib.Unmarshaller):
     dispatch = xmlrpclib.Unmarshaller.dispatch.copy()
     def end_base64(self, data):
@@ -1759,6 +1951,47 @@ def xmlrpcDump(params, methodname=None, methodresponse=None, stream=None,
         return io.getvalue()
     return ""
 
+def xmlrpcDumpIter(params, methodname=None, methodresponse=None,
+                   encoding=None, allow_none=False):
+    """
+    Like L{xmlrpcDump}, but returns an iterator over the pieces of the
+    document so large responses never need to be held in memory at once.
+    """
+    assert isinstance(params, tuple) or isinstance(params, xmlrpclib.Fault),\
+           "argument must be tuple or Fault instance"
+    if isinstance(params, xmlrpclib.Fault):
+        methodresponse = 1
+    elif methodresponse and isinstance(params, tuple):
+        assert len(params) == 1, "response tuple must be a singleton"
+
+    if not encoding:
+        encoding = "utf-8"
+
+    m = XMLRPCMarshaller(encoding, allow_none)
+    if encoding != "utf-8":
+        xmlheader = "<?xml version='1.0' encoding='%s'?>\n" % str(encoding)
+    else:
+        xmlheader = "<?xml version='1.0'?>\n" # utf-8 is default
+
+    if methodname:
+        if not isinstance(methodname, str):
+            methodname = methodname.encode(encoding)
+        yield xmlheader
+        yield "<methodCall>\n"
+        yield "<methodName>%s</methodName>\n" % methodname
+        for s in m.iterdump(params):
+            yield s
+        yield "</methodCall>\n"
+    elif methodresponse:
+        yield xmlheader
+        yield "<methodResponse>\n"
+        for s in m.iterdump(params):
+            yield s
+        yield "</methodResponse>\n"
+    else:
+        for s in m.iterdump(params):
+            yield s
+
 def xmlrpcLoad(stream):
     p, u = xmlrpcGetParser()
     if hasattr(stream, "read"):
@@ -1782,6 +2015,275 @@ def xmlrpcLoad(stream):
     return u.close(), u.getmethodname()
 
 
+# Content-Type of requests and responses which use the binary encoding
+BINRPC_CONTENT_TYPE = 'application/x-conary-rpc'
+_BINRPC_MAGIC = 'CRPC\x01'
+_binrpcLength = struct.Struct('!I')
+_binrpcInt = struct.Struct('!q')
+_binrpcFloat = struct.Struct('!d')
+
+class BinaryRPCMarshaller(object):
+    """
+    Marshaller for the binary RPC encoding. Every value is a one byte type
+    code followed by its data. Strings, arrays and structs start with
+    their length, so nothing needs to be escaped and there is no text to
+    parse on the other end.
+    """
+    dispatch = {}
+
+    def __init__(self, allow_none=False):
+        self.allow_none = allow_none
+
+    def dumps(self, value):
+        l = []
+        self._dump(value, l.append)
+        return ''.join(l)
+
+    def _dump(self, value, write):
+        try:
+            f = self.dispatch[type(value)]
+        except KeyError:
+            # objects are marshalled as structures, the same way
+            # XMLRPCMarshaller handles them
+            try:
+                value.__dict__
+            except:
+                raise TypeError, "cannot marshal %s objects" % type(value)
+            for type_ in type(value).__mro__:
+                if type_ in self.dispatch:
+                    raise TypeError, "cannot marshal %s objects" % type(value)
+            f = self.dispatch[types.InstanceType]
+        f(self, value, write)
+
+    def dump_nil(self, value, write):
+        if not self.allow_none:
+            raise TypeError, "cannot marshal None unless allow_none is enabled"
+        write('n')
+    dispatch[types.NoneType] = dump_nil
+
+    def dump_bool(self, value, write):
+        write(value and 't' or 'f')
+    dispatch[bool] = dump_bool
+
+    def dump_int(self, value, write):
+        write('i' + _binrpcInt.pack(value))
+    dispatch[int] = dump_int
+    dispatch[long] = dump_int
+
+    def dump_double(self, value, write):
+        write('d' + _binrpcFloat.pack(value))
+    dispatch[float] = dump_double
+
+    def dump_string(self, value, write):
+        write('s' + _binrpcLength.pack(len(value)))
+        write(value)
+    dispatch[str] = dump_string
+    dispatch[ProtectedString] = dump_string
+    dispatch[ProtectedTemplate] = dump_string
+
+    def dump_unicode(self, value, write):
+        value = value.encode('utf-8')
+        write('u' + _binrpcLength.pack(len(value)))
+        write(value)
+    dispatch[unicode] = dump_unicode
+
+    def _dump_iso8601(self, value, write):
+        write('D' + _binrpcLength.pack(len(value)))
+        write(value)
+
+    def dump_datetime(self, value, write):
+        self._dump_iso8601(xmlrpclib.DateTime(value).value, write)
+    dispatch[datetime.datetime] = dump_datetime
+
+    def dump_instance(self, value, write):
+        # xmlrpclib.Binary and xmlrpclib.DateTime are classic classes
+        if isinstance(value, xmlrpclib.Binary):
+            self.dump_string(value.data, write)
+        elif isinstance(value, xmlrpclib.DateTime):
+            self._dump_iso8601(value.value, write)
+        else:
+            self.dump_struct(value.__dict__, write)
+    dispatch[types.InstanceType] = dump_instance
+
+    def dump_array(self, value, write):
+        write('a' + _binrpcLength.pack(len(value)))
+        dump = self._dump
+        for v in value:
+            dump(v, write)
+    dispatch[tuple] = dump_array
+    dispatch[list] = dump_array
+
+    def dump_struct(self, value, write):
+        write('m' + _binrpcLength.pack(len(value)))
+        dump = self._dump
+        for k, v in value.iteritems():
+            dump(k, write)
+            dump(v, write)
+    dispatch[dict] = dump_struct
+
+    def iter_array(self, value, write):
+        write('a' + _binrpcLength.pack(len(value)))
+        return iter(value)
+
+    def iter_struct(self, value, write):
+        write('m' + _binrpcLength.pack(len(value)))
+        dump = self._dump
+        for k, v in value.iteritems():
+            dump(k, write)
+            yield v
+
+    iterContainers = { tuple : iter_array, list : iter_array,
+                       dict : iter_struct }
+
+    def iterdumps(self, value):
+        """Like dumps(), but yields the output in pieces"""
+        return _iterDump(self, value)
+
+class BinaryRPCUnmarshaller(object):
+    """
+    Unmarshaller for the binary RPC encoding. Arrays are returned as
+    lists, and strings and dates the same way L{XMLRPCUnmarshaller}
+    returns them.
+    """
+    dispatch = {}
+
+    def __init__(self, data):
+        self.data = data
+
+    def load(self, offset):
+        """Returns the value at offset and the offset which follows it"""
+        return self.dispatch[self.data[offset]](self, offset + 1)
+
+    def _load_bytes(self, offset):
+        length, = _binrpcLength.unpack_from(self.data, offset)
+        offset += 4
+        end = offset + length
+        if end > len(self.data):
+            raise IndexError(end)
+        return self.data[offset:end], end
+
+    def load_nil(self, offset):
+        return None, offset
+    dispatch['n'] = load_nil
+
+    def load_true(self, offset):
+        return True, offset
+    dispatch['t'] = load_true
+
+    def load_false(self, offset):
+        return False, offset
+    dispatch['f'] = load_false
+
+    def load_int(self, offset):
+        return _binrpcInt.unpack_from(self.data, offset)[0], offset + 8
+    dispatch['i'] = load_int
+
+    def load_double(self, offset):
+        return _binrpcFloat.unpack_from(self.data, offset)[0], offset + 8
+    dispatch['d'] = load_double
+
+    dispatch['s'] = _load_bytes
+
+    def load_unicode(self, offset):
+        value, offset = self._load_bytes(offset)
+        value = value.decode('utf-8')
+        try:
+            return value.encode('ascii'), offset
+        except UnicodeError:
+            return value, offset
+    dispatch['u'] = load_unicode
+
+    def load_datetime(self, offset):
+        value, offset = self._load_bytes(offset)
+        return xmlrpclib.DateTime(value), offset
+    dispatch['D'] = load_datetime
+
+    def load_array(self, offset):
+        count, = _binrpcLength.unpack_from(self.data, offset)
+        offset += 4
+        l = []
+        load = self.load
+        for i in xrange(count):
+            value, offset = load(offset)
+            l.append(value)
+        return l, offset
+    dispatch['a'] = load_array
+
+    def load_struct(self, offset):
+        count, = _binrpcLength.unpack_from(self.data, offset)
+        offset += 4
+        d = {}
+        load = self.load
+        for i in xrange(count):
+            key, offset = load(offset)
+            d[key], offset = load(offset)
+        return d, offset
+    dispatch['m'] = load_struct
+
+def binrpcDump(params, methodname=None, methodresponse=None,
+               allow_none=False):
+    """
+    Binary counterpart of L{xmlrpcDump}. A message is a header, the method
+    name for calls, and the parameters (or the fault) as a single value.
+    """
+    return ''.join(binrpcDumpIter(params, methodname = methodname,
+                                  methodresponse = methodresponse,
+                                  allow_none = allow_none))
+
+def binrpcDumpIter(params, methodname=None, methodresponse=None,
+                   allow_none=False):
+    """
+    Like L{binrpcDump}, but returns an iterator over the pieces of the
+    message.
+    """
+    assert isinstance(params, tuple) or isinstance(params, xmlrpclib.Fault),\
+           "argument must be tuple or Fault instance"
+    m = BinaryRPCMarshaller(allow_none)
+    if isinstance(params, xmlrpclib.Fault):
+        yield _BINRPC_MAGIC + 'F'
+        yield m.dumps({'faultCode' : params.faultCode,
+                       'faultString' : params.faultString})
+        return
+    elif methodresponse:
+        assert len(params) == 1, "response tuple must be a singleton"
+        yield _BINRPC_MAGIC + 'R'
+    elif methodname:
+        yield _BINRPC_MAGIC + 'C' + m.dumps(methodname)
+    else:
+        yield _BINRPC_MAGIC + 'P'
+
+    for s in m.iterdumps(params):
+        yield s
+
+def binrpcLoad(stream):
+    """
+    Binary counterpart of L{xmlrpcLoad}; returns (params, methodname).
+    """
+    if hasattr(stream, "read"):
+        data = stream.read()
+    else:
+        data = stream
+    if data[:len(_BINRPC_MAGIC)] != _BINRPC_MAGIC:
+        raise xmlrpclib.ResponseError
+    kind = data[len(_BINRPC_MAGIC):len(_BINRPC_MAGIC) + 1]
+    u = BinaryRPCUnmarshaller(data)
+    offset = len(_BINRPC_MAGIC) + 1
+    methodname = None
+    try:
+        if kind == 'C':
+            methodname, offset = u.load(offset)
+        elif kind not in ('R', 'F', 'P'):
+            raise xmlrpclib.ResponseError
+        params, offset = u.load(offset)
+        if offset != len(data):
+            raise xmlrpclib.ResponseError
+        if kind == 'F':
+            raise xmlrpclib.Fault(params['faultCode'], params['faultString'])
+        return tuple(params), methodname
+    except (IndexError, KeyError, TypeError, struct.error):
+        raise xmlrpclib.ResponseError
+
+
 class ServerProxyMethod(object):
 
     def __init__(self, send, name):
@@ -1812,7 +2314,14 @@ class ServerProxy(object):
         self._allow_none = allow_none
 
     def _request(self, methodname, params):
-        # Call a method on the remote server
+        # Call a method on the remote server. Transports which have seen
+        # the server answer in the binary encoding get binary requests.
+        if getattr(self._transport, 'binaryRequests', False):
+            request = binrpcDump(params, methodname,
+                allow_none=self._allow_none)
+            return self._transport.request(self._url, request,
+                contentType=BINRPC_CONTENT_TYPE)
+
         request = xmlrpcDump(params, methodname,
             encoding = self._encoding, allow_none=self._allow_none)
 
@@ -1871,6 +2380,15 @@ def compressStream(src, level = 5, bufferSize = 16384):
     sio.write(z.flush())
     return sio
 
+def compressIter(chunks, level = 5):
+    """Deflates an iterator of strings incrementally"""
+    z = zlib.compressobj(level)
+    for chunk in chunks:
+        data = z.compress(chunk)
+        if data:
+            yield data
+    yield z.flush()
+
 def decompressString(s):
     return zlib.decompress(s, 31)
 
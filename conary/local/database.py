@@ -36,7 +36,8 @@ from conary.local import capsules as capsulesmod
 from conary.local import localrep, sqldb, schema, update
 from conary.local.errors import DatabasePathConflictError, FileInWayError
 from conary.local.journal import JobJournal, NoopJobJournal
-from conary.repository import changeset, datastore, errors, filecontents
+from conary.repository import changeset, datastore, errors, filecontainer
+from conary.repository import filecontents
 from conary.repository import repository, trovesource
 
 OldDatabaseSchema = schema.OldDatabaseSchema
@@ -47,7 +48,7 @@ class CommitChangeSetFlags(util.Flags):
                   'replaceModifiedFiles', 'justDatabase', 'localRollbacks',
                   'test', 'keepJournal', 'replaceModifiedConfigFiles',
                   'skipCapsuleOps', 'noScripts',
-                  'ignoreMissingFiles',
+                  'ignoreMissingFiles', 'parallelRestore',
                   ]
 
     def shouldRunScripts(self, tagScriptsFile):
@@ -58,19 +59,88 @@ class CommitChangeSetFlags(util.Flags):
         return True
 
 
+class RollbackContentsStore(datastore.FlatDataStore):
+
+    """
+    Holds the regular file contents for a single rollback. Each file is a
+    hard link into a store shared by the whole rollback stack, so
+    contents which are part of many rollbacks are only stored once.
+    Shared contents which no rollback links to any longer are removed by
+    removeRollbackContents().
+    """
+
+    def addFile(self, fileObj, hash, precompressed = False):
+        path = self.hashToPath(hash)
+        if os.path.exists(path):
+            return
+
+        self.shared.addFile(fileObj, hash, precompressed = precompressed)
+        self.opJournal.create(path)
+        os.link(self.shared.hashToPath(hash), path)
+
+    def __init__(self, topPath, sharedPath, opJournal):
+        datastore.FlatDataStore.__init__(self, topPath)
+        self.shared = datastore.FlatDataStore(sharedPath)
+        self.opJournal = opJournal
+
+def removeRollbackContents(rbDir, names = None):
+    """
+    Removes the links named by names (all of them if names is None) from
+    the contents directory of the rollback in rbDir. Shared contents
+    which no other rollback links to are removed as well.
+    """
+    contentsDir = Rollback.contentsName % rbDir
+    sharedDir = Rollback.contentsName % os.path.dirname(rbDir)
+    if names is None:
+        try:
+            names = os.listdir(contentsDir)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+
+    for name in names:
+        try:
+            os.unlink(contentsDir + '/' + name)
+            sharedPath = sharedDir + '/' + name
+            if os.lstat(sharedPath).st_nlink == 1:
+                os.unlink(sharedPath)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
 class Rollback:
 
     reposName = "%s/repos.%d"
     localName = "%s/local.%d"
+    contentsName = "%s/contents"
+
+    def _getContentsStore(self):
+        path = self.contentsName % self.dir
+        if not os.path.isdir(path):
+            # rollbacks from older versions of conary keep all of their
+            # contents in the changesets
+            return None
+
+        return datastore.FlatDataStore(path)
 
     def add(self, opJournal, repos, local, rollbackScripts):
         reposName = self.reposName % (self.dir, self.count)
         localName = self.localName % (self.dir, self.count)
         countName = "%s/count" % self.dir
+        contentsDir = self.contentsName % self.dir
+        sharedDir = self.contentsName % os.path.dirname(self.dir)
 
         opJournal.create(reposName)
         opJournal.create(localName)
 
+        if not os.path.isdir(sharedDir):
+            os.mkdir(sharedDir, 0700)
+        if not os.path.isdir(contentsDir):
+            opJournal.mkdir(contentsDir)
+            os.mkdir(contentsDir, 0700)
+        store = RollbackContentsStore(contentsDir, sharedDir, opJournal)
+
         if rollbackScripts:
             # XXX We need to import rollbacks here to avoid a circular
             # import. We should refactor rollbacks.py to not import
@@ -86,8 +156,8 @@ class Rollback:
 
             rbs.save(self.dir)
 
-        repos.writeToFile(reposName, mode = 0600)
-        local.writeToFile(localName, mode = 0600)
+        repos.writeToFile(reposName, mode = 0600, contentsStore = store)
+        local.writeToFile(localName, mode = 0600, contentsStore = store)
 
         if self.count:
             self.count += 1
@@ -103,15 +173,18 @@ class Rollback:
         os.close(fd)
 
     def _getChangeSets(self, item, repos = True, local = True):
+        store = self._getContentsStore()
         if repos:
             reposCs = changeset.ChangeSetFromFile(
-                                        self.reposName % (self.dir, item))
+                                        self.reposName % (self.dir, item),
+                                        contentsStore = store)
         else:
             reposCs = False
 
         if local:
             localCs = changeset.ChangeSetFromFile(
-                                        self.localName % (self.dir, item))
+                                        self.localName % (self.dir, item),
+                                        contentsStore = store)
         else:
             localCs = False
 
@@ -139,7 +212,8 @@ class Rollback:
         return ret
 
     def getLocalChangeset(self, i):
-        local = changeset.ChangeSetFromFile(self.localName % (self.dir, i))
+        local = changeset.ChangeSetFromFile(self.localName % (self.dir, i),
+                                    contentsStore = self._getContentsStore())
         return local
 
     def isLocal(self):
@@ -156,14 +230,45 @@ class Rollback:
 
         return True
 
+    def _iterContentsRefs(self, store, item):
+        """
+        Yields the names of the links in the contents store which the
+        changesets for item reference.
+        """
+        for name in (self.reposName, self.localName):
+            csf = filecontainer.FileContainer(
+                    util.ExtendedFile(name % (self.dir, item), "r",
+                                      buffering = False))
+            entry = csf.getNextFile()
+            while entry is not None:
+                tagInfo, f = entry[1:]
+                if tagInfo[2:] == changeset.ChangedFileTypes.refr[4:]:
+                    sha1 = sha1helper.sha1FromString(f.read().split(' ')[0])
+                    yield os.path.basename(store.hashToPath(sha1))
+                entry = csf.getNextFile()
+
     def removeLast(self):
         if self.count == 0:
             return
+
+        # contents which only the removed changesets reference
+        unused = None
+        store = self._getContentsStore()
+        if store is not None:
+            unused = set(self._iterContentsRefs(store, self.count - 1))
+            for i in range(self.count - 1):
+                if not unused:
+                    break
+                unused.difference_update(self._iterContentsRefs(store, i))
+
         os.unlink(self.reposName % (self.dir, self.count - 1))
         os.unlink(self.localName % (self.dir, self.count - 1))
         self.count -= 1
         open("%s/count" % self.dir, "w").write("%d\n" % self.count)
 
+        if unused:
+            removeRollbackContents(self.dir, unused)
+
     @api.publicApi
     def iterChangeSets(self):
         """
@@ -320,8 +425,10 @@ class RollbackStack:
         rollback = int(name[2:])
         assert(rollback == self.first or rollback == self.last)
 
+        rbDir = self.dir + "/%d" % rollback
+        removeRollbackContents(rbDir)
         try:
-            shutil.rmtree(self.dir + "/%d" % rollback)
+            shutil.rmtree(rbDir)
         except OSError, e:
             if e.errno == 2:
                 pass
@@ -814,7 +921,7 @@ class UpdateJob:
                 fname = csFileName
             else:
                 fname = os.path.join(ccsdir, "%03d.ccs" % i)
-                cs.writeToFile(fname)
+                cs.writeToFile(fname, withIndex = True)
 
             csList.append((fname, int(includesFileContents)))
 
@@ -1920,7 +2027,8 @@ class Database(SqlDbRepository):
         fsJob.apply(journal, opJournal = opJournal,
                     justDatabase = commitFlags.justDatabase,
                     noScripts = commitFlags.noScripts,
-                    capsuleChangeSet = capsuleChangeSet)
+                    capsuleChangeSet = capsuleChangeSet,
+                    parallelRestore = commitFlags.parallelRestore)
 
         if (updateDatabase and not localChanges):
             for (name, version, flavor) in fsJob.getOldTroveList():
@@ -2517,8 +2625,10 @@ class Database(SqlDbRepository):
     # name looks like "r.%d"
     def removeRollback(self, name):
         rollback = int(name[2:])
+        rbDir = self.rollbackCache + "/%d" % rollback
+        removeRollbackContents(rbDir)
         try:
-            shutil.rmtree(self.rollbackCache + "/%d" % rollback)
+            shutil.rmtree(rbDir)
         except OSError, e:
             if e.errno == 2:
                 pass
@@ -2597,7 +2707,9 @@ class Database(SqlDbRepository):
             if num >= self.firstRollback:
                 break
 
-            shutil.rmtree(self.rollbackCache + '/' + "%d" % num)
+            rbDir = self.rollbackCache + '/' + "%d" % num
+            removeRollbackContents(rbDir)
+            shutil.rmtree(rbDir)
 
     def applyRollbackList(self, *args, **kwargs):
         try:
@@ -19,13 +19,16 @@
 Handles all updates to the file system; files should never get changed
 on the filesystem except by this module!
 """
+import collections
 import errno
 import itertools
 import os
+import Queue
 import select
 import stat
 import sys
 import tempfile
+import threading
 import weakref
 
 from conary import errors, files, trove, versions
@@ -83,6 +86,131 @@ class LastRestored(object):
         self.target = None
         self.type = None
 
+class _PendingRestore(object):
+
+    __slots__ = [ 'src', 'args', 'finish', 'done', 'result', 'error' ]
+
+    def __init__(self, src, args, finish):
+        # src keeps the file descriptor in args open
+        self.src = src
+        self.args = args
+        self.finish = finish
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class ParallelRestore(object):
+    """
+    Uncompresses file contents into temporary files next to their targets
+    using a pool of worker threads. Files in the same directory are always
+    handled by the same worker. The caller's finish functions (which
+    journal the file, rename it into place and set its permissions) are
+    run in this thread, strictly in the order the files were added, so
+    the job journal looks the same as it would for a serial restore.
+    """
+
+    maxPending = 128
+
+    def __init__(self, threads):
+        self.pending = collections.deque()
+        self.queues = []
+        self.threads = []
+        for i in range(threads):
+            queue = Queue.Queue()
+            thread = threading.Thread(target = self._worker, args = (queue,))
+            thread.setDaemon(True)
+            thread.start()
+            self.queues.append(queue)
+            self.threads.append(thread)
+
+    @staticmethod
+    def _worker(queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+
+            try:
+                item.result = util.sha1Uncompress(*item.args)
+            except:
+                item.error = util.SavedException()
+
+            item.done.set()
+
+    def canRestore(self, fileObj, contents):
+        """
+        Returns the (fd, start, size) of the compressed contents if they
+        can be restored by a worker, None otherwise.
+        """
+        if (not self.queues or not isinstance(fileObj, files.RegularFile)
+                or fileObj.flags.isConfig() or contents is None
+                or not contents.isCompressed()):
+            return None
+
+        src = contents.get()
+        if not hasattr(src, '_fdInfo'):
+            return None
+
+        fdInfo = src._fdInfo()
+        if fdInfo[0] is None:
+            return None
+
+        return src, fdInfo
+
+    def add(self, srcInfo, target, finish):
+        """
+        Queues the contents described by srcInfo (as returned by
+        canRestore()) to be uncompressed next to target. Once that is done,
+        finish((sha1, tmpName)) is called from flush().
+        """
+        src, fdInfo = srcInfo
+        path, name = os.path.split(target)
+        if not os.path.isdir(path):
+            util.mkdirChain(path)
+
+        item = _PendingRestore(src, fdInfo + (path, name), finish)
+        self.pending.append(item)
+        self.queues[hash(path) % len(self.queues)].put(item)
+
+        if len(self.pending) > self.maxPending:
+            self._finishOne()
+
+    def _finishOne(self):
+        item = self.pending.popleft()
+        item.done.wait()
+        if item.error:
+            item.error.throw()
+
+        try:
+            item.finish(item.result)
+        except:
+            util.removeIfExists(item.result[1])
+            raise
+
+    def flush(self):
+        """
+        Finishes all of the files which have been added, in order.
+        """
+        while self.pending:
+            self._finishOne()
+
+    def close(self):
+        """
+        Stops the workers. Temporary files for restores which were never
+        finished are removed.
+        """
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        for item in self.pending:
+            if item.result:
+                util.removeIfExists(item.result[1])
+        self.pending.clear()
+        self.queues = []
+        self.threads = []
+
 class FilesystemJob:
     """
     Represents a set of actions which need to be applied to the filesystem.
@@ -291,17 +419,18 @@ class FilesystemJob:
 
     @classmethod
     def restoreFile(cls, fileObj, contents, root, target, journal, opJournal,
-            isSourceTrove, keepTempfile = False):
+            isSourceTrove, keepTempfile = False, prepared = None):
         opJournal.backup(target)
         rootLen = len(root.rstrip('/'))
 
-        if fileObj.hasContents and contents and not \
+        if fileObj.hasContents and (contents or prepared) and not \
                                    fileObj.flags.isConfig():
             # config file sha1's are verified when they get inserted
             # into the config file cache
             tmpf = fileObj.restore(contents, root, target, journal=journal,
                             sha1 = fileObj.contents.sha1(),
-                            keepTempfile = keepTempfile)
+                            keepTempfile = keepTempfile,
+                            prepared = prepared)
         else:
             tmpf = fileObj.restore(contents, root, target, journal=journal,
                             nameLookup = (not isSourceTrove),
@@ -337,7 +466,8 @@ class FilesystemJob:
         return True
 
     def apply(self, journal = None, opJournal = None, justDatabase = False,
-              noScripts = False, capsuleChangeSet = None):
+              noScripts = False, capsuleChangeSet = None,
+              parallelRestore = False):
         assert(not self.errors)
         rootLen = len(self.root.rstrip('/'))
 
@@ -355,7 +485,6 @@ class FilesystemJob:
             os.rename(oldPath, newPath)
             log.debug(msg)
 
-        contents = None
         # restore in the same order files appear in the change set (which
         # is sorted by pathId,fileId combos
         # pathId, fileId, fileObj, targetPath, contentsOverride, msg
@@ -363,10 +492,7 @@ class FilesystemJob:
                             in self.restores.iteritems() ]
 
         restores.sort()
-        delayedRestores = []
-        ptrTargets = {}
         ptrTempFiles = {}
-        tmpPtrFiles = []
 
         # this sorting ensures /dir/file is removed before /dir
         paths = self.removes.keys()
@@ -421,6 +547,46 @@ class FilesystemJob:
                                  target, journal, opJournal,
                                  self.isSourceTrove)
 
+        if parallelRestore and util.sha1Uncompress is not None:
+            threads = os.sysconf('SC_NPROCESSORS_ONLN')
+        else:
+            threads = 0
+        restorer = ParallelRestore(threads)
+
+        try:
+            tmpPtrFiles = self._restoreFiles(restores, journal, opJournal,
+                                             restorer)
+        finally:
+            restorer.close()
+
+        # At this point, clean up all temporary ptr files
+        for fname in tmpPtrFiles:
+            os.unlink(fname)
+
+        for (target, contents, msg) in self.newFiles:
+            opJournal.backup(target)
+            try:
+                os.unlink(target)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            f = open(target, "w")
+            opJournal.create(target)
+            f.write(contents)
+            f.close()
+            self.callback.warning(msg)
+
+    def _restoreFiles(self, restores, journal, opJournal, restorer):
+        """
+        Restores everything in restores which isn't a directory. Regular
+        files may be handed to restorer (a ParallelRestore instance).
+        Returns the list of temporary files made for ptr targets.
+        """
+        contents = None
+        delayedRestores = []
+        ptrTargets = {}
+        tmpPtrFiles = []
+
         restoreIndex = 0
         j = 0
         lastRestored = LastRestored()
@@ -451,6 +617,7 @@ class FilesystemJob:
                                             pathId, fileId,
                                             compressed = True)
                 assert(contType == changeset.ChangedFileTypes.file)
+                restorer.flush()
                 tmpPtrFile = self.restoreFile(fileObj, contents, self.root,
                     target, journal, opJournal, self.isSourceTrove,
                     keepTempfile = True)
@@ -487,6 +654,7 @@ class FilesystemJob:
                         self.linkGroups.has_key(fileObj.linkGroup()):
                     # this creates links whose target we already know
                     # (because it was already present or already restored)
+                    restorer.flush()
                     if self._createLink(fileObj.linkGroup(), target, opJournal):
                         self.updatePtrs(ptrId, pathId, ptrTargets, override,
                                    contents, target)
@@ -543,6 +711,7 @@ class FilesystemJob:
                         # XXX we need to create this or conary thinks it
                         # was removed by the user if it doesn't already
                         # exist, when that's not what we mean here
+                        restorer.flush()
                         dirName = os.path.dirname(target)
                         util.mkdirChain(dirName)
                         name = os.path.basename(target)
@@ -558,9 +727,30 @@ class FilesystemJob:
             if override != "":
                 contents = override
 
-            tmpPtrFile = self.restoreFile(fileObj, contents, self.root,
-                        target, journal, opJournal, self.isSourceTrove,
-                        keepTempfile = isPtrTarget)
+            srcInfo = None
+            if not isPtrTarget:
+                srcInfo = restorer.canRestore(fileObj, contents)
+
+            if srcInfo:
+                # the file is renamed into place (and journaled) once a
+                # worker has uncompressed it; anything which needs the
+                # file to exist calls restorer.flush() first
+                def finish(prepared, fileObj = fileObj, target = target,
+                           msg = msg):
+                    self.restoreFile(fileObj, None, self.root, target,
+                                     journal, opJournal, self.isSourceTrove,
+                                     prepared = prepared)
+                    log.debug(msg, target)
+
+                restorer.add(srcInfo, target, finish)
+                tmpPtrFile = target
+            else:
+                restorer.flush()
+                tmpPtrFile = self.restoreFile(fileObj, contents, self.root,
+                            target, journal, opJournal, self.isSourceTrove,
+                            keepTempfile = isPtrTarget)
+                log.debug(msg, target)
+
             if tmpPtrFile != target:
                 self.updatePtrs(ptrId, pathId, ptrTargets, override, contents,
                                 tmpPtrFile)
@@ -570,12 +760,12 @@ class FilesystemJob:
             lastRestored.fileId = fileId
             lastRestored.target = tmpPtrFile
             lastRestored.type = changeset.ChangedFileTypes.file
-            log.debug(msg, target)
 
             if fileObj.hasContents and fileObj.linkGroup():
                 linkGroup = fileObj.linkGroup()
                 self.linkGroups[linkGroup] = target
 
+        restorer.flush()
         for (pathId, fileObj, target, msg, ptrId, fileId) in delayedRestores:
             # we wouldn't be here if the fileObj didn't have contents and
             # no override
@@ -608,23 +798,7 @@ class FilesystemJob:
                         isSourceTrove = self.isSourceTrove)
             log.debug(msg, target)
 
-        del delayedRestores
-        # At this point, clean up all temporary ptr files
-        for fname in tmpPtrFiles:
-            os.unlink(fname)
-
-        for (target, contents, msg) in self.newFiles:
-            opJournal.backup(target)
-            try:
-                os.unlink(target)
-            except OSError, e:
-                if e.errno != errno.ENOENT:
-                    raise
-            f = open(target, "w")
-            opJournal.create(target)
-            f.write(contents)
-            f.close()
-            self.callback.warning(msg)
+        return tmpPtrFiles
 
     def runPostTagScripts(self, tagSet = {}, tagScript = None):
         # this is run after the changes are in the database (but before
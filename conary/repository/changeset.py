@@ -30,6 +30,7 @@ except ImportError:
 from conary import files, rpmhelper, streams, trove, versions
 from conary.lib import base85, enum, log, patch, sha1helper, util, api
 from conary.lib import cpiostream
+from conary.lib import digestlib
 from conary.lib import fixeddifflib
 from conary.lib.ext import pack
 from conary.repository import filecontainer, filecontents, errors
@@ -180,6 +181,64 @@ class ChangeSetFileDict(dict, streams.InfoStream):
             self.thaw(data)
 
 
+class _FrozenTroveChangeSet(object):
+
+    """
+    A trove changeset which has already been frozen. These are only
+    useful for writing the changeset they are part of; see
+    ChangeSet.newTrove().
+    """
+
+    __slots__ = [ 'frz' ]
+
+    def __init__(self, frz):
+        self.frz = frz
+
+    def freeze(self):
+        return self.frz
+
+def _gzipContents(contObj):
+    # compresses exactly the way FileContainer.addFile() does, so the
+    # changeset is the same whether or not the contents were compressed
+    # ahead of time
+    out = util.BoundedStringIO()
+    gzFile = util.DeterministicGzipFile('', "wb", 6, out)
+    src = contObj.get()
+    util.copyfileobj(src, gzFile)
+    src.close()
+    gzFile.close()
+    return filecontents.FromFile(out, compressed = True)
+
+def _iterCompressedContents(contents, idList, jobs):
+    """
+    Yields (hash, contType, contents, compressed) for each hash in idList,
+    in order. When jobs is more than one, uncompressed contents which come
+    from the filesystem are gzipped by that many threads, a few files per
+    thread at a time, ahead of the caller writing them out.
+    """
+    window = max(jobs, 1) * 4
+    for start in xrange(0, len(idList), window):
+        chunk = idList[start:start + window]
+        needed = []
+        if jobs > 1:
+            needed = [ i for i, hash in enumerate(chunk)
+                       if not contents[hash][2] and
+                          isinstance(contents[hash][1],
+                                     filecontents.FromFilesystem) ]
+
+        done = {}
+        for idx, contObj in util.iterParallel(_gzipContents,
+                            [ (contents[chunk[i]][1],) for i in needed ],
+                            jobs):
+            done[needed[idx]] = contObj
+
+        for i, hash in enumerate(chunk):
+            contType, contObj, compressed = contents[hash]
+            if i in done:
+                yield hash, contType, done[i], True
+            else:
+                yield hash, contType, contObj, compressed
+
 class ChangeSet(streams.StreamSet):
 
     streamDict = {
@@ -193,6 +252,9 @@ class ChangeSet(streams.StreamSet):
            (LARGE, ChangeSetFileDict,        "files"           ),
     }
     ignoreUnknown = True
+    # threads used to compress file contents read from the filesystem
+    # while the changeset is written
+    compressionJobs = 1
 
     def _resetTroveLists(self):
         # XXX hack
@@ -226,20 +288,30 @@ class ChangeSet(streams.StreamSet):
                       "getPrimaryTroveList", DeprecationWarning)
         return self.primaryTroveList
 
-    def newTrove(self, csTrove):
+    def newTrove(self, csTrove, frozen = False):
+        """
+        Adds a trove changeset to this changeset. If frozen is set, only
+        the frozen form of the trove changeset is kept. That uses much
+        less memory for large changesets, but the trove changeset can't
+        be retrieved again; the change set can only be written out.
+        """
         old = csTrove.getOldVersion()
         new = csTrove.getNewVersion()
         assert(not old or min(old.timeStamps()) > 0)
         assert(min(new.timeStamps()) > 0)
 
-        self.newTroves[(csTrove.getName(), new,
-                        csTrove.getNewFlavor())] = csTrove
+        key = (csTrove.getName(), new, csTrove.getNewFlavor())
 
         if csTrove.isAbsolute():
             self.absolute = True
         if (old and old.onLocalLabel()) or new.onLocalLabel():
             self.local = 1
 
+        if frozen:
+            csTrove = _FrozenTroveChangeSet(csTrove.freeze())
+
+        self.newTroves[key] = csTrove
+
     def newPackage(self, csTrove):
         import warnings
         warnings.warn("newPackage is deprecated, use newTrove",
@@ -394,26 +466,28 @@ class ChangeSet(streams.StreamSet):
                 csf.addFile(hash, f, tag + contType[4:],
                             precompressed = compressed)
 
-        for hash in idList:
-            (contType, f, compressed) = contents[hash]
-            if contType != ChangedFileTypes.diff:
-                if withReferences and \
-                        isinstance(f, filecontents.CompressedFromDataStore):
-                    sha1 = sha1helper.sha1ToString(f.getSha1())
-                    realSize = os.stat(f.path()).st_size
-                    nameEntry = sha1 + ' ' + str(realSize)
-                    sizeCorrection += (realSize - len(nameEntry))
-                    if realSize >= 0x100000000:
-                        # add 4 bytes to store a 64-bit size
-                        sizeCorrection += 4
-                    csf.addFile(hash,
-                                filecontents.FromString(nameEntry,
-                                                        compressed = True),
-                                tag + ChangedFileTypes.refr[4:],
-                                precompressed = True)
-                else:
-                    csf.addFile(hash, f, tag + contType[4:],
-                                precompressed = compressed)
+        plainList = [ x for x in idList
+                      if contents[x][0] != ChangedFileTypes.diff ]
+        for (hash, contType, f, compressed) in \
+                _iterCompressedContents(contents, plainList,
+                                        self.compressionJobs):
+            if withReferences and \
+                    isinstance(f, filecontents.CompressedFromDataStore):
+                sha1 = sha1helper.sha1ToString(f.getSha1())
+                realSize = os.stat(f.path()).st_size
+                nameEntry = sha1 + ' ' + str(realSize)
+                sizeCorrection += (realSize - len(nameEntry))
+                if realSize >= 0x100000000:
+                    # add 4 bytes to store a 64-bit size
+                    sizeCorrection += 4
+                csf.addFile(hash,
+                            filecontents.FromString(nameEntry,
+                                                    compressed = True),
+                            tag + ChangedFileTypes.refr[4:],
+                            precompressed = True)
+            else:
+                csf.addFile(hash, f, tag + contType[4:],
+                            precompressed = compressed)
 
         return sizeCorrection
 
@@ -424,21 +498,40 @@ class ChangeSet(streams.StreamSet):
         return one + two
 
     def appendToFile(self, outFile, withReferences = False,
-                     versionOverride = None):
+                     versionOverride = None, withIndex = False,
+                     contentsStore = None):
         start = outFile.tell()
 
         csf = filecontainer.FileContainer(outFile,
                                           version = versionOverride,
-                                          append = True)
+                                          append = True,
+                                          index = withIndex)
+        if contentsStore is not None:
+            csf = _StoredContentsWriter(csf, contentsStore)
 
         str = self.freeze()
         csf.addFile("CONARYCHANGESET", filecontents.FromString(str), "")
         correction = self.writeAllContents(csf,
                                            withReferences = withReferences)
+        # the offsets in the index are only right if nothing gets expanded
+        # when the changeset is sent
+        if withIndex and not correction:
+            csf.writeIndex()
+
         return (outFile.tell() - start) + correction
 
     def writeToFile(self, outFileName, withReferences = False, mode = 0666,
-                    versionOverride = None):
+                    versionOverride = None, withIndex = False,
+                    contentsStore = None):
+        """
+        Writes this changeset to outFileName, returning the size of the
+        changeset. If withIndex is set, an offset index is added to the
+        end of the file so file contents can be read from the changeset
+        in any order without rescanning it. If contentsStore (a DataStore)
+        is given, regular file contents are added to it instead of the
+        changeset, which only references them; the store has to be passed
+        to ChangeSetFromFile to read the changeset back.
+        """
         # 0666 is right for mode because of umask
         try:
             outFileFd = os.open(outFileName,
@@ -447,7 +540,9 @@ class ChangeSet(streams.StreamSet):
             outFile = os.fdopen(outFileFd, "w+")
 
             size = self.appendToFile(outFile, withReferences = withReferences,
-                                     versionOverride = versionOverride)
+                                     versionOverride = versionOverride,
+                                     withIndex = withIndex,
+                                     contentsStore = contentsStore)
             outFile.close()
             return size
         except:
@@ -1397,10 +1492,48 @@ class ReadOnlyChangeSet(ChangeSet):
 
         return rc
 
+    def _getIndexedFile(self, pathId, key):
+        """
+        Finds file contents using the offset indexes of the file containers
+        for this changeset. Returns the (name, tagInfo, fileObj) tuple for
+        the contents, or None if they can't be found this way (either
+        because they aren't in the changeset or because some containers
+        can only be read sequentially).
+        """
+        if self.csfWrappers:
+            return None
+
+        for csf in self.fileContainers:
+            if not csf.hasIndex():
+                return None
+
+        for csf in self.fileContainers:
+            # we check for both the key and the pathId here for backwards
+            # compatibility reading old change set formats
+            for name in (key, pathId):
+                try:
+                    return csf.getFile(name)
+                except KeyError:
+                    pass
+
+        return None
+
     def getFileContents(self, pathId, fileId, compressed = False):
         name = None
         key = makeKey(pathId, fileId)
-        if self.configCache.has_key(pathId):
+        indexed = None
+        if not (self.configCache.has_key(pathId) or
+                self.configCache.has_key(key)):
+            indexed = self._getIndexedFile(pathId, key)
+
+        if indexed:
+            name, tagInfo, f = indexed
+            if not compressed:
+                f = gzip.GzipFile(None, "r", fileobj = f)
+
+            tag = 'cft-' + tagInfo.split()[1]
+            cont = filecontents.FromFile(f, compressed = compressed)
+        elif self.configCache.has_key(pathId):
             assert(not compressed)
             name = pathId
             (tag, contents, alreadyCompressed) = self.configCache[pathId]
@@ -1850,9 +1983,102 @@ Cannot apply a relative changeset to an incomplete trove.  Please upgrade conary
         self.fileQueue = []
 
 
+class _StoredContentsWriter(object):
+
+    """
+    Wraps a file container which is being written, moving regular
+    (non-config) file contents into a DataStore indexed by the sha1 of
+    the contents. The container gets a refr entry instead, so contents
+    which are already in the store are not written again.
+    """
+
+    def __init__(self, csf, store):
+        self.csf = csf
+        self.store = store
+
+    def __getattr__(self, name):
+        return getattr(self.csf, name)
+
+    # the contents are read twice (once to find the sha1), which only
+    # works if get() hands back the contents from the beginning each time
+    _rereadable = (filecontents.FromFile, filecontents.FromFilesystem,
+                   filecontents.FromString, filecontents.FromDataStore,
+                   filecontents.CompressedFromDataStore)
+
+    def addFile(self, name, contObj, tag, precompressed = False):
+        if (tag != '0 ' + ChangedFileTypes.file[4:] or
+                    not isinstance(contObj, self._rereadable)):
+            return self.csf.addFile(name, contObj, tag,
+                                    precompressed = precompressed)
+
+        src = contObj.get()
+        if precompressed:
+            src = gzip.GzipFile(None, "r", fileobj = src)
+
+        digest = digestlib.sha1()
+        buf = src.read(128 * 1024)
+        while buf:
+            digest.update(buf)
+            buf = src.read(128 * 1024)
+        sha1 = digest.digest()
+
+        if not self.store.hasFile(sha1):
+            self.store.addFile(contObj.get(), sha1,
+                               precompressed = precompressed)
+
+        realSize = os.stat(self.store.hashToPath(sha1)).st_size
+        nameEntry = sha1helper.sha1ToString(sha1) + ' ' + str(realSize)
+        return self.csf.addFile(name,
+                                filecontents.FromString(nameEntry,
+                                                        compressed = True),
+                                tag[:2] + ChangedFileTypes.refr[4:],
+                                precompressed = True)
+
+class _StoredContentsReader(object):
+
+    """
+    Wraps a file container written through _StoredContentsWriter,
+    returning the contents from the DataStore in place of the refr
+    entries.
+    """
+
+    def __init__(self, csf, store):
+        self.csf = csf
+        self.store = store
+
+    def __getattr__(self, name):
+        return getattr(self.csf, name)
+
+    def _resolve(self, entry):
+        if entry is None:
+            return None
+
+        name, tagInfo, f = entry
+        if tagInfo[2:] != ChangedFileTypes.refr[4:]:
+            return entry
+
+        sha1 = f.read().split(' ')[0]
+        f.seek(0)
+        path = self.store.hashToPath(sha1helper.sha1FromString(sha1))
+        contFile = util.ExtendedFile(path, "r", buffering = False)
+        size = os.fstat(contFile.fileno()).st_size
+        return (name, tagInfo[:2] + ChangedFileTypes.file[4:],
+                util.SeekableNestedFile(contFile, size, 0))
+
+    def getNextFile(self):
+        return self._resolve(self.csf.getNextFile())
+
+    def getFile(self, name):
+        return self._resolve(self.csf.getFile(name))
+
 class ChangeSetFromFile(ReadOnlyChangeSet):
     @api.publicApi
-    def __init__(self, fileName, skipValidate = 1):
+    def __init__(self, fileName, skipValidate = 1, contentsStore = None):
+        """
+        If contentsStore is given, it is a DataStore which holds the
+        contents referenced by the changeset (see
+        ChangeSet.writeToFile()).
+        """
         self.fileName = None
         try:
             if type(fileName) is str:
@@ -1875,6 +2101,9 @@ class ChangeSetFromFile(ReadOnlyChangeSet):
 
             (name, tagInfo, control) = csf.getNextFile()
             assert(name == "CONARYCHANGESET")
+
+            if contentsStore is not None:
+                csf = _StoredContentsReader(csf, contentsStore)
         except filecontainer.BadContainer:
             raise filecontainer.BadContainer(
                         "File %s is not a valid conary changeset." % fileName)
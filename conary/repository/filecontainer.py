@@ -68,6 +68,31 @@ leaves us with well over 63 bits of length.
 
 This code is careful not to depend on the file pointer at all for reading
 (via pread). The file pointer is used while creating file containers.
+
+Containers may optionally end with an offset index, which lets readers
+seek straight to an entry instead of scanning the container from the
+start. The index is stored as one last, ordinary file table entry named
+INDEX_NAME (so readers which don't know about it just see an extra file
+they never ask for). Its (uncompressed) data is::
+
+ - index entry 1
+ - index entry N
+ - offset of the file table entry holding the index (8 bytes)
+ - INDEX_MAGIC (4 bytes)
+
+where each index entry is::
+
+ - length of file name (2 bytes)
+ - length of arbitrary data (2 bytes)
+ - offset of file data (8 bytes)
+ - length of file data (8 bytes)
+ - file name
+ - arbitrary file table data
+
+All offsets are relative to the start of the container. The index is
+only used if the entry at the recorded offset is the index itself and
+ends at the end of the container; anything else (including an index
+copied into another container verbatim) is ignored.
 """
 
 import errno
@@ -94,6 +119,11 @@ READABLE_VERSIONS = [ FILE_CONTAINER_VERSION_FILEID_IDX,
 
 FILE_CONTAINER_VERSION_LATEST = max(READABLE_VERSIONS)
 
+# name, table data and trailing magic for the optional offset index
+INDEX_NAME = "CONARYINDEX"
+INDEX_TAG = "0 idx"
+INDEX_MAGIC = "\xEA\x3F\x49\x44"
+
 SEEK_SET = 0
 SEEK_CUR = 1
 SEEK_END = 2
@@ -117,6 +147,7 @@ class FileContainer:
 
         self.contentsStart = 8
         self.next = self.contentsStart
+        self.index = None
 
     def close(self):
         self.file = None
@@ -154,22 +185,127 @@ class FileContainer:
             self.file.seek(0, SEEK_END)
             self.file.write(struct.pack("!HH", len(fileName), len(tableData)))
 
-    def getNextFile(self):
-        assert(not self.mutable)
+        if self.indexEntries is not None:
+            dataOffset = (headerOffset - self.containerStart + 10 +
+                          len(fileName) + len(tableData))
+            self.indexEntries.append((fileName, tableData, dataOffset, size))
+
+    def writeIndex(self):
+        """
+        Append the offset index for all of the files added so far. Files
+        added after the index has been written are not indexed, and leave
+        the index unusable.
+        """
+        assert(self.mutable)
+        assert(self.indexEntries is not None)
+
+        l = []
+        for (name, tag, dataOffset, size) in self.indexEntries:
+            l.append(struct.pack("!HHQQ", len(name), len(tag), dataOffset,
+                                 size))
+            l.append(name)
+            l.append(tag)
+
+        headerOffset = self.file.tell() - self.containerStart
+        l.append(struct.pack("!Q", headerOffset))
+        l.append(INDEX_MAGIC)
+
+        self.indexEntries = None
+        self.addFile(INDEX_NAME,
+                     filecontents.FromString(''.join(l), compressed = True),
+                     INDEX_TAG, precompressed = True)
+
+    def _readIndex(self):
+        """
+        Returns a dict mapping file names to (tag, size, dataOffset) tuples
+        built from the offset index at the end of the container, or None if
+        the container doesn't have a (valid) index.
+        """
+        if self.size < self.contentsStart + 10 + len(INDEX_NAME) + 12:
+            return None
+
+        trailer = self.file.pread(12, self.size - 12)
+        if len(trailer) != 12 or trailer[8:] != INDEX_MAGIC:
+            return None
 
-        name, tag, size, dataOffset, nextOffset = self._nextFile()
+        headerOffset = struct.unpack("!Q", trailer[0:8])[0]
+        if headerOffset < self.contentsStart or headerOffset >= self.size:
+            return None
+
+        subMagic = self.file.pread(2, headerOffset)
+        if (len(subMagic) != 2 or
+                struct.unpack("!H", subMagic)[0] != SUBFILE_MAGIC):
+            return None
 
-        if name is None:
+        name, tag, size, dataOffset, nextOffset = self._nextFile(headerOffset)
+        if name != INDEX_NAME or nextOffset != self.size:
             return None
 
+        data = self.file.pread(size - 12, dataOffset)
+        if len(data) != size - 12:
+            raise BadContainer("file container is truncated")
+
+        index = {}
+        i = 0
+        while i < len(data):
+            nameLen, tagLen, entryOffset, entrySize = \
+                    struct.unpack("!HHQQ", data[i:i + 20])
+            i += 20
+            entryName = data[i:i + nameLen]
+            i += nameLen
+            entryTag = data[i:i + tagLen]
+            i += tagLen
+            index[entryName] = (entryTag, entrySize, entryOffset)
+
+        return index
+
+    def hasIndex(self):
+        """
+        Returns True if this container can look up files by name through
+        an offset index.
+        """
+        assert(not self.mutable)
+
+        if self.index is None:
+            self.index = self._readIndex() or False
+
+        return self.index is not False
+
+    def getFile(self, name):
+        """
+        Returns the (name, tag, fileObj) tuple for the file named name
+        using the offset index; this does not change the position used
+        by getNextFile(). KeyError is raised if the file isn't in the
+        container. Only valid if hasIndex() returns True.
+        """
+        assert(self.hasIndex())
+
+        tag, size, dataOffset = self.index[name]
         fcf = util.SeekableNestedFile(self.file, size, start = dataOffset)
 
-        self.next = nextOffset
+        return (name, tag, fcf)
+
+    def getNextFile(self, skipIndex = True):
+        assert(not self.mutable)
+
+        while True:
+            name, tag, size, dataOffset, nextOffset = self._nextFile()
+
+            if name is None:
+                return None
+
+            self.next = nextOffset
+
+            if not skipIndex or name != INDEX_NAME:
+                break
+
+        fcf = util.SeekableNestedFile(self.file, size, start = dataOffset)
 
         return (name, tag, fcf)
 
-    def _nextFile(self):
-        offset = self.next
+    def _nextFile(self, offset = None):
+        if offset is None:
+            offset = self.next
 
         nameLen = self.file.pread(10, offset)
         if not len(nameLen):
@@ -243,7 +379,9 @@ class FileContainer:
         if offset:
             offset = max(0, offset - 8)
 
-        next = self.getNextFile()
+        # the offset index is passed through as is so the size of the
+        # stream matches the size of the container
+        next = self.getNextFile(skipIndex = False)
         while next is not None:
             name, tag, subfile = next
             rawSize = subfile.size
@@ -269,7 +407,7 @@ class FileContainer:
                 yield footer[offset:]
             if offset:
                 offset = max(0, offset - len(footer))
-            next = self.getNextFile()
+            next = self.getNextFile(skipIndex = False)
 
     def reset(self):
         """
@@ -282,7 +420,7 @@ class FileContainer:
         if self.file:
             self.close()
 
-    def __init__(self, file, version = None, append = False):
+    def __init__(self, file, version = None, append = False, index = False):
         """
         Create a FileContainer object.
 
@@ -292,6 +430,8 @@ class FileContainer:
         is retained, so the caller may optionally close it.
         @param append: if True, creates a new filecontainer at the end
         of the passed flie object
+        @param index: if True, the offsets of the files added to a new
+        filecontainer are remembered so writeIndex() can store them
         """
 
         # make our own copy of this file which nobody can close underneath us
@@ -300,8 +440,14 @@ class FileContainer:
         if version is None:
             version = FILE_CONTAINER_VERSION_LATEST
 
+        self.indexEntries = None
         self.file.seek(0, SEEK_END)
-        if append or not self.file.tell():
+        self.size = self.file.tell()
+        if append or not self.size:
+            self.containerStart = self.size
+            if index:
+                self.indexEntries = []
+
             try:
                 self.file.write(FILE_CONTAINER_MAGIC)
                 self.file.write(struct.pack("!I", version))
@@ -20,6 +20,7 @@ import errno
 import gzip
 import itertools
 import os
+import threading
 import time
 import urllib
 import xml
@@ -65,6 +66,30 @@ from conary.repository.trovesource import TROVE_QUERY_ALL, TROVE_QUERY_PRESENT,
 # including / (which is normally considered "safe" by urllib.quote)
 quote = lambda s: urllib.quote(s, safe='')
 
+class _LockedCallback(object):
+    """
+    Serializes calls into a callback object which is shared by several
+    download threads.
+    """
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._callback, name)
+        if not callable(attr):
+            return attr
+
+        def locked(*args, **kwargs):
+            self._lock.acquire()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self._lock.release()
+
+        return locked
+
 class PartialResultsError(Exception):
 
     # this is expected to be handled by the caller!
@@ -400,6 +425,9 @@ class NetworkRepositoryClient(xmlshims.NetworkConvertors,
 
         self.cfg = cfg
         self.downloadRateLimit = cfg.downloadRateLimit
+        # downloads run in parallel (see downloadThreads), so they share a
+        # single limit
+        self.downloadLimiter = util.RateLimiter(cfg.downloadRateLimit)
         self.uploadRateLimit = cfg.uploadRateLimit
         self.c = ServerCache(cfg, pwPrompt)
         self.localRep = localRepository
@@ -1505,11 +1533,10 @@ class NetworkRepositoryClient(xmlshims.NetworkConvertors,
 
             return self.localRep.getTroves(troveList, pristine=True)
 
-        def _getCsFromRepos(target, cs, server, job, recurse,
-                            withFiles, withFileContents,
-                            excludeAutoSource, filesNeeded,
-                            chgSetList, removedList, changesetVersion,
-                            mirrorMode):
+        def _downloadCs(server, job, outFile, callback):
+            # appends the changesets the server has for job to outFile,
+            # returning where they start in the file, their sizes and the
+            # extra jobs and files the server wants us to handle
             if callback:
                 callback.requestingChangeSet()
             server.setAbortCheck(None)
@@ -1519,11 +1546,11 @@ class NetworkRepositoryClient(xmlshims.NetworkConvertors,
             serverVersion = server.getProtocolVersion()
 
             if mirrorMode and serverVersion >= 49:
-                if not changesetVersion:
-                    changesetVersion = \
-                        filecontainer.FILE_CONTAINER_VERSION_LATEST
+                csVersion = changesetVersion
+                if not csVersion:
+                    csVersion = filecontainer.FILE_CONTAINER_VERSION_LATEST
 
-                args += (changesetVersion, mirrorMode, )
+                args += (csVersion, mirrorMode, )
             elif changesetVersion and serverVersion > 47:
                 args += (changesetVersion, )
 
@@ -1541,7 +1568,8 @@ class NetworkRepositoryClient(xmlshims.NetworkConvertors,
                                 "Attempting to resume where it left off.")
                 try:
                     (sizes, extraTroveList, extraFileList, removedTroveList,
-                            extra,) = _getCsOnce(serverVersion, args, kwargs)
+                            extra,) = _getCsOnce(server, outFile, callback,
+                                                 serverVersion, args, kwargs)
                     break
                 except errors.TruncatedResponseError:
                     attempts -= 1
@@ -1557,27 +1585,55 @@ class NetworkRepositoryClient(xmlshims.NetworkConvertors,
                         attempts = max(1, self.cfg.downloadAttempts)
                     resume = keep
 
-            chgSetList += self.toJobList(extraTroveList)
-            filesNeeded.update(self.toFilesNeeded(extraFileList))
-            removedList += self.toJobList(removedTroveList)
+            return (start, sizes, extraTroveList, extraFileList,
+                    removedTroveList)
+
+        def _iterCsFromRepos(repoJobs):
+            # yields (csFile, start, sizes, extraTroveList, extraFileList,
+            # removedTroveList) for each (server, job) in repoJobs. When
+            # more than one server is involved the downloads run in
+            # parallel, each into its own file, and are returned in the
+            # order they finish
+            threads = min(len(repoJobs), self.cfg.downloadThreads)
+            if threads < 2:
+                for server, job in repoJobs:
+                    yield (outFile,) + _downloadCs(server, job, outFile,
+                                                   callback)
+                return
 
+            if callback:
+                threadCallback = _LockedCallback(callback)
+            else:
+                threadCallback = None
+
+            def _downloadToTmp(server, job):
+                (fd, path) = util.mkstemp(suffix = '.ccs')
+                csFile = util.ExtendedFile(path, "w+", buffering = False)
+                os.close(fd)
+                os.unlink(path)
+                return (csFile,) + _downloadCs(server, job, csFile,
+                                               threadCallback)
+
+            for idx, rc in util.iterParallel(_downloadToTmp, repoJobs,
+                                             threads):
+                yield rc
+
+        def _mergeCsFromFile(cs, csFile, start, sizes):
             for size in sizes:
-                f = util.SeekableNestedFile(outFile, size, start)
+                f = util.SeekableNestedFile(csFile, size, start)
                 try:
                     newCs = changeset.ChangeSetFromFile(f)
                 except IOError, err:
-                    assert False, 'IOError in changeset (%s); args = %r' % (
-                            str(err), args,)
+                    assert False, 'IOError in changeset (%s)' % str(err)
                 if not cs:
                     cs = newCs
                 else:
                     cs.merge(newCs)
                 start += size
 
-            return (cs, self.toJobList(extraTroveList),
-                    self.toFilesNeeded(extraFileList))
+            return cs
 
-        def _getCsOnce(serverVersion, args, kwargs):
+        def _getCsOnce(server, outFile, callback, serverVersion, args, kwargs):
             l = server.getChangeSet(*args, **kwargs)
             extra = {}
             if serverVersion >= 50:
@@ -1620,8 +1676,9 @@ class NetworkRepositoryClient(xmlshims.NetworkConvertors,
                 forceProxy = server.usedProxy()
                 headers = [('X-Conary-Servername', server._serverName)]
                 try:
-                    inF = transport.ConaryURLOpener(proxyMap=self.c.proxyMap
-                            ).open(url, forceProxy=forceProxy, headers=headers)
+                    inF = transport.ConaryURLOpener(proxyMap=self.c.proxyMap,
+                            caCerts=self.c.caCerts, persist=True).open(url,
+                                    forceProxy=forceProxy, headers=headers)
                 except transport.TransportError, e:
                     raise errors.RepositoryError(str(e))
 
@@ -1639,7 +1696,7 @@ class NetworkRepositoryClient(xmlshims.NetworkConvertors,
             # Start the total at resumeOffset so that progress callbacks
             # continue where they left off.
             copied = util.copyfileobj(inF, outFile, callback=copyCallback,
-                    abortCheck=abortCheck, rateLimit=self.downloadRateLimit,
+                    abortCheck=abortCheck, rateLimit=self.downloadLimiter,
                     total=resumeOffset)
             if copied is None:
                 raise errors.RepositoryError("Unknown error downloading changeset")
@@ -1710,30 +1767,35 @@ class NetworkRepositoryClient(xmlshims.NetworkConvertors,
             chgSetList = []
             removedList = []
 
-            for serverName, job in serverJobs.iteritems():
-                server = self.c[serverName]
-                args = (target, cs, server, job, recurse, withFiles,
-                        withFileContents, excludeAutoSource,
-                        filesNeeded, chgSetList, removedList)
-
-                try:
+            repoJobs = []
+            try:
+                for serverName, job in serverJobs.iteritems():
+                    server = self.c[serverName]
                     if server.__class__ == ServerProxy:
                         # this is a XML-RPC proxy for a remote repository
-                        rc = _getCsFromRepos(*(args + (changesetVersion,
-                                                       mirrorMode)))
-                    else:
-                        # assume we are a shim repository
-                        rc = _getCsFromShim(*args)
-                    cs, extraTroveList, extraFileList = rc
-                except Exception:
-                    if target and os.path.exists(target):
-                        os.unlink(target)
-                    elif os.path.exists(tmpName):
-                        os.unlink(tmpName)
-                    raise
-
-                chgSetList += extraTroveList
-                filesNeeded.update(extraFileList)
+                        repoJobs.append((server, job))
+                        continue
+
+                    # assume we are a shim repository
+                    args = (target, cs, server, job, recurse, withFiles,
+                            withFileContents, excludeAutoSource,
+                            filesNeeded, chgSetList, removedList)
+                    cs, extraTroveList, extraFileList = _getCsFromShim(*args)
+                    chgSetList += extraTroveList
+                    filesNeeded.update(extraFileList)
+
+                for (csFile, start, sizes, extraTroveList, extraFileList,
+                        removedTroveList) in _iterCsFromRepos(repoJobs):
+                    cs = _mergeCsFromFile(cs, csFile, start, sizes)
+                    chgSetList += self.toJobList(extraTroveList)
+                    filesNeeded.update(self.toFilesNeeded(extraFileList))
+                    removedList += self.toJobList(removedTroveList)
+            except Exception:
+                if target and os.path.exists(target):
+                    os.unlink(target)
+                elif os.path.exists(tmpName):
+                    os.unlink(tmpName)
+                raise
 
             if (ourJobList or filesNeeded) and not internalCs:
                 internalCs = changeset.ChangeSet()
@@ -2204,8 +2266,9 @@ class NetworkRepositoryClient(xmlshims.NetworkConvertors,
         # the same proxy on subsequent requests.
         forceProxy = self.c[server].usedProxy()
         headers = [('X-Conary-Servername', server)]
-        inF = transport.ConaryURLOpener(proxyMap = self.c.proxyMap).open(url,
-                forceProxy=forceProxy, headers=headers)
+        inF = transport.ConaryURLOpener(proxyMap = self.c.proxyMap,
+                caCerts = self.c.caCerts, persist = True).open(url,
+                        forceProxy=forceProxy, headers=headers)
 
         if callback:
             wrapper = callbacks.CallbackRateWrapper(
@@ -2221,7 +2284,7 @@ class NetworkRepositoryClient(xmlshims.NetworkConvertors,
         start = outF.tell()
 
         totalSize = util.copyfileobj(inF, outF,
-                                     rateLimit = self.downloadRateLimit,
+                                     rateLimit = self.downloadLimiter,
                                      callback = copyCallback)
         if totalSize == None:
             raise errors.RepositoryError("Unknown error downloading changeset")
@@ -2340,7 +2403,7 @@ class NetworkRepositoryClient(xmlshims.NetworkConvertors,
             os.close(fd)
             os.unlink(path)
 
-        for server, itemList in byServer.iteritems():
+        def _getFromServer(server, itemList, callback, outF):
             fileList = [ (self.fromFileId(x[1][0]),
                           self.fromVersion(x[1][1])) for x in itemList ]
             if callback:
@@ -2349,10 +2412,39 @@ class NetworkRepositoryClient(xmlshims.NetworkConvertors,
                 else:
                     callback.requestingFileContents()
 
-            fileObjList = self.getFileContentsObjects(server, fileList,
-                                                      callback, outF,
-                                                      compressed)
+            return self.getFileContentsObjects(server, fileList, callback,
+                                               outF, compressed)
+
+        def _getFromServerToTmp(server, itemList, callback):
+            (fd, path) = util.mkstemp(suffix = 'filecontents')
+            outF = util.ExtendedFile(path, "r+", buffering = False)
+            os.close(fd)
+            os.unlink(path)
+            return _getFromServer(server, itemList, callback, outF)
+
+        serverItems = byServer.items()
+        threads = min(len(serverItems), self.cfg.downloadThreads)
+        if threads > 1:
+            # fetch from the servers in parallel, each into its own file
+            for server, itemList in serverItems:
+                # connect from this thread; the server cache isn't
+                # thread safe
+                self.c[server]
+
+            if callback:
+                callback = _LockedCallback(callback)
+
+            results = util.iterParallel(_getFromServerToTmp,
+                    [ (server, itemList, callback)
+                      for server, itemList in serverItems ], threads)
+        else:
+            results = ( (idx, _getFromServer(server, itemList, callback,
+                                             outF))
+                        for idx, (server, itemList)
+                        in enumerate(serverItems) )
 
+        for idx, fileObjList in results:
+            itemList = serverItems[idx][1]
             for (i, item), fObj in itertools.izip(itemList, fileObjList):
                 contents[i] = fObj
 
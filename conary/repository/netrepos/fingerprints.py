@@ -21,8 +21,13 @@ from conary import trove
 from conary.lib import sha1helper
 from conary.server import schema
 
-def _troveFp(troveTup, sig, meta):
-    if not sig and not meta:
+def _troveFp(troveTup, sig, meta, removed = False):
+    if removed:
+        # removing a trove drops its signatures and metadata, which
+        # could leave it with the same fingerprint it had while it
+        # was present; changesets cached for it need to go stale
+        t = ("removed", ) + troveTup
+    elif not sig and not meta:
         # we don't have sig or metadata info; just use the trove tuple
         # itself
         t = troveTup
@@ -41,6 +46,38 @@ def _troveFp(troveTup, sig, meta):
 
     return sha1helper.sha1String("\0".join(t))
 
+def removedTroves(db, troveList):
+    """
+    Returns the set of indexes into troveList, a list of (name, version,
+    flavor) string tuples, for the troves which have been removed from
+    the repository.
+    """
+    if not troveList:
+        return set()
+
+    cu = db.cursor()
+    schema.resetTable(cu, "tmpNVF")
+
+    db.bulkload("tmpNVF", [ (idx, ) + tuple(x) for idx, x in
+                                enumerate(troveList) ],
+                     [ "idx", "name", "version", "flavor" ],
+                     start_transaction = False)
+    db.analyze("tmpNVF")
+
+    cu.execute("""SELECT tmpNVF.idx
+        FROM tmpNVF JOIN Items ON tmpNVF.name = Items.item
+        JOIN Versions ON (tmpNVF.version = Versions.version)
+        JOIN Flavors ON (tmpNVF.flavor = Flavors.flavor)
+        JOIN Instances ON
+            Items.itemId = Instances.itemId AND
+            Versions.versionId = Instances.versionId AND
+            Flavors.flavorId = Instances.flavorId
+        WHERE
+            Instances.troveType = ?
+    """, trove.TROVE_TYPE_REMOVED)
+
+    return set(x[0] for x in cu)
+
 def expandJobList(db, chgSetList, recurse):
     """
     For each job in the list, find the set of troves which are recursively
@@ -35,6 +35,10 @@ from conary.repository.repository import AbstractRepository
 from conary.repository.repository import ChangeSetJob
 from conary.repository.netrepos.repo_cfg import CfgContentStore
 
+# createChangeSet keeps at most this many frozen file streams around for
+# reuse by later jobs of the same request
+STREAM_CACHE_SIZE = 100000
+
 
 class FilesystemChangeSetJob(ChangeSetJob):
     def __init__(self, repos, cs, *args, **kw):
@@ -368,10 +372,14 @@ class FilesystemRepository(DataStoreRepository, AbstractRepository):
     def createChangeSet(self, origTroveList, recurse = True,
                         withFiles = True, withFileContents = True,
                         excludeAutoSource = False,
-                        mirrorMode = False, roleIds = None):
+                        mirrorMode = False, roleIds = None,
+                        writeOnly = False):
         """
         @param origTroveList: a list of
         C{(troveName, flavor, oldVersion, newVersion, absolute)} tuples.
+        @param writeOnly: the changesets returned are only going to be
+        written to a file. The trove changesets are kept frozen as they
+        are generated, which keeps memory use down for large groups.
 
         If C{oldVersion == None} and C{absolute == 0}, then the trove is
         assumed to be new for the purposes of the change set.
@@ -388,6 +396,10 @@ class FilesystemRepository(DataStoreRepository, AbstractRepository):
         removedTroveList = []
 
         dupFilter = set()
+        # frozen file streams fetched so far, indexed by fileId; jobs often
+        # share files (old and new versions of troves, or several flavors
+        # of the same trove), so this is kept for the whole request
+        streamCache = {}
 
         # make a copy to remove things from
         troveList = origTroveList[:]
@@ -470,7 +482,7 @@ class FilesystemRepository(DataStoreRepository, AbstractRepository):
                     else:
                         troveWrapper.append(refJob, True)
 
-            cs.newTrove(troveChgSet)
+            cs.newTrove(troveChgSet, frozen = writeOnly)
 
             if job in origTroveList and job[2][0] is not None:
                 # add the primary w/ timestamps on the version
@@ -511,38 +523,81 @@ class FilesystemRepository(DataStoreRepository, AbstractRepository):
             localFilesNeeded.sort()
             localFilesNeeded.reverse()
 
+            # fetch the streams this diff needs which didn't come along
+            # with the troves, and which we haven't seen yet, in one query
+            neededIds = set()
+            for (pathId, oldFileId, oldFileVersion, newFileId, \
+                 newFileVersion) in localFilesNeeded:
+                if oldFileVersion and oldFileId not in streams:
+                    neededIds.add(oldFileId)
+                if newFileId not in streams:
+                    neededIds.add(newFileId)
+            missingIds = neededIds.difference(streamCache)
+            if len(streamCache) + len(missingIds) > STREAM_CACHE_SIZE:
+                # start over; everything this diff needs gets fetched again
+                streamCache.clear()
+                missingIds = neededIds
+            streamCache.update(self.troveStore.getFileStreams(missingIds))
+
             ptrTable = {}
             for (pathId, oldFileId, oldFileVersion, newFileId, \
                  newFileVersion) in localFilesNeeded:
-                oldFile = None
-                if oldFileVersion:
-                    oldFile = files.ThawFile(streams[oldFileId], pathId)
+                try:
+                    newStream = streams.get(newFileId) or \
+                                    streamCache[newFileId]
+                    if oldFileVersion:
+                        oldStream = streams.get(oldFileId) or \
+                                    streamCache[oldFileId]
+                except KeyError, e:
+                    raise errors.FileStreamMissing(e.args[0])
 
+                oldFile = None
+                newFile = None
                 oldCont = None
                 newCont = None
 
-                newFile = files.ThawFile(streams[newFileId], pathId)
-
                 # Skip identical fileids when mirroring, but always use
                 # absolute file changes if there is any difference. See note
                 # below.
                 forceAbsolute = (mirrorMode and oldFileId
                         and oldFileId != newFileId)
-                if forceAbsolute:
-                    (filecs, contentsHash) = changeset.fileChangeSet(pathId,
-                                                                     None,
-                                                                     newFile)
+
+                newFlags = None
+                if not oldFileVersion:
+                    newFlags = files.frozenFileFlags(newStream)
+
+                if newFlags is not None:
+                    # the absolute change for a new file is the frozen
+                    # stream itself, so there's no need to thaw it
+                    filecs = newStream
+                    if files.frozenFileHasContents(newStream):
+                        newSha1 = files.frozenFileContentInfo(newStream).sha1()
+                    else:
+                        newSha1 = None
+                    contentsHash = newSha1
                 else:
-                    (filecs, contentsHash) = changeset.fileChangeSet(pathId,
-                                                                     oldFile,
-                                                                     newFile)
+                    if oldFileVersion:
+                        oldFile = files.ThawFile(oldStream, pathId)
+                    newFile = files.ThawFile(newStream, pathId)
+                    newFlags = newFile.flags
+                    newSha1 = None
+                    if newFile.hasContents:
+                        newSha1 = newFile.contents.sha1()
+
+                    if forceAbsolute:
+                        (filecs, contentsHash) = changeset.fileChangeSet(
+                                                        pathId, None, newFile)
+                    else:
+                        (filecs, contentsHash) = changeset.fileChangeSet(
+                                                        pathId, oldFile,
+                                                        newFile)
 
                 cs.addFile(oldFileId, newFileId, filecs)
 
                 if (not withFileContents
-                    or (excludeAutoSource and newFile.flags.isAutoSource())
-                    or (newFile.flags.isEncapsulatedContent()
-                        and not newFile.flags.isCapsuleOverride())):
+                    or (excludeAutoSource and newFlags.isAutoSource())
+                    or (newFlags.isEncapsulatedContent()
+                        and not newFlags.isCapsuleOverride())):
                     continue
 
                 # this test catches files which have changed from not
@@ -553,16 +608,22 @@ class FilesystemRepository(DataStoreRepository, AbstractRepository):
                 # fileid changed, even if the SHA-1 did not.
                 # cf CNY-1570, CNY-1699, CNY-2210
                 if (contentsHash
-                        or (oldFile and newFile.flags.isConfig()
+                        or (oldFile and newFlags.isConfig()
                             and not oldFile.flags.isConfig())
-                        or (forceAbsolute and newFile.hasContents)
+                        or (forceAbsolute and newSha1 is not None)
                         ):
                     if oldFileVersion and oldFile.hasContents:
                         oldCont = self.getFileContents(
                             [ (oldFileId, oldFileVersion, oldFile) ])[0]
 
-                    newCont = self.getFileContents(
-                            [ (newFileId, newFileVersion, newFile) ])[0]
+                    # the same check getFileContents() makes; the new
+                    # file may not have been thawed, so look up its
+                    # contents by sha1 directly
+                    if newFileVersion.getHost() not in self.serverNameList:
+                        raise errors.RepositoryMismatch(self.serverNameList,
+                                newFileVersion.getHost())
+                    newCont = filecontents.FromDataStore(self.contentsStore,
+                                                         newSha1)
 
                     (contType, cont) = changeset.fileContentsDiff(oldFile,
                                                 oldCont, newFile, newCont,
@@ -573,9 +634,9 @@ class FilesystemRepository(DataStoreRepository, AbstractRepository):
                     # which would completely hose the sort order we use. this
                     # could be relaxed someday to let them be ptr's to other
                     # config files
-                    if not newFile.flags.isConfig() and \
+                    if not newFlags.isConfig() and \
                                 contType == changeset.ChangedFileTypes.file:
-                        contentsHash = newFile.contents.sha1()
+                        contentsHash = newSha1
                         ptr = ptrTable.get(contentsHash, None)
                         if ptr is not None:
                             contType = changeset.ChangedFileTypes.ptr
@@ -583,11 +644,10 @@ class FilesystemRepository(DataStoreRepository, AbstractRepository):
                         else:
                             ptrTable[contentsHash] = pathId + newFileId
 
-                    if not newFile.flags.isConfig() and \
+                    if not newFlags.isConfig() and \
                                 contType == changeset.ChangedFileTypes.file:
                         cont = filecontents.CompressedFromDataStore(
-                                              self.contentsStore,
-                                              newFile.contents.sha1())
+                                              self.contentsStore, newSha1)
                         compressed = True
                     else:
                         compressed = False
@@ -599,7 +659,7 @@ class FilesystemRepository(DataStoreRepository, AbstractRepository):
                         compressed = False
 
                     cs.addFileContents(pathId, newFileId, contType, cont,
-                                       newFile.flags.isConfig(),
+                                       newFlags.isConfig(),
                                        compressed = compressed)
 
             if not recurse:
@@ -618,7 +678,7 @@ class _TroveListWrapper:
         t = self.trvIterator.next()
 
         if t is not None:
-            if self.withFiles:
+            if self.withFileStreams:
                 t, streams = t
             else:
                 streams = {}
@@ -648,6 +708,13 @@ class _TroveListWrapper:
             # self.new for new jobs we need
 
             troveList = []
+            # Jobs which create a trove need the streams for all of its
+            # files, and those are cheapest to get along with the troves.
+            # Relative jobs usually change only a few files, so if there
+            # aren't any jobs which need everything, createChangeSet
+            # fetches just the streams each diff needs instead.
+            self.withFileStreams = self.withFiles and \
+                    [ x for x in self.new if x[0][1][0] is None ] != []
             for job, recursed in self.new:
                 # do we need the old trove?
                 if job[1][0] is not None:
@@ -661,7 +728,7 @@ class _TroveListWrapper:
             # reset self.new for later additions
             self.trvIterator = self.troveStore.iterTroves(
                         troveList, withFiles = self.withFiles,
-                        withFileStreams = self.withFiles,
+                        withFileStreams = self.withFileStreams,
                         permCheckFilter = self._permCheck,
                         hidden=True,
                         )
@@ -716,4 +783,5 @@ class _TroveListWrapper:
         self.l = []
         self.troveStore = troveStore
         self.withFiles = withFiles
+        self.withFileStreams = False
         self.roleIds = roleIds
@@ -20,14 +20,23 @@ import re
 from conary.dbstore import idtable
 
 _cacheRe = {}
-def checkTrove(pattern, trove):
-    global _cacheRe
-    if pattern == 'ALL' or trove is None:
-        return True
+def compileTrovePattern(pattern):
+    """
+    Returns the compiled regular expression for an ACL trove pattern, or
+    None for the 'ALL' pattern which matches every trove.
+    """
+    if pattern == 'ALL':
+        return None
     regExp = _cacheRe.get(pattern, None)
     if regExp is None:
         regExp = _cacheRe[pattern] = re.compile(pattern + '$')
-    if regExp.match(trove):
+    return regExp
+
+def checkTrove(pattern, trove):
+    if trove is None:
+        return True
+    regExp = compileTrovePattern(pattern)
+    if regExp is None or regExp.match(trove):
         return True
     return False
 
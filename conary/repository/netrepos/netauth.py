@@ -18,9 +18,11 @@
 import itertools
 import logging
 import os
+import threading
 import time
 import urllib, urllib2
 import xml
+from collections import OrderedDict
 
 from conary import conarycfg, versions
 from conary.deps import deps
@@ -311,7 +313,60 @@ class EntitlementAuthorization:
 
         return roleIds
 
+class AuthCache(object):
+    """
+    Bounded map whose entries expire after a timeout. Once maxSize entries
+    are stored the oldest ones are dropped first. Instances are shared by
+    every thread in the process.
+    """
+
+    def __init__(self, maxSize = 4096):
+        self.maxSize = maxSize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default = None):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, timeout = entry
+            if time.time() >= timeout:
+                del self._entries[key]
+                return default
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, timeout):
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + timeout)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last = False)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
 class NetworkAuthorization:
+
+    # (roleCache, aclCache) for each repository database, keyed by its
+    # driver and connection string. The role cache holds the roles granted
+    # to an auth token and the ACL cache holds the ACLs of each role; both
+    # are only used when a cacheTimeout is given. They are kept here rather
+    # than in the instance because servers create a new instance for every
+    # request.
+    _caches = {}
+    _cachesLock = threading.Lock()
+
     def __init__(self, db, serverNameList, cacheTimeout = None, log = None,
             passwordURL=None, entCheckURL=None, geoIpFiles=None):
         """
@@ -327,6 +382,7 @@ class NetworkAuthorization:
         """
         self.serverNameList = serverNameList
         self.db = db
+        self.cacheTimeout = cacheTimeout
         self.log = log or tracelog.getLog(None)
         self.userAuth = UserAuthorization(
             self.db, passwordURL, cacheTimeout = cacheTimeout)
@@ -335,6 +391,20 @@ class NetworkAuthorization:
         self.items = items.Items(db)
         self.ri = accessmap.RoleInstances(db)
         self.geoIp = geoip.GeoIPLookup(geoIpFiles or [])
+        self.roleCache, self.aclCache = self._getCaches(db)
+
+    @classmethod
+    def _getCaches(cls, db):
+        key = (db.driver, db.database)
+        cls._cachesLock.acquire()
+        try:
+            caches = cls._caches.get(key)
+            if caches is None:
+                caches = cls._caches[key] = (AuthCache(),
+                                             AuthCache(maxSize = 1024))
+            return caches
+        finally:
+            cls._cachesLock.release()
 
     def getAuthRoles(self, cu, authToken, allowAnonymous = True):
         """Return the set of roleIds that the caller has access to.
@@ -346,6 +416,51 @@ class NetworkAuthorization:
         if not isinstance(authToken, AuthToken):
             authToken = AuthToken(*authToken)
 
+        cacheEntry = self._roleCacheEntry(authToken, allowAnonymous)
+        roleSet = None
+        if cacheEntry is not None:
+            roleSet = self.roleCache.get(cacheEntry)
+        if roleSet is None:
+            roleSet = self._getAuthRoles(cu, authToken, allowAnonymous)
+            if cacheEntry is not None:
+                self.roleCache.set(cacheEntry, roleSet, self.cacheTimeout)
+
+        for roleId, acceptFlags in roleSet.items():
+            if authToken.flags is None:
+                authToken.flags = self._getFlags(authToken)
+            if not authToken.flags.satisfies(acceptFlags):
+                log.error("Rejecting client %s access to role %s due to "
+                        "acceptFlags mismatch:  has: %s  required: %s",
+                        authToken.remote_ip, roleId,
+                        authToken.flags, acceptFlags)
+                raise errors.InsufficientPermission
+
+        return set(roleSet)
+
+    def _roleCacheEntry(self, authToken, allowAnonymous):
+        """
+        Returns the key used to cache the roles granted to authToken, or
+        None if the result may not be cached.
+        """
+        if not self.cacheTimeout:
+            return None
+        if (isinstance(authToken.user, ValidUser)
+                or authToken.password is ValidPasswordToken):
+            return None
+        # externally validated credentials have their own caching rules
+        # (and transient failures must not be remembered)
+        if self.userAuth.pwCheckUrl:
+            return None
+        if authToken.entitlements and self.entitlementAuth.entCheckUrl:
+            return None
+
+        entitlements = [ tuple(x) for x in authToken.entitlements ]
+        return sha1helper.sha1String("\0".join([
+            repr(tuple(self.serverNameList)), repr(authToken.user),
+            repr(str(authToken.password)), repr(entitlements),
+            repr(authToken.remote_ip), repr(bool(allowAnonymous)) ]))
+
+    def _getAuthRoles(self, cu, authToken, allowAnonymous):
         roleSet = self.userAuth.getAuthorizedRoles(
             cu, authToken.user, authToken.password,
             allowAnonymous=allowAnonymous,
@@ -369,17 +484,73 @@ class NetworkAuthorization:
         if timedOut:
             raise errors.EntitlementTimeout(timedOut)
 
-        for roleId, acceptFlags in roleSet.items():
-            if authToken.flags is None:
-                authToken.flags = self._getFlags(authToken)
-            if not authToken.flags.satisfies(acceptFlags):
-                log.error("Rejecting client %s access to role %s due to "
-                        "acceptFlags mismatch:  has: %s  required: %s",
-                        authToken.remote_ip, roleId,
-                        authToken.flags, acceptFlags)
-                raise errors.InsufficientPermission
+        return roleSet
 
-        return set(roleSet)
+    def _getRoleAcls(self, cu, roleIds):
+        """
+        Returns a list of (label, trovePattern, canWrite, canRemove) tuples
+        for the ACLs of the given roles. The label is None for ACLs which
+        apply to every label, and trovePattern is the compiled regular
+        expression for the ACL (None if it matches all troves).
+        """
+        scope = tuple(self.serverNameList)
+        acls = []
+        missing = []
+        for roleId in roleIds:
+            roleAcls = None
+            if self.cacheTimeout:
+                roleAcls = self.aclCache.get((scope, roleId))
+            if roleAcls is None:
+                missing.append(roleId)
+            else:
+                acls.extend(roleAcls)
+
+        if not missing:
+            return acls
+
+        cu.execute("""
+        SELECT Permissions.userGroupId, Permissions.labelId, Labels.label,
+               Items.item, Permissions.canWrite, Permissions.canRemove
+        FROM Permissions
+        JOIN Items USING (itemId)
+        JOIN Labels ON Permissions.labelId = Labels.labelId
+        WHERE Permissions.userGroupId IN (%s)""" %
+                   ",".join("%d" % x for x in missing))
+        roleAcls = dict((x, []) for x in missing)
+        for roleId, labelId, label, item, canWrite, canRemove in cu:
+            if labelId == 0:
+                label = None
+            roleAcls[roleId].append((label, items.compileTrovePattern(item),
+                                     bool(canWrite), bool(canRemove)))
+
+        for roleId, aclList in roleAcls.iteritems():
+            if self.cacheTimeout:
+                self.aclCache.set((scope, roleId), aclList, self.cacheTimeout)
+            acls.extend(aclList)
+
+        return acls
+
+    @staticmethod
+    def _aclMatches(acl, label, trove, write, remove):
+        aclLabel, pattern, canWrite, canRemove = acl
+        if write and not canWrite:
+            return False
+        if remove and not canRemove:
+            return False
+        if label is not None and aclLabel is not None and aclLabel != label:
+            return False
+        return trove is None or pattern is None or bool(pattern.match(trove))
+
+    def _commit(self):
+        self.db.commit()
+        self._invalidateCaches()
+
+    def _invalidateCaches(self):
+        # changes made by other processes are only seen once the cached
+        # entries time out
+        self.roleCache.clear()
+        self.aclCache.clear()
+        self.userAuth.pwCache.clear()
 
     def _getFlags(self, authToken):
         flags = deps.Flavor()
@@ -468,29 +639,16 @@ class NetworkAuthorization:
             return retlist
         if not len(groupIds):
             return retlist
-        # build the query statement for permissions check
-        stmt = """
-        select Items.item
-        from Permissions join Items using (itemId)
-        """
-        where = ["Permissions.canWrite=1"]
-        where.append("Permissions.userGroupId IN (%s)" %
-                     ",".join("%d" % x for x in groupIds))
-        if len(checkDict):
-            where.append("""(
-            Permissions.labelId = 0 OR
-            Permissions.labelId in (select labelId from Labels where label=?)
-            )""")
-        stmt += "WHERE " + " AND ".join(where)
+        acls = [ x for x in self._getRoleAcls(cu, groupIds) if x[2] ]
         # we need to test for each label separately in case we have
         # mutiple troves living of multiple lables with different
         # permission settings
-        for label in checkDict.iterkeys():
-            cu.execute(stmt, label)
-            patterns = [ x[0] for x in cu ]
-            for i in checkDict[label]:
-                for pattern in patterns:
-                    if self.checkTrove(pattern, troveList[i]):
+        for label, troveIdxs in checkDict.iteritems():
+            labelAcls = [ x for x in acls
+                          if self._aclMatches(x, label, None, True, False) ]
+            for i in troveIdxs:
+                for acl in labelAcls:
+                    if self._aclMatches(acl, None, troveList[i], True, False):
                         retlist[i] = True
                         break
         return retlist
@@ -565,39 +723,13 @@ class NetworkAuthorization:
             # no more checks to do -- the authentication information is valid
             return True
 
-        stmt = """
-        select Items.item
-        from Permissions join items using (itemId)
-        """
-        params = []
-        where = []
-        if len(groupIds):
-            where.append("Permissions.userGroupId IN (%s)" %
-                     ",".join("%d" % x for x in groupIds))
         if label:
-            where.append("""
-            (
-            Permissions.labelId = 0 OR
-            Permissions.labelId in
-                ( select labelId from Labels where Labels.label = ? )
-            )
-            """)
-            params.append(label.asString())
-
-        if write:
-            where.append("Permissions.canWrite=1")
-
-        if remove:
-            where.append("Permissions.canRemove=1")
-
-        if where:
-            stmt += "WHERE " + " AND ".join(where)
-
-        self.log(4, stmt, params)
-        cu.execute(stmt, params)
+            label = label.asString()
+        else:
+            label = None
 
-        for (pattern,) in cu:
-            if self.checkTrove(pattern, trove):
+        for acl in self._getRoleAcls(cu, groupIds):
+            if self._aclMatches(acl, label, trove, write, remove):
                 return True
 
         return False
@@ -645,7 +777,7 @@ class NetworkAuthorization:
             raise errors.PermissionAlreadyExists, "labelId: '%s', itemId: '%s'" %(
                 labelId, itemId)
         self.ri.addPermissionId(permissionId, roleId)
-        self.db.commit()
+        self._commit()
 
     def editAcl(self, role, oldTroveId, oldLabelId, troveId, labelId,
                 write = False, canRemove = False):
@@ -683,7 +815,7 @@ class NetworkAuthorization:
             self.ri.updatePermissionId(permissionId, roleId)
         else: # just set the new canWrite flag
             self.ri.updateCanWrite(permissionId, roleId)
-        self.db.commit()
+        self._commit()
 
     def deleteAcl(self, role, label, item):
         self.log(3, role, label, item)
@@ -713,7 +845,7 @@ class NetworkAuthorization:
             self.ri.deletePermissionId(permissionId, roleId)
             cu.execute("delete from Permissions where permissionId = ?",
                        permissionId)
-        self.db.commit()
+        self._commit()
 
     def addUser(self, user, password):
         self.log(3, user)
@@ -748,7 +880,7 @@ class NetworkAuthorization:
         cu = self.db.transaction()
         cu.execute("UPDATE userGroups SET admin=? WHERE userGroup=?",
                    (int(bool(admin)), role))
-        self.db.commit()
+        self._commit()
 
     def setUserRoles(self, userName, roleList):
         cu = self.db.cursor()
@@ -756,14 +888,14 @@ class NetworkAuthorization:
         cu.execute("""DELETE FROM userGroupMembers WHERE userId=?""", userId)
         for role in roleList:
             self.addRoleMember(role, userName, commit = False)
-        self.db.commit()
+        self._commit()
 
     def setMirror(self, role, canMirror):
         self.log(3, role, canMirror)
         cu = self.db.transaction()
         cu.execute("UPDATE userGroups SET canMirror=? WHERE userGroup=?",
                    (int(bool(canMirror)), role))
-        self.db.commit()
+        self._commit()
 
     def _checkValidName(self, name):
         for letter in name:
@@ -780,7 +912,7 @@ class NetworkAuthorization:
             self.db.rollback()
             raise
         else:
-            self.db.commit()
+            self._commit()
         return uid
 
     def deleteUserByName(self, user, deleteRole=True):
@@ -817,7 +949,7 @@ class NetworkAuthorization:
                 except errors.RoleNotFound:
                     pass
         self.userAuth.deleteUser(cu, user)
-        self.db.commit()
+        self._commit()
 
     def changePassword(self, user, newPassword):
         self.log(3, user)
@@ -828,7 +960,7 @@ class NetworkAuthorization:
 
         cu = self.db.cursor()
         self.userAuth.changePassword(cu, user, salt, m.hexdigest())
-        self.db.commit()
+        self._commit()
 
     def getRoles(self, user):
         cu = self.db.cursor()
@@ -915,7 +1047,7 @@ class NetworkAuthorization:
             self.db.rollback()
             raise errors.RoleAlreadyExists, "role: %s" % role
         self._checkDuplicates(cu, role)
-        self.db.commit()
+        self._commit()
         return ugid
 
     def renameRole(self, oldRole, newRole):
@@ -929,7 +1061,7 @@ class NetworkAuthorization:
             self.db.rollback()
             raise errors.RoleAlreadyExists("role: %s" % newRole)
         self._checkDuplicates(cu, newRole)
-        self.db.commit()
+        self._commit()
         return True
 
     def updateRoleMembers(self, role, members):
@@ -942,7 +1074,7 @@ class NetworkAuthorization:
         #now add the new members
         for userName in members:
             self.addRoleMember(role, userName, commit=False)
-        self.db.commit()
+        self._commit()
 
     def addRoleMember(self, role, userName, commit = True):
         cu = self.db.cursor()
@@ -955,7 +1087,7 @@ class NetworkAuthorization:
                         VALUES (?, ?)""", roleId, userId)
 
         if commit:
-            self.db.commit()
+            self._commit()
 
     def deleteRole(self, role, commit = True):
         self.deleteRoleById(self._getRoleIdByName(role), commit)
@@ -976,7 +1108,7 @@ class NetworkAuthorization:
         #another group.
         cu.execute("DELETE FROM UserGroups WHERE userGroupId=?", roleId)
         if commit:
-            self.db.commit()
+            self._commit()
 
     def getItemList(self):
         cu = self.db.cursor()
@@ -1050,7 +1182,7 @@ class NetworkAuthorization:
                    entClassId)
         cu.execute("DELETE FROM EntitlementGroups WHERE entGroupId=?",
                    entClassId)
-        self.db.commit()
+        self._commit()
 
     def addEntitlementKey(self, authToken, entClass, entKey):
         cu = self.db.cursor()
@@ -1076,7 +1208,7 @@ class NetworkAuthorization:
         cu.execute("INSERT INTO Entitlements (entGroupId, entitlement) VALUES (?, ?)",
                    (entClassId, entKey))
 
-        self.db.commit()
+        self._commit()
 
     def deleteEntitlementKey(self, authToken, entClass, entKey):
         cu = self.db.cursor()
@@ -1099,7 +1231,7 @@ class NetworkAuthorization:
         cu.execute("DELETE FROM Entitlements WHERE entGroupId=? AND "
                    "entitlement=?", (entClassId, entKey))
 
-        self.db.commit()
+        self._commit()
 
     def addEntitlementClass(self, authToken, entClass, role):
         """
@@ -1124,7 +1256,7 @@ class NetworkAuthorization:
         entClassId = cu.lastrowid
         cu.execute("INSERT INTO EntitlementAccessMap (entGroupId, userGroupId) "
                    "VALUES (?, ?)", entClassId, roleId)
-        self.db.commit()
+        self._commit()
 
     def getEntitlementClassOwner(self, authToken, entClass):
         """
@@ -1170,7 +1302,7 @@ class NetworkAuthorization:
         cu.execute("INSERT INTO EntitlementOwners (entGroupId, ownerGroupId) "
                    "VALUES (?, ?)",
                    (entClassId, roleId))
-        self.db.commit()
+        self._commit()
 
     def deleteEntitlementClassOwner(self, authToken, role, entClass):
         if not self.authCheck(authToken, admin = True):
@@ -1181,7 +1313,7 @@ class NetworkAuthorization:
         cu.execute("DELETE FROM EntitlementOwners WHERE "
                    "entGroupId=? AND ownerGroupId=?",
                    entClassId, roleId)
-        self.db.commit()
+        self._commit()
 
     def iterEntitlementKeys(self, authToken, entClass):
         # validate the password
@@ -1283,7 +1415,7 @@ class NetworkAuthorization:
                               (entGroupId, userGroupId) VALUES (?, ?)""",
                            entClassMap[entClass], roleMap[role])
 
-        self.db.commit()
+        self._commit()
 
     def getRoleFilters(self, roles):
         cu = self.db.cursor()
@@ -1307,7 +1439,7 @@ class NetworkAuthorization:
             args.append(role)
             cu.execute("""UPDATE UserGroups SET accept_flags = ?,
                     filter_flags = ? WHERE userGroup = ?""", args)
-        self.db.commit()
+        self._commit()
 
 
 class PasswordCheckParser(dict):
@@ -32,7 +32,7 @@ from conary.deps import deps
 from conary.lib import log, tracelog, sha1helper, util
 from conary.lib.cfg import ConfigFile
 from conary.lib.cfgtypes import (CfgInt, CfgString, CfgPath, CfgBool, CfgList,
-        CfgLineList)
+        CfgLineList, CfgBytes)
 from conary.repository import changeset, errors, xmlshims
 from conary.repository.netrepos import fsrepos, instances, trovestore
 from conary.repository.netrepos import accessmap, deptable, fingerprints
@@ -767,49 +767,47 @@ class NetworkRepositoryServer(xmlshims.NetworkConvertors):
     def _setupFlavorFilter(self, cu, flavorSet):
         self.log(3, flavorSet)
         schema.resetTable(cu, 'tmpFlavorMap')
+        rows = []
         for i, flavor in enumerate(flavorSet.iterkeys()):
             flavorId = i + 1
             flavorSet[flavor] = flavorId
             if flavor is '':
                 # empty flavor yields a dummy dep on a null flag
-                cu.execute("""INSERT INTO tmpFlavorMap
-                (flavorId, base, sense, depClass, flag)
-                VALUES(?, 'use', ?, ?, NULL)""",(
-                    flavorId, deps.FLAG_SENSE_REQUIRED, deps.DEP_CLASS_USE),
-                           start_transaction = False)
+                rows.append((flavorId, 'use', deps.FLAG_SENSE_REQUIRED,
+                             deps.DEP_CLASS_USE, None))
                 continue
             for depClass in self.toFlavor(flavor).getDepClasses().itervalues():
                 for dep in depClass.getDeps():
-                    cu.execute("""INSERT INTO tmpFlavorMap
-                    (flavorId, base, sense, depClass) VALUES (?, ?, ?, ?)""", (
-                        flavorId, dep.name, deps.FLAG_SENSE_REQUIRED, depClass.tag),
-                               start_transaction = False)
+                    rows.append((flavorId, dep.name, deps.FLAG_SENSE_REQUIRED,
+                                 depClass.tag, None))
                     for (flag, sense) in dep.flags.iteritems():
-                        cu.execute("""INSERT INTO tmpFlavorMap
-                        (flavorId, base, sense, depClass, flag)
-                        VALUES (?, ?, ?, ?, ?)""", (
-                            flavorId, dep.name, sense, depClass.tag, flag),
-                                   start_transaction = False)
+                        rows.append((flavorId, dep.name, sense, depClass.tag,
+                                     flag))
+        self.db.bulkload("tmpFlavorMap", rows,
+                         ["flavorId", "base", "sense", "depClass", "flag"],
+                         start_transaction=False)
         self.db.analyze("tmpFlavorMap")
 
     def _setupTroveFilter(self, cu, troveSpecs, flavorIndices):
         self.log(3, troveSpecs, flavorIndices)
         schema.resetTable(cu, 'tmpGTVL')
+        rows = []
         for troveName, versionDict in troveSpecs.iteritems():
             if type(versionDict) is list:
                 versionDict = dict.fromkeys(versionDict, [ None ])
 
             for versionSpec, flavorList in versionDict.iteritems():
                 if flavorList is None:
-                    cu.execute("INSERT INTO tmpGTVL VALUES (?, ?, NULL)",
-                               cu.encode(troveName), cu.encode(versionSpec),
-                               start_transaction = False)
+                    rows.append((cu.encode(troveName), cu.encode(versionSpec),
+                                 None))
                 else:
                     for flavorSpec in flavorList:
                         flavorId = flavorIndices.get(flavorSpec, None)
-                        cu.execute("INSERT INTO tmpGTVL VALUES (?, ?, ?)",
-                                cu.encode(troveName), cu.encode(versionSpec),
-                                flavorId, start_transaction=False)
+                        rows.append((cu.encode(troveName),
+                                     cu.encode(versionSpec), flavorId))
+        self.db.bulkload("tmpGTVL", rows,
+                         ["item", "versionSpec", "flavorId"],
+                         start_transaction=False)
         self.db.analyze("tmpGTVL")
 
     def _latestType(self, queryType):
@@ -820,71 +818,43 @@ class NetworkRepositoryServer(xmlshims.NetworkConvertors):
     _GTL_VERSION_TYPE_VERSION = 2
     _GTL_VERSION_TYPE_BRANCH = 3
 
-    def _getTroveList(self, authToken, clientVersion, troveSpecs,
-                      versionType = _GTL_VERSION_TYPE_NONE,
-                      latestFilter = _GET_TROVE_ALL_VERSIONS,
-                      flavorFilter = _GET_TROVE_ALL_FLAVORS,
-                      withFlavors = False,
-                      troveTypes = TROVE_QUERY_PRESENT):
-        self.log(3, versionType, latestFilter, flavorFilter)
-        cu = self.db.cursor()
-        singleVersionSpec = None
-        dropTroveTable = False
-
-        assert(versionType == self._GTL_VERSION_TYPE_NONE or
-               versionType == self._GTL_VERSION_TYPE_BRANCH or
-               versionType == self._GTL_VERSION_TYPE_VERSION or
-               versionType == self._GTL_VERSION_TYPE_LABEL)
+    _GTL_TROVE_ALL = 0
+    _GTL_TROVE_SPECS = 1
+    _GTL_TROVE_NAMES = 2
 
-        # permission check first
-        roleIds = self.auth.getAuthRoles(cu, authToken)
-        if not roleIds:
-            return {}
-
-        flavorIndices = {}
-        if troveSpecs:
-            # populate flavorIndices with all of the flavor lookups we
-            # need; a flavor of 0 (numeric) means "None"
-            for versionDict in troveSpecs.itervalues():
-                for flavorList in versionDict.itervalues():
-                    if flavorList is not None:
-                        flavorIndices.update({}.fromkeys(flavorList))
-            if flavorIndices.has_key(0):
-                del flavorIndices[0]
-        if flavorIndices:
-            self._setupFlavorFilter(cu, flavorIndices)
+    # SQL statements built by _getTroveListQuery(), keyed by query shape
+    _gtlQueryCache = {}
 
+    def _getTroveListQuery(self, *shape):
+        """
+        Returns the SQL statement for a _getTroveList() lookup of the given
+        shape. The statement text only depends on the shape, so it is built
+        once per process and the database sees identical statements (and
+        can reuse their plans) for every call of that shape.
+        """
+        query = self._gtlQueryCache.get(shape)
+        if query is None:
+            query = self._buildTroveListQuery(*shape)
+            self._gtlQueryCache[shape] = query
+        return query
+
+    def _buildTroveListQuery(self, versionType, troveFilter, singleVersionSpec,
+                             roleCount, latest, troveTypes, flavorCount,
+                             withFlavors):
         coreQdict = {}
         coreQdict["localFlavor"] = "0"
-        if not troveSpecs or (len(troveSpecs) == 1 and
-                                 troveSpecs.has_key(None) and
-                                 len(troveSpecs[None]) == 1 and
-                                 troveSpecs[None].has_key(None)):
-            # None or { None:None} case
+        if troveFilter == self._GTL_TROVE_ALL:
             coreQdict["trove"] = "Items"
-            assert(versionType == self._GTL_VERSION_TYPE_NONE)
-        elif len(troveSpecs) == 1 and None in troveSpecs:
-            if len(troveSpecs[None]) == 1:
-                # no trove names, and a single version spec (multiple ones
-                # are disallowed)
-                coreQdict["trove"] = "Items"
-                singleVersionSpec = troveSpecs[None].keys()[0]
-            else:
-                self._setupTroveFilter(cu, troveSpecs, flavorIndices)
-                coreQdict["trove"] = "Items CROSS JOIN tmpGTVL"
-                coreQdict["localFlavor"] = "tmpGTVL.flavorId"
+        elif troveFilter == self._GTL_TROVE_SPECS:
+            coreQdict["trove"] = "Items CROSS JOIN tmpGTVL"
+            coreQdict["localFlavor"] = "tmpGTVL.flavorId"
         else:
-            dropTroveTable = True
-            self._setupTroveFilter(cu, troveSpecs, flavorIndices)
+            assert(troveFilter == self._GTL_TROVE_NAMES)
             coreQdict["trove"] = "tmpGTVL JOIN Items USING (item)"
             coreQdict["localFlavor"] = "tmpGTVL.flavorId"
 
-        # FIXME: the '%s' in the next lines are wreaking havoc through
-        # cached execution plans
-        argDict = {}
         if singleVersionSpec:
             spec = ":spec"
-            argDict["spec"] = singleVersionSpec
         else:
             spec = "tmpGTVL.versionSpec"
         if versionType == self._GTL_VERSION_TYPE_LABEL:
@@ -912,10 +882,10 @@ class NetworkRepositoryServer(xmlshims.NetworkConvertors):
         where = []
         where.append(
             "ugi.userGroupId IN (%s)" % (
-            ", ".join("%d" % x for x in roleIds),))
+            ", ".join(":role%d" % x for x in range(roleCount)),))
         # "leaves" == Latest ; "all" == Instances
         coreQdict["latest"] = ""
-        if latestFilter != self._GET_TROVE_ALL_VERSIONS:
+        if latest:
             coreQdict["latest"] = """JOIN LatestCache ON
             LatestCache.itemId = Nodes.itemId AND
             LatestCache.versionId = Nodes.versionId AND
@@ -923,15 +893,12 @@ class NetworkRepositoryServer(xmlshims.NetworkConvertors):
             LatestCache.flavorId = Instances.flavorId AND
             LatestCache.userGroupId = ugi.userGroupId AND
             LatestCache.latestType = :ltype"""
-            argDict["ltype"] = self._latestType(troveTypes)
         elif troveTypes != TROVE_QUERY_ALL:
             if troveTypes == TROVE_QUERY_PRESENT:
                 s = "!= :ttype"
-                argDict["ttype"] = trove.TROVE_TYPE_REMOVED
             else:
                 assert(troveTypes == TROVE_QUERY_NORMAL)
                 s = "= :ttype"
-                argDict["ttype"] = trove.TROVE_TYPE_NORMAL
             where.append("Instances.isPresent = %d " % (
                 instances.INSTANCE_PRESENT_NORMAL,))
             where.append("Instances.troveType %s" % (s,))
@@ -959,15 +926,14 @@ class NetworkRepositoryServer(xmlshims.NetworkConvertors):
         # build the outer query around the coreQuery
         mainQdict = {}
 
-        if flavorIndices:
-            assert(withFlavors)
+        if flavorCount:
             extraJoin = localGroup = ""
             localFlavor = "0"
-            if len(flavorIndices) > 1:
+            if flavorCount > 1:
                 # if there is only one flavor we don't need to join based on
                 # the tmpGTVL.flavorId (which is good, since it may not exist)
                 extraJoin = "tmpFlavorMap.flavorId = gtlTmp.localFlavorId AND"
-            if dropTroveTable:
+            if troveFilter == self._GTL_TROVE_NAMES:
                 localFlavor = "gtlTmp.localFlavorId"
                 localGroup = ", " + localFlavor
 
@@ -997,7 +963,6 @@ class NetworkRepositoryServer(xmlshims.NetworkConvertors):
                     "group" : localGroup}
             mainQdict["score"] = "tmpQ.flavorScore"
         else:
-            assert(flavorFilter == self._GET_TROVE_ALL_FLAVORS)
             mainQdict["core"] = coreQuery
             mainQdict["score"] = "NULL"
 
@@ -1028,6 +993,86 @@ class NetworkRepositoryServer(xmlshims.NetworkConvertors):
         %(joinFlavor)s
         ORDER BY I.item, N.finalTimestamp
         """ % mainQdict
+        return fullQuery
+
+    def _getTroveList(self, authToken, clientVersion, troveSpecs,
+                      versionType = _GTL_VERSION_TYPE_NONE,
+                      latestFilter = _GET_TROVE_ALL_VERSIONS,
+                      flavorFilter = _GET_TROVE_ALL_FLAVORS,
+                      withFlavors = False,
+                      troveTypes = TROVE_QUERY_PRESENT):
+        self.log(3, versionType, latestFilter, flavorFilter)
+        cu = self.db.cursor()
+        singleVersionSpec = None
+
+        assert(versionType == self._GTL_VERSION_TYPE_NONE or
+               versionType == self._GTL_VERSION_TYPE_BRANCH or
+               versionType == self._GTL_VERSION_TYPE_VERSION or
+               versionType == self._GTL_VERSION_TYPE_LABEL)
+
+        # permission check first
+        roleIds = self.auth.getAuthRoles(cu, authToken)
+        if not roleIds:
+            return {}
+
+        flavorIndices = {}
+        if troveSpecs:
+            # populate flavorIndices with all of the flavor lookups we
+            # need; a flavor of 0 (numeric) means "None"
+            for versionDict in troveSpecs.itervalues():
+                for flavorList in versionDict.itervalues():
+                    if flavorList is not None:
+                        flavorIndices.update({}.fromkeys(flavorList))
+            if flavorIndices.has_key(0):
+                del flavorIndices[0]
+        if flavorIndices:
+            self._setupFlavorFilter(cu, flavorIndices)
+
+        if not troveSpecs or (len(troveSpecs) == 1 and
+                                 troveSpecs.has_key(None) and
+                                 len(troveSpecs[None]) == 1 and
+                                 troveSpecs[None].has_key(None)):
+            # None or { None:None} case
+            troveFilter = self._GTL_TROVE_ALL
+            assert(versionType == self._GTL_VERSION_TYPE_NONE)
+        elif len(troveSpecs) == 1 and None in troveSpecs:
+            if len(troveSpecs[None]) == 1:
+                # no trove names, and a single version spec (multiple ones
+                # are disallowed)
+                troveFilter = self._GTL_TROVE_ALL
+                singleVersionSpec = troveSpecs[None].keys()[0]
+            else:
+                self._setupTroveFilter(cu, troveSpecs, flavorIndices)
+                troveFilter = self._GTL_TROVE_SPECS
+        else:
+            self._setupTroveFilter(cu, troveSpecs, flavorIndices)
+            troveFilter = self._GTL_TROVE_NAMES
+
+        if flavorIndices:
+            assert(withFlavors)
+        else:
+            assert(flavorFilter == self._GET_TROVE_ALL_FLAVORS)
+
+        # everything which varies between calls of the same shape is
+        # passed as a bind parameter
+        argDict = {}
+        if singleVersionSpec:
+            argDict["spec"] = singleVersionSpec
+        for i, roleId in enumerate(sorted(roleIds)):
+            argDict["role%d" % i] = roleId
+        latest = (latestFilter != self._GET_TROVE_ALL_VERSIONS)
+        if latest:
+            argDict["ltype"] = self._latestType(troveTypes)
+        elif troveTypes == TROVE_QUERY_PRESENT:
+            argDict["ttype"] = trove.TROVE_TYPE_REMOVED
+        elif troveTypes == TROVE_QUERY_NORMAL:
+            argDict["ttype"] = trove.TROVE_TYPE_NORMAL
+
+        fullQuery = self._getTroveListQuery(versionType, troveFilter,
+                                            bool(singleVersionSpec),
+                                            len(roleIds), latest, troveTypes,
+                                            min(len(flavorIndices), 2),
+                                            withFlavors)
 
         self.log(4, "execute query", fullQuery, argDict)
         cu.execute(fullQuery, argDict)
@@ -1541,23 +1586,45 @@ class NetworkRepositoryServer(xmlshims.NetworkConvertors):
         def oneChangeSet(destFile, jobs, **kwargs):
             # dedup jobs here; duplicates confuse the createChangeSet
             # iterator.
-            jobDict = dict.fromkeys(jobs)
-            jobOrder = jobDict.keys()
-            for result in self.repos.createChangeSet(jobOrder, **kwargs):
-                job = jobOrder.pop(0)
-                jobDict[job] = result
-
+            jobOrder = []
+            seen = set()
+            for job in jobs:
+                if job not in seen:
+                    seen.add(job)
+                    jobOrder.append(job)
+
+            # each changeset is written out as soon as it has been
+            # generated, so only one of them is in memory at a time.
+            # duplicate jobs get a copy of what was already written
+            csIter = self.repos.createChangeSet(jobOrder, writeOnly = True,
+                                                **kwargs)
+            written = {}
             rc = []
             for job in jobs:
-                cs, trovesNeeded, filesNeeded, removedTroves = jobDict[job]
                 start = destFile.tell()
-                size = cs.appendToFile(destFile, withReferences = True)
 
-                rc.append((str(size), self.fromJobList(trovesNeeded),
-                                  self.fromFilesNeeded(filesNeeded),
-                                  self.fromJobList(removedTroves),
-                                  str(destFile.tell() - start)))
+                if job in written:
+                    oldStart, oldEnd, info = written[job]
+                    util.copyfileobj(
+                        util.SeekableNestedFile(destFile, oldEnd - oldStart,
+                                                oldStart), destFile)
+                else:
+                    cs, trovesNeeded, filesNeeded, removedTroves = \
+                                                            csIter.next()
+                    size = cs.appendToFile(destFile, withReferences = True)
+                    del cs
+
+                    info = (str(size), self.fromJobList(trovesNeeded),
+                            self.fromFilesNeeded(filesNeeded),
+                            self.fromJobList(removedTroves),
+                            str(destFile.tell() - start))
 
+                written[job] = (start, destFile.tell(), info)
+                rc.append(info)
+
+            # let the generator finish up its queries
+            for result in csIter:
+                assert(0)
 
             return rc
 
@@ -1648,16 +1715,21 @@ class NetworkRepositoryServer(xmlshims.NetworkConvertors):
         pureMetaList = self.getTroveInfo(authToken, SERVER_VERSIONS[-1],
                                         trove._TROVEINFO_TAG_METADATA,
                                         [ x for x in sigItems if x ])
+        pureRemovedSet = fingerprints.removedTroves(self.db,
+                                        [ x for x in sigItems if x ])
         sigList = []
         metaList = []
+        removedList = []
         sigCount = 0
         for item in sigItems:
             if not item:
                 sigList.append(None)
                 metaList.append(None)
+                removedList.append(False)
             else:
                 sigList.append(pureSigList[sigCount])
                 metaList.append(pureMetaList[sigCount])
+                removedList.append(sigCount in pureRemovedSet)
                 sigCount += 1
 
         # 0 is a version number for this signature block; changing this will
@@ -1685,7 +1757,8 @@ class NetworkRepositoryServer(xmlshims.NetworkConvertors):
 
                 fp = fingerprints._troveFp(sigItems[sigCount],
                                         sigList[sigCount],
-                                        metaList[sigCount])
+                                        metaList[sigCount],
+                                        removed = removedList[sigCount])
                 sigCount += 1
 
                 fpList.append(fp)
@@ -3433,6 +3506,7 @@ class ServerConfig(ConfigFile):
     memCacheTimeout         = (CfgInt, -1)
     memCachePrefix          = CfgString
     changesetCacheDir       = CfgPath
+    changesetCacheLimit     = (CfgBytes('M'), 0)
     changesetCacheLogFile   = CfgPath
     commitAction            = CfgString
     contentsDir             = CfgContentStore
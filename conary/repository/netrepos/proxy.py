@@ -16,14 +16,16 @@
 
 import cPickle
 import errno
+import fcntl
 import itertools
 import os
+import re
 import resource
 import struct
 import tempfile
 import time
 
-from conary import constants, conarycfg, trove
+from conary import constants, conarycfg, dbstore, trove
 from conary.lib import digestlib, sha1helper, tracelog, urlparse, util
 from conary.lib.http import http_error
 from conary.lib.http import request as req_mod
@@ -1040,7 +1042,9 @@ class BaseCachingChangesetFilter(ChangesetFilter):
             util.mkdirChain(cfg.changesetCacheDir)
             csCache = ChangesetCache(
                     datastore.ShallowDataStore(cfg.changesetCacheDir),
-                    cfg.changesetCacheLogFile)
+                    cfg.changesetCacheLogFile,
+                    sizeLimit=cfg.changesetCacheLimit,
+                    pokeCounter=self.pokeCounter)
         else:
             csCache = None
         ChangesetFilter.__init__(self, cfg, basicUrl, csCache)
@@ -1192,6 +1196,9 @@ class FileCachingChangesetFilter(BaseCachingChangesetFilter):
         BaseCachingChangesetFilter.__init__(self, cfg, basicUrl)
         util.mkdirChain(cfg.proxyContentsDir)
         self.contents = datastore.DataStore(cfg.proxyContentsDir)
+        # Use only 1/4 our file descriptor limit for locks
+        limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        self.maxLocks = limit / 4
 
     def getFileContents(self, caller, authToken, clientVersion, fileList,
                         authCheckOnly = False):
@@ -1201,38 +1208,57 @@ class FileCachingChangesetFilter(BaseCachingChangesetFilter):
 
         hasFiles = []
         neededFiles = []
+        locks = []
 
-        for encFileId, encVersion in fileList:
-            fileId = sha1helper.sha1ToString(self.toFileId(encFileId))
-            if self.contents.hasFile(fileId + '-c'):
+        # Lock the missing files in fileId order, like the changeset cache
+        # does with fingerprints, so only one process fetches each of them
+        # and concurrent requests can't deadlock
+        orderedFiles = sorted(
+            (sha1helper.sha1ToString(self.toFileId(encFileId)), encFileId,
+                encVersion)
+            for encFileId, encVersion in fileList)
+
+        try:
+            for fileId, encFileId, encVersion in orderedFiles:
                 path = self.contents.hashToPath(fileId + '-c')
-                pathfd = None
-                try:
-                    try:
-                        # touch the file; we don't want it to be removed
-                        # by a cleanup job when we need it
-                        pathfd = os.open(path, os.O_RDONLY)
-                        hasFiles.append((encFileId, encVersion))
-                        continue
-                    except OSError:
-                        pass
-                finally:
-                    if pathfd: os.close(pathfd)
-
-            neededFiles.append((encFileId, encVersion))
-
-        # make sure this user has permissions for these file contents. an
-        # exception will get raised if we don't have sufficient permissions
-        if hasFiles:
-            caller.getFileContents(clientVersion, hasFiles, True)
-
-        if neededFiles:
-            # now get the contents we don't have cached
-            (url, sizes) = caller.getFileContents(
-                    clientVersion, neededFiles, False)
-            url = self._localUrl(url)
-            self._saveFileContents(neededFiles, url, sizes,
-                    forceProxy=caller._lastProxy)
+                if len(locks) < self.maxLocks:
+                    self.contents.makeDir(path)
+                    lockfile = util.LockedFile(path)
+                    # this blocks while another process is fetching the file
+                    fileObj = lockfile.open()
+                else:
+                    lockfile = None
+                    fileObj = util.fopenIfExists(path, "r")
+
+                if fileObj is not None:
+                    # opening the file touches it; we don't want it to be
+                    # removed by a cleanup job when we need it
+                    fileObj.close()
+                    hasFiles.append((encFileId, encVersion))
+                    continue
+
+                if lockfile is not None:
+                    locks.append(lockfile)
+                neededFiles.append((encFileId, encVersion))
+
+            # make sure this user has permissions for these file contents. an
+            # exception will get raised if we don't have sufficient
+            # permissions
+            if hasFiles:
+                caller.getFileContents(clientVersion, hasFiles, True)
+
+            if neededFiles:
+                # now get the contents we don't have cached
+                (url, sizes) = caller.getFileContents(
+                        clientVersion, neededFiles, False)
+                url = self._localUrl(url)
+                self._saveFileContents(neededFiles, url, sizes,
+                        forceProxy=caller._lastProxy)
+        finally:
+            # Anyone waiting on these now finds the file, or takes the lock
+            # and fetches it if we failed to
+            for lockfile in locks:
+                lockfile.unlock()
 
         url, sizes = self._saveFileContentsChangeset(clientVersion, fileList)
         return url, sizes
@@ -1427,14 +1453,32 @@ class ProxyRepositoryServer(Memcache, FileCachingChangesetFilter):
 class ChangesetCache(object):
 
     CACHE_VERSION = 1
+    INDEX_NAME = 'cache-index.db'
+    # Entries used this recently are never evicted; the client still has to
+    # come back for the changeset URL we handed out
+    EVICT_GRACE = 300
+    # A hit only records the use of an entry in the index if this process
+    # hasn't done so in the last TOUCH_INTERVAL seconds, so hits on popular
+    # changesets don't all queue up for the index write lock. This has to
+    # stay well below EVICT_GRACE.
+    TOUCH_INTERVAL = 60
 
     # Provides a place to cache changeset; uses a directory for them
-    # all indexed by fingerprint
+    # all indexed by fingerprint. If sizeLimit is set, the size and last use
+    # of every entry is kept in a small sqlite index next to the cache so
+    # the least recently used changesets can be evicted without walking the
+    # tree.
 
-    def __init__(self, dataStore, logPath=None):
+    def __init__(self, dataStore, logPath=None, sizeLimit=None,
+            pokeCounter=None):
         self.dataStore = dataStore
         self.logPath = logPath
+        self.sizeLimit = sizeLimit
+        self.pokeCounter = pokeCounter
         self.locksMap = {}
+        self.db = None
+        self.touched = set()
+        self.touchedSince = 0
         # Use only 1/4 our file descriptor limit for locks
         limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
         self.maxLocks = limit / 4
@@ -1471,15 +1515,23 @@ class ChangesetCache(object):
         self.locksMap.pop(csPath, None)
 
         self._log('WRITE', key, size=sizeLimit)
+        size = os.stat(csPath).st_size
+        self._count('cscache_write_bytes', size)
+        if self.sizeLimit:
+            self._addEntry(csPath, size)
 
     def get(self, key, shouldLock = True):
         csPath = self.hashKey(key)
         csVersion = key[1]
-        if len(self.locksMap) >= self.maxLocks:
-            shouldLock = False
         lockfile = util.LockedFile(csPath)
         util.mkdirChain(os.path.dirname(csPath))
-        fileObj = lockfile.open(shouldLock=shouldLock)
+        if shouldLock and len(self.locksMap) >= self.maxLocks:
+            # We can't afford another lock, but we still should not fetch
+            # something another process is already fetching
+            shouldLock = False
+            fileObj = self._waitForWriter(lockfile)
+        else:
+            fileObj = lockfile.open(shouldLock=shouldLock)
 
         if fileObj is None:
             if shouldLock:
@@ -1494,12 +1546,141 @@ class ChangesetCache(object):
         csInfo.version = csVersion
 
         self._log('HIT', key)
+        self._count('cscache_hit_bytes', os.fstat(fileObj.fileno()).st_size)
+        if self.sizeLimit:
+            self._touchEntry(csPath)
 
         return csInfo
 
     def resetLocks(self):
         self.locksMap.clear()
 
+    def _waitForWriter(self, lockfile):
+        """
+        Wait until no other process holds the lock for C{lockfile}, then
+        open the cached file if it is there. The lock itself is not held
+        on return.
+        """
+        fileObj = util.fopenIfExists(lockfile.fileName, "r")
+        if fileObj is not None:
+            return fileObj
+        lockfobj = util.fopenIfExists(lockfile.lockFileName, "r")
+        if lockfobj is None:
+            return None
+        try:
+            # A shared lock blocks for as long as a writer holds its
+            # exclusive lock
+            fcntl.lockf(lockfobj, fcntl.LOCK_SH)
+        finally:
+            # Closing releases the lock again
+            lockfobj.close()
+        return util.fopenIfExists(lockfile.fileName, "r")
+
+    def _count(self, name, delta):
+        if self.pokeCounter is not None:
+            self.pokeCounter(name, delta)
+
+    def _getIndex(self):
+        """
+        Open the index of cached changesets, creating it from the existing
+        contents of the cache if it is not there yet.
+        """
+        if self.db is not None:
+            return self.db
+        db = dbstore.connect(os.path.join(self.dataStore.top,
+            self.INDEX_NAME), driver='sqlite')
+        # Creating the table takes the write lock, so only one process
+        # populates a new index
+        cu = db.transaction()
+        db.loadSchema()
+        if 'CacheEntries' not in db.tables:
+            cu.execute("""
+                CREATE TABLE CacheEntries(
+                    path        VARCHAR(767) PRIMARY KEY,
+                    size        INTEGER NOT NULL,
+                    atime       INTEGER NOT NULL
+                )""")
+            db.tables['CacheEntries'] = []
+            db.createIndex('CacheEntries', 'CacheEntriesAtimeIdx', 'atime')
+            cu.executemany("INSERT INTO CacheEntries VALUES (?, ?, ?)",
+                self._iterExisting())
+        db.commit()
+        self.db = db
+        return db
+
+    def _iterExisting(self):
+        suffix = re.compile(r'-\d+\.%d$' % self.CACHE_VERSION)
+        for dirPath, dirNames, fileNames in os.walk(self.dataStore.top):
+            for fileName in fileNames:
+                if not suffix.search(fileName):
+                    continue
+                path = os.path.join(dirPath, fileName)
+                try:
+                    sb = os.stat(path)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                yield path, sb.st_size, int(sb.st_atime)
+
+    def _addEntry(self, csPath, size):
+        db = self._getIndex()
+        cu = db.transaction()
+        cu.execute("DELETE FROM CacheEntries WHERE path = ?", csPath)
+        cu.execute("INSERT INTO CacheEntries VALUES (?, ?, ?)",
+            csPath, size, int(time.time()))
+        self._evict(cu)
+        db.commit()
+
+    def _touchEntry(self, csPath):
+        now = int(time.time())
+        if now - self.touchedSince >= self.TOUCH_INTERVAL:
+            self.touched.clear()
+            self.touchedSince = now
+        elif csPath in self.touched:
+            return
+
+        db = self._getIndex()
+        cu = db.transaction()
+        cu.execute("UPDATE CacheEntries SET atime = ? WHERE path = ?",
+            now, csPath)
+        db.commit()
+        self.touched.add(csPath)
+
+    def _evict(self, cu):
+        """
+        Remove the least recently used changesets until the cache fits in
+        sizeLimit again.
+        """
+        cu.execute("SELECT SUM(size) FROM CacheEntries")
+        total = cu.fetchone()[0] or 0
+        if total <= self.sizeLimit:
+            return
+
+        cutoff = int(time.time()) - self.EVICT_GRACE
+        cu.execute("""SELECT path, size FROM CacheEntries
+            WHERE atime < ? ORDER BY atime""", cutoff)
+        victims = []
+        for path, size in cu.fetchall():
+            if total <= self.sizeLimit:
+                break
+            if path in self.locksMap:
+                continue
+            victims.append((path, size))
+            total -= size
+
+        evictedBytes = 0
+        for path, size in victims:
+            try:
+                os.unlink(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            cu.execute("DELETE FROM CacheEntries WHERE path = ?", path)
+            evictedBytes += size
+        self._count('cscache_evictions', len(victims))
+        self._count('cscache_evicted_bytes', evictedBytes)
+
     def _log(self, status, key, **kwargs):
         """Log a HIT/MISS/WRITE to file."""
         if self.logPath is None:
@@ -1614,12 +1795,14 @@ class ChangesetProducer(object):
             if additionalOffset == expandedSize:
                 # Skipped
                 pass
-            elif isChangeset:
+            elif isChangeset and self._hasReferences(fobj):
                 changeSet = filecontainer.FileContainer(fobj)
                 for data in changeSet.dumpIter(self._readNestedFile,
                         offset=additionalOffset):
                     yield data
             else:
+                # Either not a changeset or one with nothing to expand, so
+                # it goes out exactly as it is on disk
                 fobj.seek(additionalOffset)
                 for data in util.iterFileChunks(fobj):
                     yield data
@@ -1627,6 +1810,52 @@ class ChangesetProducer(object):
             if not preserveFile:
                 os.unlink(path)
 
+    def getSingleFile(self):
+        """
+        If the whole response is the rest of one file on disk, return that
+        file open and positioned where the response starts, so the web
+        server can send it without the data passing through Python.
+        Otherwise return None.
+        """
+        if len(self.items) != 1:
+            return None
+        (path, expandedSize, isChangeset, preserveFile, offset,
+                ) = self.items[0]
+
+        container = util.ExtendedFile(path, 'rb', buffering=False)
+        try:
+            rawSize = os.fstat(container.fileno()).st_size - offset
+            if rawSize != expandedSize:
+                return None
+            if isChangeset and self._hasReferences(
+                    util.SeekableNestedFile(container, rawSize, offset)):
+                return None
+        finally:
+            container.close()
+
+        fobj = open(path, 'rb')
+        fobj.seek(offset + (self.resumeOffset or 0))
+        if not preserveFile:
+            # The open file keeps the contents around until it is sent
+            os.unlink(path)
+        return fobj
+
+    @staticmethod
+    def _hasReferences(fobj):
+        """
+        Return True if the changeset in C{fobj} refers to files in the
+        contents store, which have to be expanded when it is sent.
+        """
+        refrTag = changeset.ChangedFileTypes.refr[4:]
+        changeSet = filecontainer.FileContainer(fobj)
+        # only the headers are read here
+        next = changeSet.getNextFile(skipIndex=False)
+        while next is not None:
+            if next[1][2:] == refrTag:
+                return True
+            next = changeSet.getNextFile(skipIndex=False)
+        return False
+
     def _readNestedFile(self, name, tag, rawSize, subfile):
         """Use with ChangeSet.dumpIter to handle external file references."""
         if changeset.ChangedFileTypes.refr[4:] == tag[2:]:
@@ -1217,6 +1217,16 @@ class TroveStore:
         del retr
         return d
 
+    def getFileStreams(self, fileIds):
+        # frozen streams for a set of fileIds, fetched with a single query
+        if not fileIds:
+            return {}
+
+        retr = FileRetriever(self.db, self.log)
+        d = retr.getStreams(fileIds)
+        del retr
+        return d
+
     def _cleanCache(self):
         self.versionIdCache = {}
         self.itemIdCache = {}
@@ -1566,19 +1576,16 @@ class FileRetriever:
         schema.resetTable(self.cu, 'tmpFileId')
         self.log = log or tracelog.getLog(None)
 
-    def get(self, l):
-        lookup = range(len(l))
-
-        insertL = []
-        for itemId, tup in enumerate(l):
-            (pathId, fileId) = tup[:2]
-            insertL.append((itemId, self.cu.binary(fileId)))
-            lookup[itemId] = (pathId, fileId)
-
+    def _loadFileIds(self, fileIds):
+        insertL = [ (itemId, self.cu.binary(fileId))
+                    for itemId, fileId in enumerate(fileIds) ]
         self.db.bulkload("tmpFileId", insertL, [ "itemId", "fileId" ],
                          start_transaction = False)
-
         self.db.analyze("tmpFileId")
+
+    def get(self, l):
+        lookup = [ tup[:2] for tup in l ]
+        self._loadFileIds(x[1] for x in lookup)
         self.cu.execute("SELECT itemId, stream FROM tmpFileId "
                         "JOIN FileStreams using (fileId) ")
         d = {}
@@ -1591,3 +1598,19 @@ class FileRetriever:
             d[(pathId, fileId)] = f
         schema.resetTable(self.cu, "tmpFileId")
         return d
+
+    def getStreams(self, fileIds):
+        """
+        Returns a dict mapping each fileId to its frozen file stream. Streams
+        are not thawed, and fileIds without a stream in this repository
+        are left out.
+        """
+        self._loadFileIds(fileIds)
+        self.cu.execute("SELECT fileId, stream FROM tmpFileId "
+                        "JOIN FileStreams using (fileId) "
+                        "WHERE stream IS NOT NULL")
+        d = {}
+        for fileId, stream in self.cu:
+            d[self.cu.frombinary(fileId)] = self.cu.frombinary(stream)
+        schema.resetTable(self.cu, "tmpFileId")
+        return d
@@ -97,6 +97,7 @@ class Transport(xmlrpclib.Transport):
 
     openerFactory = XMLOpener
     contentTypes = ['text/xml', 'application/xml']
+    binaryType = util.BINRPC_CONTENT_TYPE
     mixedType = 'multipart/mixed'
 
     def __init__(self, proxyMap=None, serverName=None, caCerts=None,
@@ -111,13 +112,16 @@ class Transport(xmlrpclib.Transport):
         self.responseProtocol = None
         self.usedProxy = None
         self.entitlement = None
+        # set once the server has answered in the binary encoding
+        self.binaryRequests = False
         self._proxyHost = None  # Can be a URL object
         self.proxyHost = None
         self.proxyProtocol = None
-        # More investigation about how persistent connections affect Conary
-        # operation is needed. For now, just close the cached connections.
+        # Connections are kept alive in the shared pool, so calls to the same
+        # server from other ServerProxy objects, as well as changeset and
+        # file downloads, reuse them.
         self.opener = self.openerFactory(proxyMap=proxyMap, caCerts=caCerts,
-                persist=False, connectAttempts=connectAttempts)
+                persist=True, connectAttempts=connectAttempts)
 
     def setEntitlements(self, entitlementList):
         self.entitlements = entitlementList
@@ -148,11 +152,13 @@ class Transport(xmlrpclib.Transport):
     def setAbortCheck(self, abortCheck):
         self.abortCheck = abortCheck
 
-    def request(self, url, body, verbose=0):
+    def request(self, url, body, verbose=0, contentType=None):
         self.verbose = verbose
 
         req = self.opener.newRequest(url, method='POST',
                 headers=self.extraHeaders)
+        if contentType:
+            req.headers['Content-Type'] = contentType
 
         req.setAbortCheck(self.abortCheck)
         req.setData(body, compress=self.compress)
@@ -161,7 +167,8 @@ class Transport(xmlrpclib.Transport):
         if self.serverName:
             req.headers['X-Conary-Servername'] = self.serverName
         req.headers['User-agent'] = self.user_agent
-        req.headers['Accept'] = ','.join(self.contentTypes + [self.mixedType])
+        req.headers['Accept'] = ','.join([self.binaryType] +
+                self.contentTypes + [self.mixedType])
 
         # Make sure we capture some useful information from the
         # opener, even if we failed
@@ -211,6 +218,13 @@ class Transport(xmlrpclib.Transport):
     def getparser(self):
         return util.xmlrpcGetParser()
 
+    def _parse_rpc_body(self, ctype, body):
+        if ctype == self.binaryType:
+            # the server understands binary requests as well
+            self.binaryRequests = True
+            return util.binrpcLoad(body)[0]
+        return xmlrpclib.Transport.parse_response(self, body)
+
     @staticmethod
     def _parse_multipart_header(response, boundary):
         if response.readline() != "--%s\r\n" % (boundary,):
@@ -232,8 +246,8 @@ class Transport(xmlrpclib.Transport):
     def parse_response(self, response):
         ctype = response.headers.get('content-type', '')
         ctype, pdict = cgi.parse_header(ctype)
-        if ctype in self.contentTypes:
-            return xmlrpclib.Transport.parse_response(self, response)
+        if ctype in self.contentTypes or ctype == self.binaryType:
+            return self._parse_rpc_body(ctype, response)
         elif ctype != self.mixedType:
             raise xmlrpclib.ResponseError(
                     "Response has invalid or missing Content-Type")
@@ -241,12 +255,12 @@ class Transport(xmlrpclib.Transport):
 
         # Read XMLRPC response
         rpcHeaders, rpcBody = decoder.get()
-        if (cgi.parse_header(rpcHeaders.get('content-type'))[0]
-                not in self.contentTypes):
+        rpcType = cgi.parse_header(rpcHeaders.get('content-type'))[0]
+        if rpcType not in self.contentTypes and rpcType != self.binaryType:
             raise xmlrpclib.ResponseError(
                     "Response has invalid or missing Content-Type")
         rpcBody = StringIO.StringIO(rpcBody)
-        result = xmlrpclib.Transport.parse_response(self, rpcBody)
+        result = self._parse_rpc_body(rpcType, rpcBody)
 
         # Replace the URL in the XMLRPC response with a file-like object that
         # reads out the second part of the multipart response
@@ -16,7 +16,7 @@
 
 
 from itertools import izip
-import cPickle, os, tempfile
+import os, struct, tempfile
 
 from conary import errors, trove, versions
 from conary.deps import deps
@@ -42,9 +42,124 @@ class CacheDict(dict):
     def add(self, troveTup, trv, withFiles=False):
         dict.__setitem__(self, troveTup, (withFiles, trv))
 
+# string table index used for None
+_NONE = 0xffffffff
+
+class _StringTable(object):
+
+    # interns the strings used by one section of a saved cache
+
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def add(self, s):
+        if s is None:
+            return _NONE
+
+        idx = self.ids.get(s)
+        if idx is None:
+            idx = len(self.strings)
+            self.ids[s] = idx
+            self.strings.append(s)
+
+        return idx
+
+def _freezeSection(table, words, size):
+    """
+    Packs one section of a saved cache. A section is a header, the lengths
+    of its interned strings, the strings themselves, and its records as a
+    flat list of 32 bit words, mostly indexes into the string table. The
+    size is what TroveCache._getSizeTuple() reports for the section.
+    """
+    strings = table.strings
+    return ''.join([
+            struct.pack('!III', len(strings), len(words), size),
+            struct.pack('!%dI' % len(strings), *[ len(x) for x in strings ]),
+            ''.join(strings),
+            struct.pack('!%dI' % len(words), *words) ])
+
+def _sectionSize(data):
+    return struct.unpack_from('!III', data)[2]
+
+class _CacheSection(object):
+
+    # unpacked form of a section written by _freezeSection(); each string
+    # is thawed at most once, however many records refer to it
+
+    def __init__(self, data):
+        stringCount, wordCount, self.size = struct.unpack_from('!III', data)
+        offset = 12
+        lengths = struct.unpack_from('!%dI' % stringCount, data, offset)
+        offset += 4 * stringCount
+
+        self.strings = strings = []
+        for length in lengths:
+            strings.append(data[offset:offset + length])
+            offset += length
+
+        self.words = struct.unpack_from('!%dI' % wordCount, data, offset)
+        self._thawed = {}
+
+    def string(self, idx):
+        if idx == _NONE:
+            return None
+
+        return self.strings[idx]
+
+    def thaw(self, idx, thawFn):
+        thawed = self._thawed.setdefault(thawFn, {})
+        obj = thawed.get(idx)
+        if obj is None:
+            obj = thawFn(self.strings[idx])
+            thawed[idx] = obj
+
+        return obj
+
+class _FrozenDepSolution(object):
+
+    # dependency solution which is thawed the first time it is asked for
+
+    __slots__ = ( 'section', 'offset' )
+
+    def __init__(self, section, offset):
+        self.section = section
+        self.offset = offset
+
+    def _decode(self, decodeTup):
+        words = self.section.words
+        i = self.offset + 1
+        results = []
+        for j in xrange(words[self.offset]):
+            count = words[i]
+            i += 1
+            results.append([ decodeTup(*words[k:k + 3])
+                             for k in xrange(i, i + 3 * count, 3) ])
+            i += 3 * count
+
+        return results
+
+    def freeze(self):
+        strings = self.section.strings
+        return self._decode(lambda name, version, flavor:
+                    (strings[name], strings[version], strings[flavor]))
+
+    def thaw(self):
+        section = self.section
+        return self._decode(lambda name, version, flavor:
+                    (section.strings[name],
+                     section.thaw(version, versions.ThawVersion),
+                     section.thaw(flavor, deps.ThawFlavor)))
+
+def _depCacheSize(depCache):
+    return sum([ len([ x[0] for x in depCache.itervalues()
+                         if x[0] is not None ]),
+                 len([ x[1] for x in depCache.itervalues()
+                         if x[1] is not None ]) ] )
+
 class TroveCache(trovesource.AbstractTroveSource):
 
-    VERSION = (4, 0)                    # (major, minor)
+    VERSION = (5, 0)                    # (major, minor)
 
     _fileId = '\0' * 40
     _troveCacheVersionPathId = 'TROVE-CACHE-FILE-VERSION--------'
@@ -54,7 +169,17 @@ class TroveCache(trovesource.AbstractTroveSource):
     _timeStampsPathId = 'SYSTEM-MODEL-TIMESTAMP-CACHE----'
     _includeFilePathId = 'SYSTEM-MODEL-INCLUDE-FILE-CACHE-'
 
+    # Timestamps must come first because some other caches use it to
+    # construct versions.
+    _sections = [ ('timeStampCache', _timeStampsPathId, 'Timestamps'),
+                  ('depCache', _depCachePathId, 'Deps'),
+                  ('depSolutionCache', _depSolutionsPathId, 'DepSolutions'),
+                  ('fileCache', _includeFilePathId, 'FileCache') ]
+
     def __init__(self, troveSource):
+        # maps the name of a cache which hasn't been used since it was
+        # loaded to its (saved form, size)
+        self._pendingSections = {}
         self.troveInfoCache = {}
         self.depCache = {}
         self.depSolutionCache = {}
@@ -65,7 +190,17 @@ class TroveCache(trovesource.AbstractTroveSource):
         self.fileCache = {}
         self.callback = None
         self._startingSizes = self._getSizeTuple()
-        self._cs = None
+
+    def __getattr__(self, name):
+        # load() leaves each of the caches in _sections in its saved form
+        # until the first time it is used
+        pending = self.__dict__.get('_pendingSections', {}).pop(name, None)
+        if pending is None:
+            raise AttributeError(name)
+
+        kind = [ x[2] for x in self._sections if x[0] == name ][0]
+        getattr(self, '_thaw' + kind)(_CacheSection(pending[0]))
+        return self.__dict__[name]
 
     def _addToCache(self, troveTupList, troves, _cached = None,
                     withFiles = False):
@@ -84,13 +219,19 @@ class TroveCache(trovesource.AbstractTroveSource):
         pass
 
     def _getSizeTuple(self):
+        def sizeOf(name, sizeFn):
+            # don't thaw a cache just to find out how big it is
+            pending = self._pendingSections.get(name)
+            if pending is not None:
+                return pending[1]
+            return sizeFn(getattr(self, name))
+
         return ( len(self.cache),
-                 sum([ len([ x[0] for x in self.depCache.itervalues()
-                                 if x[0] is not None ]),
-                       len([ x[1] for x in self.depCache.itervalues()
-                                 if x[1] is not None ]) ] ),
-                 len(self.depSolutionCache), len(self.timeStampCache),
-                 len(self.findCache), len(self.fileCache) )
+                 sizeOf('depCache', _depCacheSize),
+                 sizeOf('depSolutionCache', len),
+                 sizeOf('timeStampCache', len),
+                 len(self.findCache),
+                 sizeOf('fileCache', len) )
 
     def cacheTroves(self, troveTupList, _cached = None, withFiles = False):
         troveTupList = [x for x in troveTupList
@@ -116,7 +257,12 @@ class TroveCache(trovesource.AbstractTroveSource):
         self.depSolutionCache[(sig, depSet)] = list(result)
 
     def getDepSolution(self, sig, depSet):
-        return self.depSolutionCache.get( (sig, depSet), None )
+        result = self.depSolutionCache.get( (sig, depSet), None )
+        if type(result) is _FrozenDepSolution:
+            result = result.thaw()
+            self.depSolutionCache[(sig, depSet)] = result
+
+        return result
 
     def getDepCacheEntry(self, troveTup):
         result = self.depCache.get(troveTup)
@@ -331,102 +477,133 @@ class TroveCache(trovesource.AbstractTroveSource):
             # major number is too big for us; we can't load this
             return
 
-        # Timestamps must come first because some other caches use it to
-        # construct versions.
-        self._cs = cs
-        self._loadTimestamps()
-        self._loadDeps()
-        self._loadDepSolutions()
-        self._loadFileCache()
-        self._startingSizes = self._getSizeTuple()
-        self._cs = None
-
-    def _loadPickle(self, pathId):
-        self._cs.reset()
-        contType, contents = self._cs.getFileContents(pathId, self._fileId)
-        pickled = contents.get().read()
-        return cPickle.loads(pickled)
-
-    def _savePickle(self, pathId, data):
-        pickled = cPickle.dumps(data, 2)
-        self._cs.addFileContents(pathId, self._fileId,
-                changeset.ChangedFileTypes.file,
-                filecontents.FromString(pickled), False)
-
-    def _loadTimestamps(self):
-        if self.version < (4, 0):
+        if self.version < (5, 0):
+            # older caches pickled everything but the troves; the rest
+            # gets rebuilt
             return
-        timeStampList = self._loadPickle(self._timeStampsPathId)
-        for (name, frozenVersion) in timeStampList:
-            thawed = versions.ThawVersion(frozenVersion)
-            self.timeStampCache[(name, thawed)] = thawed
-
-    def _saveTimestamps(self):
-        timeStamps = []
-        for (name, baseVersion), version in self.timeStampCache.items():
-            timeStamps.append( (name, version.freeze()) )
-        self._savePickle(self._timeStampsPathId, timeStamps)
-
-    def _loadDeps(self):
-        depList = self._loadPickle(self._depCachePathId)
-        for (name, thawedVersion, frzFlavor, prov, req) in depList:
-            version = versions.VersionFromString(thawedVersion)
-            flavor = deps.ThawFlavor(frzFlavor)
-            self.depCache[ (name, version, flavor) ] = (prov, req)
-
-    def _saveDeps(self):
-        depList = []
+
+        # Only read the sections here; each one is unpacked the first time
+        # its cache is used
+        for name, pathId, kind in self._sections:
+            cs.reset()
+            contType, contents = cs.getFileContents(pathId, self._fileId)
+            data = contents.get().read()
+            self._pendingSections[name] = (data, _sectionSize(data))
+            delattr(self, name)
+
+        self._startingSizes = self._getSizeTuple()
+
+    def _thawTimestamps(self, section):
+        timeStampCache = {}
+        strings = section.strings
+        words = section.words
+        for i in xrange(0, len(words), 2):
+            thawed = section.thaw(words[i + 1], versions.ThawVersion)
+            timeStampCache[(strings[words[i]], thawed)] = thawed
+
+        self.timeStampCache = timeStampCache
+
+    def _freezeTimestamps(self):
+        table = _StringTable()
+        words = []
+        for (name, baseVersion), version in self.timeStampCache.iteritems():
+            words.append(table.add(name))
+            words.append(table.add(version.freeze()))
+
+        return _freezeSection(table, words, len(self.timeStampCache))
+
+    def _thawDeps(self, section):
+        # timestamps must be thawed first; see _sections
+        self.timeStampCache
+
+        depCache = {}
+        strings = section.strings
+        words = section.words
+        for i in xrange(0, len(words), 5):
+            name, version, flavor, prov, req = words[i:i + 5]
+            version = section.thaw(version, versions.VersionFromString)
+            flavor = section.thaw(flavor, deps.ThawFlavor)
+            # getDepCacheEntry() thaws the dependency sets when needed
+            depCache[(strings[name], version, flavor)] = \
+                    (section.string(prov), section.string(req))
+
+        self.depCache = depCache
+
+    def _freezeDeps(self):
+        table = _StringTable()
+        words = []
         for troveTup, (prov, req) in self.depCache.iteritems():
             if type(prov) is not str and prov is not None:
                 prov = prov.freeze()
             if type(req) is not str and req is not None:
                 req = req.freeze()
 
-            depList.append((troveTup[0], troveTup[1].asString(),
-                            troveTup[2].freeze(), prov, req))
-        self._savePickle(self._depCachePathId, depList)
-
-    def _loadDepSolutions(self):
-        if self.version < (3, 0):
-            # Version 1 was missing timestamps, which interferes with dep
-            # solver tie-breaking.
-            # Version 2 could have bogus unresolved dep solutions due to a bug
-            # so the version was bumped to invalidate those.
-            return
-        depSolutionsList = self._loadPickle(self._depSolutionsPathId)
-        for (sig, depSet, aResult) in depSolutionsList:
-            depSet = deps.ThawDependencySet(depSet)
-            allResults = []
-            for resultList in aResult:
-                allResults.append([
-                    (x[0], versions.ThawVersion(x[1]), deps.ThawFlavor(x[2]))
-                    for x in resultList])
-            self.addDepSolution(sig, depSet, allResults)
-
-    def _saveDepSolutions(self):
-        depSolutions = []
+            words.extend((table.add(troveTup[0]),
+                          table.add(troveTup[1].asString()),
+                          table.add(troveTup[2].freeze()),
+                          table.add(prov), table.add(req)))
+
+        return _freezeSection(table, words, _depCacheSize(self.depCache))
+
+    def _thawDepSolutions(self, section):
+        depSolutionCache = {}
+        words = section.words
+        i = 0
+        while i < len(words):
+            sig, depSet, resultCount = words[i:i + 3]
+            # getDepSolution() thaws the results when needed
+            solution = _FrozenDepSolution(section, i + 2)
+            i += 3
+            for j in xrange(resultCount):
+                i += 1 + 3 * words[i]
+
+            depSet = section.thaw(depSet, deps.ThawDependencySet)
+            depSolutionCache[(section.strings[sig], depSet)] = solution
+
+        self.depSolutionCache = depSolutionCache
+
+    def _freezeDepSolutions(self):
+        table = _StringTable()
+        words = []
         for (sig, depSet), aResult in self.depSolutionCache.iteritems():
-            allResults = []
-            for resultList in aResult:
-                allResults.append([ (x[0], x[1].freeze(), x[2].freeze()) for
-                                     x in resultList ])
-
-            depSolutions.append( (sig, depSet.freeze(), allResults) )
-        self._savePickle(self._depSolutionsPathId, depSolutions)
-
-    def _loadFindCache(self):
-        self.findCache = self._loadPickle(self._findCachePathId)
-
-    def _saveFindCache(self):
-        self._savePickle(self._findCachePathId, self.findCache)
-
-    def _loadFileCache(self):
-        if self.version < (1, 0):
-            return
-        self.fileCache = self._loadPickle(self._includeFilePathId)
-
-    def _saveFileCache(self):
-        self._savePickle(self._includeFilePathId, self.fileCache)
+            if type(aResult) is _FrozenDepSolution:
+                allResults = aResult.freeze()
+            else:
+                allResults = [ [ (x[0], x[1].freeze(), x[2].freeze())
+                                 for x in resultList ]
+                               for resultList in aResult ]
+
+            words.extend((table.add(sig), table.add(depSet.freeze()),
+                          len(allResults)))
+            for resultList in allResults:
+                words.append(len(resultList))
+                for troveTup in resultList:
+                    words.extend([ table.add(x) for x in troveTup ])
+
+        return _freezeSection(table, words, len(self.depSolutionCache))
+
+    def _thawFileCache(self, section):
+        fileCache = {}
+        strings = section.strings
+        words = section.words
+        i = 0
+        while i < len(words):
+            key, count = words[i:i + 2]
+            i += 2
+            fileCache[strings[key]] = [ strings[x]
+                                        for x in words[i:i + count] ]
+            i += count
+
+        self.fileCache = fileCache
+
+    def _freezeFileCache(self):
+        table = _StringTable()
+        words = []
+        for key, lines in self.fileCache.iteritems():
+            words.extend((table.add(key), len(lines)))
+            words.extend([ table.add(x) for x in lines ])
+
+        return _freezeSection(table, words, len(self.fileCache))
 
     def save(self, path):
         # return early if we aren't going to have permission to save
@@ -454,16 +631,21 @@ class TroveCache(trovesource.AbstractTroveSource):
                            changeset.ChangedFileTypes.file,
                            filecontents.FromString("%d %d" % self.VERSION),
                            False)
-        self._cs = cs
-        self._saveTimestamps()
-        self._saveDeps()
-        self._saveDepSolutions()
-        self._saveFileCache()
-        self._cs = None
+        for name, pathId, kind in self._sections:
+            pending = self._pendingSections.get(name)
+            if pending is not None:
+                # unused since it was loaded, so it can't have changed
+                data = pending[0]
+            else:
+                data = getattr(self, '_freeze' + kind)()
+
+            cs.addFileContents(pathId, self._fileId,
+                    changeset.ChangedFileTypes.file,
+                    filecontents.FromString(data), False)
 
         try:
             try:
-                cs.writeToFile(cacheName)
+                cs.writeToFile(cacheName, withIndex = True)
                 if util.exists(path):
                     os.chmod(cacheName, os.stat(path).st_mode)
                 else:
@@ -801,14 +801,18 @@ class SearchableTroveSource(AbstractTroveSource):
                              preferenceList):
         if not preferenceList:
             return 0, flavorList, []
-        strongList = [ (x.toStrongFlavor(), x) for x in flavorList ]
-        indexedList = list(enumerate(preferenceList[:scoreToMatch + 1]))
+        # satisfied[i][j] is the score of the strong form of flavorList[j]
+        # against preference i
+        satisfied = [ deps.FlavorMatcher(x).scoreProviders(flavorList,
+                                                           strong = True)
+                      for x in preferenceList[:scoreToMatch + 1] ]
+        indexedList = list(enumerate(satisfied))
         nomatches = []
         minScore = None
         matchingFlavors = []
-        for strongFlavor, flavor in strongList:
-            for currentScore, preferenceFlavor in indexedList:
-                if strongFlavor.satisfies(preferenceFlavor):
+        for i, flavor in enumerate(flavorList):
+            for currentScore, preferenceScores in indexedList:
+                if preferenceScores[i] is not False:
                     if minScore is None or currentScore < minScore:
                         matchingFlavors = []
                     elif currentScore > minScore:
@@ -853,15 +857,14 @@ class SearchableTroveSource(AbstractTroveSource):
                       if (flavorQuery, x) not in scoreCache ]
         if not toCalc:
             return
+        matcher = deps.FlavorMatcher(flavorQuery)
         if flavorCheck == _CHECK_TROVE_STRONG_FLAVOR:
-            strongFlavors = [x.toStrongFlavor() for x in toCalc]
-            toCalc = zip(strongFlavors, toCalc)
-            scores = ((x[0].score(flavorQuery), x[1]) \
-                                        for x in toCalc)
+            scores = matcher.scoreProviders(toCalc, strong = True)
         else:
-            scores = ((flavorQuery.score(x), x) for x in flavorList)
+            scores = matcher.scoreRequirements(toCalc)
 
-        scoreCache.update(((flavorQuery, x[1]),x[0]) for x in scores)
+        scoreCache.update(((flavorQuery, x), score)
+                          for x, score in itertools.izip(toCalc, scores))
 
     def _addFilteredFlavorsToResults(self, version, flavorList, flavorQuery,
                                    usedFlavors, queryResults, latestFilter,
@@ -134,7 +134,8 @@ class HttpRequests(SimpleHTTPRequestHandler):
             self.send_error(501)
 
     def do_POST(self):
-        if self.headers.get('Content-Type', '') == 'text/xml':
+        if self.headers.get('Content-Type', '') in ('text/xml',
+                                                    util.BINRPC_CONTENT_TYPE):
             authToken = self.getAuth()
             if authToken is None:
                 return
@@ -205,7 +206,12 @@ class HttpRequests(SimpleHTTPRequestHandler):
             sio = util.decompressStream(sio)
             sio.seek(0)
 
-        (params, method) = util.xmlrpcLoad(sio)
+        binary = (self.headers.get('Content-Type') ==
+                  util.BINRPC_CONTENT_TYPE)
+        if binary:
+            (params, method) = util.binrpcLoad(sio)
+        else:
+            (params, method) = util.xmlrpcLoad(sio)
         logMe(3, "decoded xml-rpc call %s from %d bytes request" %(method, contentLength))
 
         if self.netProxy:
@@ -251,7 +257,12 @@ class HttpRequests(SimpleHTTPRequestHandler):
         rawResponse, headers = response.toWire(request.version)
 
         sio = util.BoundedStringIO()
-        util.xmlrpcDump((rawResponse,), stream = sio, methodresponse=1)
+        if binary or util.BINRPC_CONTENT_TYPE in self.headers.get('Accept', ''):
+            contentType = util.BINRPC_CONTENT_TYPE
+            sio.write(util.binrpcDump((rawResponse,), methodresponse=1))
+        else:
+            contentType = "text/xml"
+            util.xmlrpcDump((rawResponse,), stream = sio, methodresponse=1)
         respLen = sio.tell()
         logMe(3, "encoded xml-rpc response to %d bytes" % respLen)
 
@@ -262,7 +273,7 @@ class HttpRequests(SimpleHTTPRequestHandler):
             sio = util.compressStream(sio, level = 5)
             respLen = sio.tell()
             self.send_header('Content-encoding', 'deflate')
-        self.send_header("Content-type", "text/xml")
+        self.send_header("Content-type", contentType)
         self.send_header("Content-length", str(respLen))
         for key, value in sorted(headers.items()):
             self.send_header(key, value)
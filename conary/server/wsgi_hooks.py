@@ -208,6 +208,9 @@ class ConaryHandler(object):
 
     requestFilter = xmlshims.RequestArgs
     responseFactory = webob.Response
+    rpcContentTypes = ('text/xml', util.BINRPC_CONTENT_TYPE)
+    # RPC responses larger than this are streamed
+    rpcStreamThreshold = 256 * 1024
 
     def __init__(self, cfg):
         self.cfg = cfg
@@ -410,7 +413,7 @@ class ConaryHandler(object):
         elif self.request.method == 'POST':
             # Only check content-type because of proxying considerations; as
             # above, the full URL will vary.
-            if self.request.content_type == 'text/xml':
+            if self.request.content_type in self.rpcContentTypes:
                 return self.postRpc()
             # Fall through to web handler
         elif self.request.method == 'PUT':
@@ -430,7 +433,8 @@ class ConaryHandler(object):
         return web._handleRequest(request)
 
     def postRpc(self):
-        if self.request.content_type != 'text/xml':
+        contentType = self.request.content_type
+        if contentType not in self.rpcContentTypes:
             return self._makeError('400 Bad Request',
                     "Unrecognized Content-Type")
         stream = self.request.body_file
@@ -443,7 +447,10 @@ class ConaryHandler(object):
                     "Unrecognized Content-Encoding")
 
         try:
-            params, method = util.xmlrpcLoad(stream)
+            if contentType == util.BINRPC_CONTENT_TYPE:
+                params, method = util.binrpcLoad(stream)
+            else:
+                params, method = util.xmlrpcLoad(stream)
         except:
             return self._makeError('400 Bad Request',
                     "Malformed XMLRPC request")
@@ -482,24 +489,56 @@ class ConaryHandler(object):
             headers['Via'] = proxy.formatViaHeader(localAddr,
                     self.request.http_version, prefix=extraInfo.getVia())
         response = self.responseFactory(headerlist=headers.items())
-        response.content_type = 'text/xml'
-
-        # Output phase -- serialize and write the response
-        body = util.xmlrpcDump((rawResponse,), methodresponse=1)
-        accept = self.request.accept_encoding
-        if len(body) > 200 and 'deflate' in accept:
-            response.content_encoding = 'deflate'
-            response.body = zlib.compress(body, 5)
-        else:
-            response.body = body
-
-        if (method == 'getChangeSet'
+        inline = (method == 'getChangeSet'
                 and request.version >= 71
                 and not responseArgs.isException
                 and response.status_int == 200
                 and responseArgs.result[0]
                 and 'multipart/mixed' in list(self.request.accept)
-                ):
+                )
+
+        # Output phase -- serialize and write the response. Clients which
+        # can read the binary encoding list it in Accept.
+        if (contentType == util.BINRPC_CONTENT_TYPE
+                or util.BINRPC_CONTENT_TYPE in list(self.request.accept)):
+            response.content_type = util.BINRPC_CONTENT_TYPE
+            chunks = util.binrpcDumpIter((rawResponse,), methodresponse=1)
+        else:
+            response.content_type = 'text/xml'
+            chunks = util.xmlrpcDumpIter((rawResponse,), methodresponse=1)
+
+        # Small responses, and those with a changeset attached, are sent in
+        # one piece. Anything larger is deflated as it is serialized and
+        # sent without a Content-Length (chunked), so the whole body is
+        # never held in memory.
+        head = []
+        size = 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= self.rpcStreamThreshold and not inline:
+                break
+        else:
+            chunks = None
+
+        accept = self.request.accept_encoding
+        deflate = size > 200 and 'deflate' in accept
+        if deflate:
+            response.content_encoding = 'deflate'
+        if chunks is None:
+            body = ''.join(head)
+            if deflate:
+                response.body = zlib.compress(body, 5)
+            else:
+                response.body = body
+        else:
+            appIter = itertools.chain(head, chunks)
+            if deflate:
+                appIter = util.compressIter(appIter, 5)
+            response.app_iter = appIter
+            response.content_length = None
+
+        if inline:
             return self.inlineChangeset(response, responseArgs, headers)
         else:
             return response
@@ -516,9 +555,17 @@ class ConaryHandler(object):
             if err.args[0] == errno.ENOENT:
                 return self._makeError('404 Not Found', "Changeset not found")
             raise
+        appIter = producer
+        fileWrapper = self.request.environ.get('wsgi.file_wrapper')
+        if fileWrapper is not None:
+            # Let the server send cached changesets and file contents
+            # straight from disk when it can (e.g. with sendfile)
+            fobj = producer.getSingleFile()
+            if fobj is not None:
+                appIter = fileWrapper(fobj, 65536)
         return self.responseFactory(
                 status='200 OK',
-                app_iter=producer,
+                app_iter=appIter,
                 content_type='application/x-conary-change-set',
                 content_length=str(producer.getSize()),
                 )
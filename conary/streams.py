@@ -271,7 +271,7 @@ class BaseDependenciesStream(InfoStream):
     def set(self, val):
         assert(val is not None)
         self._members = val._members
-        self.hash = None
+        self._hash = self._frozen = None
 
     def diff(self, them):
         if self != them:
@@ -22,6 +22,7 @@ Implements troves (packages, components, etc.) for the repository
 import itertools, os
 import re
 import struct
+import threading
 
 from conary import changelog
 from conary import errors
@@ -1414,6 +1415,148 @@ class TroveRefsTrovesStream(dict, streams.InfoStream):
 
         return new
 
+def _iterFrozenFileList(data):
+    """
+    Decodes the frozen form of a ReferencedFileList, yielding
+    (pathId, dirName, baseName, fileId, version) tuples.
+    """
+    # this lastVerStr check bypasses the normal version cache whenever
+    # there are two sequential versions which are the same; this is a
+    # massive speedup for troves with many files (90% or better)
+    lastVerStr = None;
+    lastVer = None
+    i = 0
+    while i < len(data):
+        i, (pathId, path, fileId, verStr) = pack.unpack("!S16SHSHSH", i,
+                                                        data)
+        if not path:
+            dirName = None
+            baseName = None
+        else:
+            dirName, baseName = os.path.split(path)
+            dirName = intern(dirName)
+            baseName = intern(baseName)
+
+        if not fileId:
+            fileId = None
+        else:
+            fileId = intern(fileId)
+
+        if verStr == lastVerStr:
+            version = lastVer
+        elif verStr:
+            version = versions.VersionFromString(verStr)
+            lastVer = version
+            lastVerStr = verStr
+        else:
+            version = None
+
+        yield (pathId, dirName, baseName, fileId, version)
+
+def _countFrozenFileList(data):
+    """
+    Returns the number of entries in the frozen form of a
+    ReferencedFileList without decoding them.
+    """
+    unpackFrom = struct.Struct("!H").unpack_from
+    end = len(data)
+    count = 0
+    i = 0
+    while i < end:
+        i += 16
+        i += unpackFrom(data, i)[0] + 2
+        i += unpackFrom(data, i)[0] + 2
+        i += unpackFrom(data, i)[0] + 2
+        count += 1
+
+    return count
+
+def _iterRawFileList(data):
+    """
+    Decodes the frozen form of a ReferencedFileList, yielding
+    (pathId, path, fileId, version string) tuples. Nothing is interned or
+    converted.
+    """
+    i = 0
+    while i < len(data):
+        i, entry = pack.unpack("!S16SHSHSH", i, data)
+        path = entry[1]
+        if '//' in path:
+            # match the os.path.split()/join() round trip a thawed
+            # entry goes through
+            entry = (entry[0], os.path.join(*os.path.split(path)),
+                     entry[2], entry[3])
+        yield entry
+
+# serializes decoding the contents of _LazyStream objects
+_thawLock = threading.Lock()
+
+class _LazyStream(streams.InfoStream):
+
+    """
+    Base class for streams which keep their frozen form until their
+    contents are needed. Objects of this class are not dicts or lists
+    themselves, so code which looks directly at the storage of those
+    (dict(), list.extend() and the like) goes through the normal methods
+    and can't see an empty container. Container methods are passed on to
+    the object _thawContainer() builds from the frozen form the first time
+    one of them is called.
+    """
+
+    __slots__ = ( '_frozen', '_thawed' )
+
+    def _thaw(self):
+        thawed = self._thawed
+        if thawed is None:
+            _thawLock.acquire()
+            try:
+                if self._thawed is None:
+                    self._thawed = self._thawContainer(self._frozen)
+                    self._frozen = None
+
+                thawed = self._thawed
+            finally:
+                _thawLock.release()
+
+        return thawed
+
+    def _getFrozen(self):
+        """
+        Returns the frozen form, or None once the contents have been thawed.
+        """
+        if self._thawed is not None:
+            return None
+
+        _thawLock.acquire()
+        try:
+            if self._thawed is None:
+                return self._frozen
+
+            return None
+        finally:
+            _thawLock.release()
+
+    def __eq__(self, other):
+        return self._thaw() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+def _lazyMethods(lazyClass, names):
+    """
+    Adds each of the named methods to lazyClass, passing the call on to the
+    container returned by _thaw().
+    """
+    def wrap(name):
+        def fn(self, *args, **kwargs):
+            return getattr(self._thaw(), name)(*args, **kwargs)
+
+        fn.__name__ = name
+        return fn
+
+    for name in names:
+        setattr(lazyClass, name, wrap(name))
+
 class TroveRefsFilesStream(dict, streams.InfoStream):
 
     """
@@ -1460,6 +1603,335 @@ class TroveRefsFilesStream(dict, streams.InfoStream):
 
         return new
 
+# troves with at least this many files keep their file list in a
+# _CompactTroveRefsFilesStream
+COMPACT_FILE_LIST_SIZE = 5000
+
+_compactFileEntry = struct.Struct("!II20s")
+
+class _CompactTroveRefsFilesStream(streams.InfoStream):
+
+    """
+    A TroveRefsFilesStream for troves with very many files. Rather than a
+    (dirName, baseName, fileId, version) tuple, each entry is kept as a
+    single string holding indexes into tables of directory names and
+    versions, the fileId and the base name. Entries which don't fit that
+    form (missing paths or fileIds) are stored as plain tuples.
+
+    The packed entries never leave this object. It isn't a dict; it
+    provides the mapping interface itself and rebuilds the tuples whenever
+    values are looked up. Removing or replacing entries can leave rows in
+    the tables which nothing uses any more, so the tables are rebuilt once
+    there have been more of those changes than there are entries.
+    """
+
+    __slots__ = ( '_map', '_dirs', '_dirIndex', '_versions', '_versionIndex',
+                  '_changes' )
+
+    def __init__(self, items = None):
+        self._map = {}
+        self._initTables()
+        if items is not None:
+            self.update(items)
+
+    def _initTables(self):
+        self._dirs = []
+        self._dirIndex = {}
+        # versions are tabled by identity so lookups give back exactly
+        # the object which was stored
+        self._versions = []
+        self._versionIndex = {}
+        self._changes = 0
+
+    def _pack(self, val):
+        (dirName, baseName, fileId, version) = val
+        if (type(dirName) is not str or type(baseName) is not str or
+                type(fileId) is not str or len(fileId) != 20):
+            return val
+
+        dirIdx = self._dirIndex.get(dirName)
+        if dirIdx is None:
+            dirIdx = len(self._dirs)
+            self._dirs.append(dirName)
+            self._dirIndex[dirName] = dirIdx
+
+        verIdx = self._versionIndex.get(id(version))
+        if verIdx is None:
+            verIdx = len(self._versions)
+            self._versions.append(version)
+            self._versionIndex[id(version)] = verIdx
+
+        return _compactFileEntry.pack(dirIdx, verIdx, fileId) + baseName
+
+    def _unpack(self, val):
+        if type(val) is tuple:
+            return val
+
+        dirIdx, verIdx, fileId = _compactFileEntry.unpack_from(val)
+        return (self._dirs[dirIdx], val[_compactFileEntry.size:], fileId,
+                self._versions[verIdx])
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes <= len(self._map):
+            return
+
+        # drop the table rows nothing refers to any more; the keys don't
+        # change, so iterators over the map stay valid
+        entries = [ (key, self._unpack(val))
+                    for key, val in self._map.iteritems() ]
+        self._initTables()
+        for key, val in entries:
+            self._map[key] = self._pack(val)
+
+    def _thawRaw(self, rawEntries):
+        # loads (pathId, path, fileId, version string) entries without
+        # building (or interning) the pieces of the usual tuple
+        versionCache = {}
+        split = os.path.split
+        for (pathId, path, fileId, verStr) in rawEntries:
+            version = versionCache.get(verStr)
+            if version is None:
+                version = verStr and versions.VersionFromString(verStr) or None
+                versionCache[verStr] = version
+
+            dirName, baseName = split(path)
+            self._map[pathId] = self._pack((dirName, baseName, fileId,
+                                            version))
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self._map)
+
+    def iterkeys(self):
+        return self._map.iterkeys()
+
+    def keys(self):
+        return self._map.keys()
+
+    def __getitem__(self, key):
+        return self._unpack(self._map[key])
+
+    def get(self, key, default = None):
+        val = self._map.get(key, self)
+        if val is self:
+            return default
+
+        return self._unpack(val)
+
+    def __setitem__(self, key, val):
+        if key in self._map:
+            self._changed()
+
+        self._map[key] = self._pack(val)
+
+    def __delitem__(self, key):
+        del self._map[key]
+        self._changed()
+
+    def setdefault(self, key, default = None):
+        if key not in self._map:
+            self[key] = default
+
+        return self[key]
+
+    def pop(self, key, *args):
+        if key not in self._map and args:
+            return args[0]
+
+        val = self._unpack(self._map.pop(key))
+        self._changed()
+        return val
+
+    def popitem(self):
+        key, val = self._map.popitem()
+        val = self._unpack(val)
+        self._changed()
+        return key, val
+
+    def update(self, other = (), **kwargs):
+        if hasattr(other, 'iteritems'):
+            other = other.iteritems()
+
+        for key, val in itertools.chain(other, kwargs.iteritems()):
+            self[key] = val
+
+    def clear(self):
+        self._map.clear()
+        self._initTables()
+
+    def itervalues(self):
+        unpack = self._unpack
+        for val in self._map.itervalues():
+            yield unpack(val)
+
+    def iteritems(self):
+        unpack = self._unpack
+        for key, val in self._map.iteritems():
+            yield key, unpack(val)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def copy(self):
+        new = _CompactTroveRefsFilesStream()
+        new._map = self._map.copy()
+        new._dirs = self._dirs[:]
+        new._dirIndex = self._dirIndex.copy()
+        new._versions = self._versions[:]
+        new._versionIndex = self._versionIndex.copy()
+        new._changes = self._changes
+        return new
+
+    freeze = TroveRefsFilesStream.freeze.im_func
+
+    def __eq__(self, other):
+        if isinstance(other, _LazyTroveRefsFilesStream):
+            other = other._thaw()
+
+        if (not isinstance(other, (dict, _CompactTroveRefsFilesStream)) or
+                len(self) != len(other)):
+            return False
+
+        for key, val in self.iteritems():
+            if key not in other or other[key] != val:
+                return False
+
+        return True
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def __reduce_ex__(self, protocol):
+        return (TroveRefsFilesStream, (), None, None, self.iteritems())
+
+class _LazyTroveRefsFilesStream(_LazyStream):
+
+    """
+    A TroveRefsFilesStream built directly from the frozen new file list of
+    an absolute trove change set (the ReferencedFileList format). The
+    buffer is kept as-is; freezing, copying, counting and iterating over
+    the files work from it directly, and any other use decodes the entries
+    into a TroveRefsFilesStream (or a _CompactTroveRefsFilesStream for
+    large troves) which handles everything from then on.
+    """
+
+    __slots__ = ( '_count', '_sorted' )
+
+    def __init__(self, data):
+        self._frozen = data
+        self._thawed = None
+        self._count = None
+        self._sorted = None
+
+    def _thawContainer(self, data):
+        self._sorted = None
+        count = self._count
+        if count is None:
+            count = _countFrozenFileList(data)
+
+        if count >= COMPACT_FILE_LIST_SIZE:
+            thawed = _CompactTroveRefsFilesStream()
+            thawed._thawRaw(_iterRawFileList(data))
+            return thawed
+
+        thawed = TroveRefsFilesStream()
+        for (pathId, dirName, baseName, fileId, version) in \
+                                                _iterFrozenFileList(data):
+            thawed[pathId] = (dirName, baseName, fileId, version)
+
+        return thawed
+
+    def __nonzero__(self):
+        frozen = self._getFrozen()
+        if frozen is None:
+            return bool(self._thawed)
+
+        return bool(frozen)
+
+    def __len__(self):
+        frozen = self._getFrozen()
+        if frozen is None:
+            return len(self._thawed)
+
+        if self._count is None:
+            self._count = _countFrozenFileList(frozen)
+
+        return self._count
+
+    def freeze(self, skipSet = {}):
+        frozen = self._getFrozen()
+        if frozen is None:
+            return self._thawed.freeze(skipSet = skipSet)
+
+        # signature checks freeze the trove more than once, so keep the
+        # sorted form around while the buffer is still in use
+        if self._sorted is None:
+            l = []
+            for (pathId, path, fileId, verStr) in _iterRawFileList(frozen):
+                s = pack.pack("!S16S20SHSH", pathId, fileId, path, verStr)
+                l.append((len(s), s))
+
+            l.sort()
+
+            self._sorted = pack.pack("!" + "SH" * len(l),
+                                     *( x[1] for x in l))
+
+        return self._sorted
+
+    def copy(self):
+        frozen = self._getFrozen()
+        if frozen is None:
+            return self._thawed.copy()
+
+        return _LazyTroveRefsFilesStream(frozen)
+
+    def __deepcopy__(self, mem):
+        return self.copy()
+
+    def iterFiles(self):
+        """
+        Yields (pathId, path, fileId, version) for each file, straight from
+        the frozen buffer if it hasn't been decoded.
+        """
+        frozen = self._getFrozen()
+        if frozen is None:
+            for (pathId, (dirName, baseName, fileId, version)) in \
+                                                    self._thawed.iteritems():
+                yield (pathId, os.path.join(dirName, baseName), fileId,
+                       version)
+
+            return
+
+        lastVerStr = None
+        lastVer = None
+        for (pathId, path, fileId, verStr) in _iterRawFileList(frozen):
+            if verStr != lastVerStr:
+                lastVer = verStr and versions.VersionFromString(verStr) or None
+                lastVerStr = verStr
+
+            yield (pathId, path, fileId or None, lastVer)
+
+_lazyMethods(_LazyTroveRefsFilesStream,
+             [ '__iter__', '__getitem__', '__contains__', '__setitem__',
+               '__delitem__', '__repr__', 'has_key', 'get', 'keys',
+               'values', 'items', 'iterkeys', 'itervalues', 'iteritems',
+               'pop', 'popitem', 'setdefault', 'update', 'clear',
+               '__reduce_ex__' ])
+
 _STREAM_TRV_NAME            = 0
 _STREAM_TRV_VERSION         = 1
 _STREAM_TRV_FLAVOR          = 2
@@ -1891,6 +2363,9 @@ class Trove(streams.StreamSet):
         assert(fileId is None or len(fileId) == 20)
         assert(not self.type())
         self.idMap[pathId] = (dirName, baseName, fileId, version)
+        if (len(self.idMap) == COMPACT_FILE_LIST_SIZE and
+                type(self.idMap) is TroveRefsFilesStream):
+            self.idMap = _CompactTroveRefsFilesStream(self.idMap)
 
     def addRpmCapsule(self, path, version, fileId, hdr):
         assert(len(fileId) == 20)
@@ -1988,6 +2463,14 @@ class Trove(streams.StreamSet):
             # capsule, so return everything
             members = True
 
+        if isinstance(self.idMap, _LazyTroveRefsFilesStream):
+            for (theId, path, fileId, version) in self.idMap.iterFiles():
+                if ( (theId != CAPSULE_PATHID and members) or
+                     (theId == CAPSULE_PATHID and capsules) ):
+                    yield (theId, path, fileId, version)
+
+            return
+
         for (theId, (path, base, fileId, version)) in self.idMap.iteritems():
             if ( (theId != CAPSULE_PATHID and members) or
                  (theId == CAPSULE_PATHID and capsules) ):
@@ -2145,9 +2628,21 @@ class Trove(streams.StreamSet):
 
         fileMap = {}
 
-        if not skipFiles:
+        newFiles = trvCs.getNewFileList(raw = True)
+        frozenFiles = None
+        if (not skipFiles and not needNewFileMap and not self.type() and
+                isinstance(newFiles, _LazyReferencedFileList) and
+                not self.idMap and not trvCs.getChangedFileList(raw = True)
+                and not trvCs.getOldFileList()):
+            frozenFiles = newFiles._getFrozen()
+
+        if frozenFiles:
+            # building a trove from an absolute change set; keep the frozen
+            # file list around and decode it only if it's needed
+            self.idMap = _LazyTroveRefsFilesStream(frozenFiles)
+        elif not skipFiles:
             for (pathId, dirName, baseName, fileId, fileVersion) in \
-                            trvCs.getNewFileList(raw = True):
+                            newFiles:
                 self.addRawFile(pathId, dirName, baseName, fileVersion, fileId)
                 if needNewFileMap:
                     fileMap[pathId] = self.idMap[pathId] + \
@@ -3448,46 +3943,73 @@ class ReferencedFileList(list, streams.InfoStream):
 
     def thaw(self, data):
         del self[:]
+        self.extend(_iterFrozenFileList(data))
 
-        # this lastVerStr check bypasses the normal version cache whenever
-        # there are two sequential versions which are the same; this is a
-        # massive speedup for troves with many files (90% or better)
-        lastVerStr = None;
-        lastVer = None
-        i = 0
-        while i < len(data):
-            i, (pathId, path, fileId, verStr) = pack.unpack("!S16SHSHSH", i,
-                                                            data)
-            if not path:
-                dirName = None
-                baseName = None
-            else:
-                dirName, baseName = os.path.split(path)
-                dirName = intern(dirName)
-                baseName = intern(baseName)
+    def __init__(self, data = None):
+        list.__init__(self)
+        if data is not None:
+            self.thaw(data)
 
-            if not fileId:
-                fileId = None
-            else:
-                fileId = intern(fileId)
+class _LazyReferencedFileList(_LazyStream):
 
-            if verStr == lastVerStr:
-                version = lastVer
-            elif verStr:
-                version = versions.VersionFromString(verStr)
-                lastVer = version
-                lastVerStr = verStr
-            else:
-                version = None
+    """
+    The ReferencedFileList of the new files in a trove change set. The
+    frozen form is kept until the list is used, so Trove.applyChangeSet()
+    can build a _LazyTroveRefsFilesStream from it, and freezing it again
+    just returns the original buffer.
+    """
 
-            self.append((pathId, dirName, baseName, fileId,
-                         version))
+    __slots__ = ()
 
     def __init__(self, data = None):
-        list.__init__(self)
+        self._frozen = None
+        self._thawed = ReferencedFileList()
         if data is not None:
             self.thaw(data)
 
+    def _thawContainer(self, data):
+        return ReferencedFileList(data)
+
+    def thaw(self, data):
+        _thawLock.acquire()
+        try:
+            self._frozen = data
+            self._thawed = None
+        finally:
+            _thawLock.release()
+
+    def freeze(self, skipSet = {}):
+        frozen = self._getFrozen()
+        if frozen is None:
+            return self._thawed.freeze()
+
+        return frozen
+
+    def __nonzero__(self):
+        frozen = self._getFrozen()
+        if frozen is None:
+            return bool(self._thawed)
+
+        return bool(frozen)
+
+    def __len__(self):
+        frozen = self._getFrozen()
+        if frozen is None:
+            return len(self._thawed)
+
+        return _countFrozenFileList(frozen)
+
+    def __iadd__(self, other):
+        self._thaw().extend(other)
+        return self
+
+_lazyMethods(_LazyReferencedFileList,
+             [ '__iter__', '__reversed__', '__getitem__', '__getslice__',
+               '__contains__', '__setitem__', '__delitem__', '__setslice__',
+               '__delslice__', '__add__', '__mul__', '__repr__', 'append',
+               'extend', 'insert', 'pop', 'remove', 'index', 'count', 'sort',
+               'reverse', '__reduce_ex__' ])
+
 _STREAM_TCS_NAME                    =  0
 _STREAM_TCS_OLD_VERSION             =  1
 _STREAM_TCS_NEW_VERSION             =  2
@@ -3528,7 +4050,8 @@ class AbstractTroveChangeSet(streams.StreamSet):
                                   (LARGE, ReferencedTroveSet,   "strongTroves"),
         _STREAM_TCS_WEAK_TROVE_CHANGES:
                                   (LARGE, ReferencedTroveSet,   "weakTroves" ),
-        _STREAM_TCS_NEW_FILES   : (LARGE, ReferencedFileList,   "newFiles"   ),
+        _STREAM_TCS_NEW_FILES   : (LARGE, _LazyReferencedFileList,
+                                                        "newFiles"           ),
         _STREAM_TCS_CHG_FILES   : (LARGE, ReferencedFileList,   "changedFiles"),
         _STREAM_TCS_OLD_FLAVOR  : (SMALL, FlavorsStream,        "oldFlavor"  ),
         _STREAM_TCS_NEW_FLAVOR  : (SMALL, FlavorsStream,        "newFlavor"  ),
@@ -17,13 +17,14 @@
 
 import os
 import socket
+import time
 import httplib
 from SimpleHTTPServer import SimpleHTTPRequestHandler
 
 from testrunner import testhelp
 
 from conary_test import rephelp
-from conary.lib import log, util
+from conary.lib import log, sha1helper, util
 from conary.build import lookaside
 
 class LookAsideTest(rephelp.RepositoryHelper):
@@ -642,6 +643,90 @@ class ArchiveTest(PackageRecipe):
         url5 = lookaside.laUrl('lookaside://lp:lightdm/lp:lightdm--466.tar.bz2')
         self.assertEqual(url5.host, 'lp:lightdm')
 
+    def testSha1Index(self):
+        hashed = []
+        origSha1 = sha1helper.sha1FileBin
+        def sha1FileBin(path):
+            hashed.append(path)
+            return origSha1(path)
+        self.mock(sha1helper, 'sha1FileBin', sha1FileBin)
+
+        path = os.path.join(self.workDir, 'foo.tar')
+        self.writeFile(path, 'contents')
+        sha1 = sha1helper.sha1String('contents')
+
+        # recently modified files are hashed every time
+        index = lookaside.Sha1Index(self.workDir)
+        self.assertEqual(index.sha1FileBin(path), sha1)
+        self.assertEqual(index.sha1FileBin(path), sha1)
+        self.assertEqual(len(hashed), 2)
+
+        # from here on, the changes below are long past
+        origTime = lookaside.time.time
+        self.mock(lookaside.time, 'time', lambda: origTime() + 10)
+        self.assertEqual(index.sha1FileBin(path), sha1)
+        self.assertEqual(len(hashed), 3)
+        # the index persists between instances
+        index = lookaside.Sha1Index(self.workDir)
+        self.assertEqual(index.sha1FileBin(path), sha1)
+        self.assertEqual(len(hashed), 3)
+
+        # a changed file is hashed again
+        self.writeFile(path, 'new contents!')
+        self.assertEqual(index.sha1FileBin(path),
+                         sha1helper.sha1String('new contents!'))
+        self.assertEqual(len(hashed), 4)
+
+        # so is one whose inode changed while its mtime and size did not
+        # (ctimes are recorded in seconds)
+        time.sleep(1.1)
+        os.chmod(path, 0600)
+        self.assertEqual(index.sha1FileBin(path),
+                         sha1helper.sha1String('new contents!'))
+        self.assertEqual(len(hashed), 5)
+
+        # entries are appended, and the index is compacted when it is
+        # loaded once half of it is out of date
+        indexPath = os.path.join(self.workDir, '.sha1index')
+        self.assertEqual(len(open(indexPath).readlines()), 3)
+        index = lookaside.Sha1Index(self.workDir)
+        self.assertEqual(index.sha1FileBin(path),
+                         sha1helper.sha1String('new contents!'))
+        self.assertEqual(len(hashed), 5)
+        self.assertEqual(len(open(indexPath).readlines()), 1)
+
+        # entries for files which are gone are dropped
+        os.rename(path, path + '.old')
+        index = lookaside.Sha1Index(self.workDir)
+        self.assertEqual(index.sha1FileBin(path + '.old'),
+                         sha1helper.sha1String('new contents!'))
+        self.assertEqual(index.entries.keys(), [ path + '.old' ])
+        self.assertEqual(len(hashed), 6)
+
+        # damaged indexes are ignored
+        self.writeFile(indexPath, 'garbage\n')
+        index = lookaside.Sha1Index(self.workDir)
+        self.assertEqual(index.sha1FileBin(path + '.old'),
+                         sha1helper.sha1String('new contents!'))
+        self.assertEqual(len(hashed), 7)
+
+        # so are short sha1s and lines torn by an interrupted append,
+        # whether or not another entry was joined to them
+        entry = open(indexPath).read()
+        self.assertEqual(entry.count('\n'), 1)
+        self.writeFile(indexPath, '1 2 3 4 abc %s\n' % (path + '.old')
+                                  + '123 45' + entry + '123 45')
+        index = lookaside.Sha1Index(self.workDir)
+        self.assertEqual(index.sha1FileBin(path + '.old'),
+                         sha1helper.sha1String('new contents!'))
+        self.assertEqual(len(hashed), 8)
+        self.assertEqual(open(indexPath).read().split('\n')[-2:],
+                         [ entry[:-1], '' ])
+        index = lookaside.Sha1Index(self.workDir)
+        self.assertEqual(index.sha1FileBin(path + '.old'),
+                         sha1helper.sha1String('new contents!'))
+        self.assertEqual(len(hashed), 8)
+
 
 def getRequester():
     accessed = {}
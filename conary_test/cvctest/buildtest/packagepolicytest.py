@@ -8097,6 +8097,41 @@ class TestProperties(PackageRecipe):
             trv.troveInfo.properties.freeze())
 
 
+class DependencyPrefetchTest(rephelp.RepositoryHelper):
+
+    def testPrefetchMagic(self):
+        from conary.lib import magic
+        destdir = self.workDir + '/destdir'
+        paths = []
+        for i in range(10):
+            util.mkdirChain(destdir + '/usr/bin')
+            paths.append('/usr/bin/ls%d' % i)
+            util.copyfile('/bin/ls', destdir + paths[-1], verbose=False)
+            paths.append('/usr/bin/script%d' % i)
+            self.writeFile(destdir + paths[-1], '#!/bin/sh\n')
+        paths.sort()
+
+        recipe = mock.MockObject()
+        recipe.autopkg.pathMap = dict.fromkeys(paths)
+        recipe.magic = magic.magicCache(destdir)
+        class Dependency(packagepolicy._dependency):
+            magicPrefetchMinimum = 2
+            magicPrefetchChunk = 3
+            def __init__(self, recipe):
+                self.recipe = recipe
+            def _pathAllowed(self, path):
+                return path != '/usr/bin/ls0'
+
+        self.mock(packagepolicy._dependency, '_parallelJobs',
+                  staticmethod(lambda: 2))
+        Dependency(recipe)._prefetchMagic()
+        self.assertEqual(sorted(recipe.magic), paths[1:])
+        for path in paths[1:]:
+            m = magic.magic(path, destdir)
+            self.assertEqual(recipe.magic[path].__class__, m.__class__)
+            self.assertEqual(recipe.magic[path].contents, m.contents)
+
+
 def _findVendorPerl(_cached=[]):
     """Return the first vendor_perl directory for the system interpreter"""
     if not _cached:
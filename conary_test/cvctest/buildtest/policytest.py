@@ -18,6 +18,7 @@
 import os
 import tempfile
 import shutil
+import time
 
 from conary.build import recipe, policy, macros, buildinfo, lookaside
 from conary_test import rephelp
@@ -94,3 +95,62 @@ class PolicyTest(rephelp.RepositoryHelper):
         assert(p2.invariantsubtrees == [ '/blah' ])
         p2.doProcess(r)
         assert(sorted(p2.traversed) == ['/foo-1/file-1', '/foo-2/file-2'])
+
+    def testTreeIndex(self):
+        top = self.workDir + '/tree'
+        for d in ('a', 'a/b', 'c'):
+            os.makedirs(os.path.join(top, d))
+        for f in ('a/1', 'a/b/2', 'c/3'):
+            open(os.path.join(top, f), 'w').close()
+        os.symlink('a', top + '/link')
+
+        def walk(walker):
+            found = []
+            def visit(arg, dirname, names):
+                found.extend(os.path.join(dirname, x)[len(top):]
+                             for x in names)
+            walker(top, visit, None)
+            return sorted(found)
+
+        def age():
+            past = time.time() - 10
+            for dirname in ('', '/a', '/a/b', '/c'):
+                os.utime(top + dirname, (past, past))
+
+        index = policy.TreeIndex()
+        expected = walk(os.path.walk)
+        # freshly changed directories can't be trusted, so aren't kept
+        self.assertEqual(walk(index.walk), expected)
+        self.assertEqual(index.dirs, {})
+        age()
+        self.assertEqual(walk(index.walk), expected)
+        self.assertEqual(sorted(index.dirs), [top, top + '/a', top + '/a/b',
+                                              top + '/c'])
+        self.assertEqual(walk(index.walk), expected)
+        self.assertEqual(sorted(index.listdir(top + '/a')), ['1', 'b'])
+        self.assertEqual(index.listdir(top + '/a/1'), None)
+
+        # changes are noticed through the directory mtimes
+        os.unlink(top + '/a/1')
+        os.mkdir(top + '/c/d')
+        open(top + '/c/d/4', 'w').close()
+        age()
+        expected = walk(os.path.walk)
+        self.assertEqual(walk(index.walk), expected)
+        self.assertEqual(expected, ['/a', '/a/b', '/a/b/2', '/c', '/c/3',
+                                    '/c/d', '/c/d/4', '/link'])
+
+        # directories created while walking are walked as well
+        def create(arg, dirname, names):
+            if dirname == top + '/a':
+                os.mkdir(dirname + '/new')
+                open(dirname + '/new/5', 'w').close()
+                names.append('new')
+            arg.extend(os.path.join(dirname, x)[len(top):] for x in names)
+        for walker in (os.path.walk, index.walk):
+            age()
+            walk(index.walk)
+            found = []
+            walker(top, create, found)
+            self.assertTrue('/a/new/5' in found)
+            shutil.rmtree(top + '/a/new')
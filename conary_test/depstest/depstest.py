@@ -40,6 +40,9 @@ from conary.deps.deps import (
         FLAG_SENSE_PREFERRED,
         getShortFlavorDescriptors,
         dependencyCache,
+        scoreCache,
+        strongScoreCache,
+        FlavorMatcher,
         Flavor,
         DependencyClass,
         AbiDependency,
@@ -691,6 +694,61 @@ class DepsTest(unittest.TestCase):
         _testDep('trove: foo(a)', 'trove: foo(a)', 3)
         _testDep('trove: foo(a) trove: bar(a)', 'trove: foo(a) trove: bar(a)', 6)
 
+    def testScoreCache(self):
+        scoreCache.clear()
+        strongScoreCache.clear()
+
+        a = ThawFlavor(parseFlavor('is: x86').freeze())
+        b = ThawFlavor(parseFlavor('is: x86 x86_64').freeze())
+        self.assertEqual(b.score(a), 1)
+        self.assertEqual(a.score(b), False)
+        self.assertEqual(scoreCache[(b.freeze(), a.freeze())], 1)
+
+        # flavors which have been scored before aren't thawed again
+        a = ThawFlavor(a.freeze())
+        b = ThawFlavor(b.freeze())
+        self.assertEqual(b.score(a), 1)
+        self.assertEqual(a.score(b), False)
+        self.assertEqual(type(a._members), str)
+        self.assertEqual(type(b._members), str)
+        self.assertEqual(b.stronglySatisfies(a), True)
+        self.assertEqual(a.stronglySatisfies(b), False)
+
+        # changes invalidate the cached frozen form
+        b = parseFlavor('is: x86 x86_64')
+        frozen = b.freeze()
+        b.removeDeps(InstructionSetDependency, [ Dependency('x86_64') ])
+        self.assertNotEqual(b.freeze(), frozen)
+        self.assertEqual(b.freeze(), a.freeze())
+        self.assertEqual(a.score(b), 1)
+        b.union(parseFlavor('is: x86(mmx)'))
+        self.assertEqual(a.score(b), False)
+        self.assertEqual(b.score(a), 1)
+
+    def testFlavorMatcher(self):
+        candidates = [ parseFlavor(x) for x in
+                       ('', 'is: x86', 'is: x86_64', 'is: x86 x86_64',
+                        'is: x86(i686)', 'ssl is: x86', '!ssl is: x86',
+                        '~ssl,~!gtk is: x86_64', 'gtk,krb is: x86(i686,mmx)',
+                        'ssl,~!krb') ]
+        for flavorStr in ('', 'is: x86', 'is: x86_64', 'ssl is: x86',
+                          '~!ssl,~gtk is: x86(~i686) x86_64',
+                          '!ssl', '~ssl,~!gtk is: x86_64'):
+            flavor = parseFlavor(flavorStr)
+            matcher = FlavorMatcher(flavor)
+            self.assertEqual(matcher.scoreRequirements(candidates),
+                             [ flavor.score(x) for x in candidates ])
+            self.assertEqual(matcher.scoreProviders(candidates),
+                             [ x.score(flavor) for x in candidates ])
+            self.assertEqual(matcher.scoreProviders(candidates, strong=True),
+                             [ x.toStrongFlavor().score(flavor)
+                               for x in candidates ])
+
+        matcher = FlavorMatcher(parseFlavor('is: x86'))
+        self.assertEqual(matcher.scoreRequirements(
+                                [ parseFlavor('is: x86 x86_64') ]), [False])
+        self.assertEqual(matcher.scoreProviders(
+                                [ parseFlavor('is: x86 x86_64') ]), [1])
 
 
     def testParseDependencies(self):
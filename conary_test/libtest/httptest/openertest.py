@@ -18,14 +18,18 @@
 from testrunner import testhelp
 
 import errno
+import httplib
 import logging
 import socket
+import StringIO
 from conary.lib import log
 from conary.lib import timeutil
 from conary.lib import util
 from conary.lib.compat import namedtuple
+from conary.lib.http import connection as conn_mod
 from conary.lib.http import http_error
 from conary.lib.http import opener as opener_mod
+from conary.lib.http import request as req_mod
 
 
 class OpenerTest(testhelp.TestCase):
@@ -116,6 +120,144 @@ class OpenerTest(testhelp.TestCase):
         err = self.assertRaises(socket.error, opener.open, 'http://nowhere./')
         self.assertEqual(err.args[0], errno.ECONNRESET)
 
+    def testConnectionPool(self):
+        """Persistent openers share connections through a pool."""
+        made = []
+        class MockConnection(object):
+            busy = False
+            def __init__(self, *args, **kwargs):
+                made.append(self)
+            def request(self, req):
+                self.headers = dict(req.headers.iteritems())
+                return MockResponse.OK
+            def close(self):
+                self.closed = True
+        pool = conn_mod.ConnectionPool(maxPerHost=2)
+        opener1 = opener_mod.URLOpener(persist=True, connectionPool=pool)
+        opener1.connectionFactory = MockConnection
+        opener2 = opener_mod.URLOpener(persist=True, connectionPool=pool)
+        opener2.connectionFactory = MockConnection
+
+        # A connection is reused by any opener once it is released
+        opener1.open('http://nowhere./')
+        made[0].busy = False
+        opener2.open('http://nowhere./foo')
+        self.assertEqual(len(made), 1)
+        self.assertEqual(made[0].headers.get('Connection'), None)
+
+        # Busy connections aren't shared, and past the limit requests get a
+        # connection of their own which isn't kept alive
+        opener1.open('http://nowhere./')
+        opener1.open('http://nowhere./')
+        self.assertEqual(len(made), 3)
+        self.assertEqual(made[1].headers.get('Connection'), None)
+        self.assertEqual(made[2].headers.get('Connection'), 'close')
+        self.assertEqual(len(pool.connections.values()[0]), 2)
+
+        # Other servers get their own connections
+        opener1.open('http://elsewhere./')
+        self.assertEqual(len(made), 4)
+
+        # Closing an opener closes the idle connections it used
+        made[1].busy = False
+        opener2.close()
+        self.assertEqual(made[1].closed, True)
+        self.assertEqual(sorted(len(x) for x in pool.connections.values()),
+                [1, 1])
+
+    def testBadStatusLine(self):
+        """Opener only resends requests which are safe to repeat when the
+        server closes the connection without answering."""
+        self.mock(timeutil.BackoffTimer, 'sleep', lambda self: None)
+        sent = []
+        class MockConnection(object):
+            def __init__(self, *args, **kwargs):
+                pass
+            def request(self, req):
+                sent.append(req.method)
+                if len(sent) == 1:
+                    raise httplib.BadStatusLine('')
+                return MockResponse.OK
+        opener = opener_mod.URLOpener()
+        opener.connectionFactory = MockConnection
+
+        opener.open('http://nowhere./')
+        self.assertEqual(sent, ['GET', 'GET'])
+
+        del sent[:]
+        self.assertRaises(httplib.BadStatusLine, opener.open,
+                'http://nowhere./', data='foo')
+        self.assertEqual(sent, ['POST'])
+
+    def testReusedConnection(self):
+        """A kept-alive connection which the server closed without answering
+        is only replaced for requests which are safe to repeat."""
+        opened = []
+        class MockHTTPConnection(object):
+            def __init__(self):
+                opened.append(self)
+                self.closed = False
+            def close(self):
+                self.closed = True
+        def requestOnce(conn, req):
+            if conn is opened[0] and len(opened) == 1:
+                raise httplib.BadStatusLine('')
+            return MockTrackedResponse()
+        class MockTrackedResponse(object):
+            will_close = False
+            def isclosed(self):
+                return True
+        url = req_mod.URL.parse('http://nowhere./')
+        for method, expected in (('GET', 2), ('POST', 1)):
+            del opened[:]
+            conn = conn_mod.Connection(url)
+            conn.cached = MockHTTPConnection()
+            conn.busy = True
+            conn._isStale = lambda conn: False
+            conn.requestOnce = requestOnce
+            conn.openConnection = MockHTTPConnection
+            req = req_mod.Request(url, method=method)
+            if method == 'GET':
+                conn.request(req)
+                self.assertEqual(conn.cached, opened[1])
+            else:
+                self.assertRaises(httplib.BadStatusLine, conn.request, req)
+                self.assertEqual(conn.cached, None)
+            self.assertEqual(len(opened), expected)
+            self.assertEqual(opened[0].closed, True)
+            self.assertEqual(conn.busy, False)
+
+    def testAbandonedResponse(self):
+        """A response dropped before it is read to the end retires its
+        connection."""
+        class MockSocket(object):
+            def makefile(self, *args):
+                return StringIO.StringIO('HTTP/1.1 200 OK\r\n'
+                        'Content-Length: 6\r\n\r\nfoobar')
+        finished = []
+        def getResponse():
+            response = conn_mod.TrackedResponse(MockSocket())
+            response.begin()
+            response.onFinish = finished.append
+            return response
+
+        # Reading everything releases the connection for reuse
+        response = getResponse()
+        wrapper = opener_mod.ResponseWrapper(response, response)
+        response.setOwner(wrapper)
+        self.assertEqual(response.read(), 'foobar')
+        del wrapper
+        self.assertEqual(finished, [True])
+
+        # Dropping the wrapper half way through does not
+        del finished[:]
+        response = getResponse()
+        wrapper = opener_mod.ResponseWrapper(response, response)
+        response.setOwner(wrapper)
+        self.assertEqual(wrapper.read(3), 'foo')
+        del wrapper
+        self.assertEqual(finished, [False])
+
 
 class MockResponse(namedtuple('MockResponse', 'status reason')):
     msg = read = None
@@ -208,6 +208,80 @@ class Database(testhelp.TestCase):
         finally:
             shutil.rmtree(d)
 
+    def testRollbackContentsStore(self):
+        from conary.local.journal import NoopJobJournal
+        from conary.repository import changeset, filecontents
+        d = tempfile.mkdtemp()
+        try:
+            rbDir = d + '/rollbacks'
+            stack = database.RollbackStack(rbDir, d, None, None)
+            cfgId = md5FromString("00010001000100010001000100010003")
+            otherId = md5FromString("00010001000100010001000100010004")
+            fileId = '1' * 20
+            contents = 'contents ' * 100
+
+            for i in range(2):
+                cs = changeset.ChangeSet()
+                cs.addFileContents(self.id1, fileId,
+                                   changeset.ChangedFileTypes.file,
+                                   filecontents.FromString(contents), False)
+                cs.addFileContents(cfgId, fileId,
+                                   changeset.ChangedFileTypes.file,
+                                   filecontents.FromString('config\n'), True)
+                rb = stack.new()
+                rb.add(NoopJobJournal(), cs, changeset.ChangeSet(), None)
+
+            # the regular contents are only stored once, and aren't in
+            # the changesets
+            shared = os.listdir(rbDir + '/contents')
+            self.assertEqual(len(shared), 1)
+            self.assertEqual(os.stat(rbDir + '/contents/' +
+                                     shared[0]).st_nlink, 3)
+            self.assertTrue(os.stat(rbDir + '/1/repos.0').st_size < 500)
+
+            reposCs, localCs = stack.getRollback('r.1').getLast()
+            tag, cont = reposCs.getFileContents(self.id1, fileId)
+            self.assertEqual(tag, changeset.ChangedFileTypes.file)
+            self.assertEqual(cont.get().read(), contents)
+            tag, cont = reposCs.getFileContents(cfgId, fileId)
+            self.assertEqual(cont.get().read(), 'config\n')
+
+            # rewriting the rollback changeset includes the contents again
+            reposCs.reset()
+            reposCs.writeToFile(d + '/full.ccs')
+            fullCs = changeset.ChangeSetFromFile(d + '/full.ccs')
+            tag, cont = fullCs.getFileContents(self.id1, fileId)
+            self.assertEqual(cont.get().read(), contents)
+
+            # removing the last changeset from a rollback only drops the
+            # contents which the rest of the rollback doesn't reference
+            rb = stack.getRollback('r.1')
+            cs = changeset.ChangeSet()
+            cs.addFileContents(self.id2, fileId,
+                               changeset.ChangedFileTypes.file,
+                               filecontents.FromString(contents), False)
+            cs.addFileContents(otherId, fileId,
+                               changeset.ChangedFileTypes.file,
+                               filecontents.FromString('other ' * 100), False)
+            rb.add(NoopJobJournal(), cs, changeset.ChangeSet(), None)
+            self.assertEqual(len(os.listdir(rbDir + '/contents')), 2)
+            self.assertEqual(len(os.listdir(rbDir + '/1/contents')), 2)
+            rb.removeLast()
+            self.assertEqual(os.listdir(rbDir + '/contents'), shared)
+            self.assertEqual(os.listdir(rbDir + '/1/contents'), shared)
+            self.assertEqual(os.stat(rbDir + '/contents/' +
+                                     shared[0]).st_nlink, 3)
+
+            stack.removeFirst()
+            self.assertEqual(os.stat(rbDir + '/contents/' +
+                                     shared[0]).st_nlink, 2)
+            stack.getRollback('r.1').removeLast()
+            self.assertEqual(os.listdir(rbDir + '/contents'), [])
+            stack.removeLast()
+            self.assertFalse(os.path.exists(rbDir + '/1'))
+        finally:
+            shutil.rmtree(d)
+
     def testGetCapsulesTroveList(self):
         # make sure that getCapsulesTroveList is at least not removed...
         from conary.lib import util
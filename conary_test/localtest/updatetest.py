@@ -18,17 +18,19 @@
 from testrunner import testhelp
 from conary_test import rephelp
 
+import gzip
 import itertools
 import os
 import signal
 import shutil
+import StringIO
 
-from conary import conaryclient, errors, trove, versions
+from conary import conaryclient, errors, files, trove, versions
 from conary.build import tags
 from conary.conaryclient import filetypes
 from conary.deps import deps
-from conary.repository import changeset, filecontainer
-from conary.lib import util, log
+from conary.repository import changeset, filecontainer, filecontents
+from conary.lib import sha1helper, util, log
 from conary.local import database, update
 
 import conary_test
@@ -1686,3 +1688,108 @@ foo:*:1234:1234::/:/sbin/nologin
         self.updatePkg('usrmove:runtime=1.0', raiseError=True)
         self.updatePkg('usrmove:runtime=2.0', raiseError=True)
         self.assertEqual(open(os.path.join(self.rootDir, 'usr/sbin/usrmove')).read(), '2.0')
+
+    def testParallelRestore(self):
+        class Journal(object):
+            def __init__(self):
+                self.log = []
+            def backup(self, path):
+                self.log.append(('backup', path))
+            def create(self, path):
+                self.log.append(('create', path))
+
+        contentsPath = self.workDir + '/contents'
+        contentsFile = util.ExtendedFile(contentsPath, 'w+', buffering = False)
+        items = []
+        for i, (path, contents) in enumerate(
+                    [ ('/a/1', 'one'), ('/b/2', 'two'), ('/a/3', 'three'),
+                      ('/c/4', 'four' * 1000) ]):
+            fileObj = files.RegularFile(None)
+            fileObj.inode.perms.set(0644)
+            fileObj.inode.mtime.set(100 + i)
+            fileObj.inode.owner.set('root')
+            fileObj.inode.group.set('root')
+            fileObj.contents = files.RegularFileStream()
+            fileObj.contents.size.set(len(contents))
+            fileObj.contents.sha1.set(sha1helper.sha1String(contents))
+            fileObj.flags.set(0)
+            sio = StringIO.StringIO()
+            gz = gzip.GzipFile(None, 'w', fileobj = sio)
+            gz.write(contents)
+            gz.close()
+            compressed = sio.getvalue()
+            start = contentsFile.tell()
+            contentsFile.write(compressed)
+            fileContents = filecontents.FromFile(
+                util.SeekableNestedFile(contentsFile, len(compressed), start),
+                compressed = True)
+            items.append((self.rootDir + path, fileObj, fileContents,
+                          contents))
+
+        def restoreAll(items, threads):
+            opJournal = Journal()
+            restorer = update.ParallelRestore(threads)
+            try:
+                for target, fileObj, fileContents, contents in items:
+                    def finish(prepared, fileObj = fileObj, target = target):
+                        update.FilesystemJob.restoreFile(fileObj, None,
+                            self.rootDir, target, None, opJournal, True,
+                            prepared = prepared)
+                    srcInfo = restorer.canRestore(fileObj, fileContents)
+                    assert(srcInfo)
+                    restorer.add(srcInfo, target, finish)
+                restorer.flush()
+            finally:
+                restorer.close()
+            return opJournal.log
+
+        # the journal is written in the order the files were added, no
+        # matter which worker finishes first
+        log = restoreAll(items, 3)
+        self.assertEqual(log, [ (x, items[i / 2][0]) for i, x in
+                    enumerate(['backup', 'create'] * len(items)) ])
+        for target, fileObj, fileContents, contents in items:
+            self.assertEqual(open(target).read(), contents)
+            self.assertEqual(os.stat(target).st_mtime,
+                             fileObj.inode.mtime())
+
+        # no workers means nothing is restored in parallel
+        restorer = update.ParallelRestore(0)
+        assert(not restorer.canRestore(items[0][1], items[0][2]))
+        restorer.close()
+
+        # bad contents are reported when the file is finished, and the
+        # temporary files left behind are cleaned up
+        items[1][1].contents.sha1.set('0' * 20)
+        util.rmtree(self.rootDir + '/a')
+        util.rmtree(self.rootDir + '/b')
+        self.assertRaises(files.Sha1Exception, restoreAll, items, 2)
+        self.assertEqual(os.listdir(self.rootDir + '/a'), [ '1' ])
+        self.assertEqual(os.listdir(self.rootDir + '/b'), [ '2' ])
+
+    def testParallelRestoreUpdate(self):
+        self.cfg.parallelRestore = True
+        try:
+            self.addComponent('foo:runtime', '1.0',
+                fileContents = [
+                    ( '/a', rephelp.RegularFile(contents = "a",
+                                                pathId = "1") ),
+                    ( '/b', rephelp.RegularFile(contents = "a",
+                                                pathId = "2") ),
+                    ( '/c', rephelp.RegularFile(contents = "c",
+                                                pathId = "3",
+                                                linkGroup = "\1" * 16) ),
+                    ( '/d', rephelp.RegularFile(contents = "c",
+                                                pathId = "4",
+                                                linkGroup = "\1" * 16) ),
+                    ( '/etc/e', rephelp.RegularFile(contents = "e\n",
+                                                    pathId = "5") ) ])
+            self.updatePkg('foo:runtime', raiseError = True)
+        finally:
+            self.cfg.parallelRestore = False
+
+        for path, contents in [ ('/a', 'a'), ('/b', 'a'), ('/c', 'c'),
+                                ('/d', 'c'), ('/etc/e', 'e\n') ]:
+            self.assertEqual(open(self.rootDir + path).read(), contents)
+        assert(os.stat(self.rootDir + '/c').st_ino ==
+               os.stat(self.rootDir + '/d').st_ino)
@@ -210,6 +210,91 @@ class ChangesetTest(rephelp.RepositoryHelper):
         cs3.reset()
         assert(cs3.writeToFile('foo.ccs') == 129)
 
+    def testChangeSetIndex(self):
+        os.chdir(self.workDir)
+
+        cs = changeset.ChangeSet()
+        fileId = '0' * 20
+        pathIds = [ str(i) * 16 for i in range(5) ]
+        for pathId in pathIds:
+            cs.addFileContents(pathId, fileId, changeset.ChangedFileTypes.file,
+                               filecontents.FromString(pathId), False)
+        size = cs.writeToFile('foo.ccs', withIndex = True)
+        assert(size == os.stat('foo.ccs').st_size)
+
+        cs = changeset.ChangeSetFromFile('foo.ccs')
+        assert(cs.fileContainers[0].hasIndex())
+        # out of order lookups don't consume the sequential queue
+        for pathId in reversed(pathIds):
+            contType, contents = cs.getFileContents(pathId, fileId)
+            assert(contType == changeset.ChangedFileTypes.file)
+            assert(contents.get().read() == pathId)
+        contType, contents = cs.getFileContents(pathIds[0], fileId,
+                                                compressed = True)
+        assert(util.decompressString(contents.get().read()) == pathIds[0])
+        self.assertRaises(KeyError, cs.getFileContents, 'x' * 16, fileId)
+
+        # rewriting the changeset drops the old index
+        cs.reset()
+        cs.writeToFile('bar.ccs')
+        cs = changeset.ChangeSetFromFile('bar.ccs')
+        assert(not cs.fileContainers[0].hasIndex())
+        contType, contents = cs.getFileContents(pathIds[3], fileId)
+        assert(contents.get().read() == pathIds[3])
+
+    def testParallelCompression(self):
+        os.chdir(self.workDir)
+
+        cs = changeset.ChangeSet()
+        fileId = '0' * 20
+        pathIds = [ '%016d' % i for i in range(20) ]
+        for i, pathId in enumerate(pathIds):
+            self.writeFile(pathId, os.urandom(i * 1000) + 'x' * i * 10000)
+            cs.addFileContents(pathId, fileId, changeset.ChangedFileTypes.file,
+                               filecontents.FromFilesystem(pathId), i % 4 == 0)
+        cs.addFileContents('d' * 16, fileId, changeset.ChangedFileTypes.diff,
+                           filecontents.FromString('diff'), False)
+
+        cs.writeToFile('serial.ccs')
+        cs.compressionJobs = 3
+        cs.writeToFile('parallel.ccs')
+        # compressing ahead of the writer doesn't change the changeset
+        self.assertEqual(open('serial.ccs').read(),
+                         open('parallel.ccs').read())
+
+        cs = changeset.ChangeSetFromFile('parallel.ccs')
+        for pathId in pathIds:
+            contType, contents = cs.getFileContents(pathId, fileId)
+            self.assertEqual(contents.get().read(), open(pathId).read())
+
+    def testFrozenTroves(self):
+        # troves added frozen write out exactly the same changeset
+        os.chdir(self.workDir)
+        v = versions.VersionFromString('/localhost@rpl:devel/1.0-1-1',
+                                       timeStamps = [1.000])
+        flavor = deps.parseFlavor('is: x86')
+        pathId = '1' * 16
+        fileId = '2' * 20
+
+        t = trove.Trove('test:runtime', v, flavor, None)
+        t.addFile(pathId, '/foo', v, fileId)
+        trvCs = t.diff(None, absolute = True)[0]
+
+        sizes = []
+        for frozen in (False, True):
+            cs = changeset.ChangeSet()
+            cs.newTrove(trvCs, frozen = frozen)
+            cs.addPrimaryTrove('test:runtime', v, flavor)
+            assert(cs.isAbsolute())
+            sizes.append(cs.writeToFile('%s.ccs' % frozen))
+
+        assert(sizes[0] == sizes[1])
+        assert(open('False.ccs').read() == open('True.ccs').read())
+
+        cs = changeset.ChangeSetFromFile('True.ccs')
+        newTrv = trove.Trove(cs.getNewTroveVersion('test:runtime', v, flavor))
+        assert(newTrv == t)
+
     def testChangeSetFilter(self):
         def addFirst():
             return self.addComponent('first:run')
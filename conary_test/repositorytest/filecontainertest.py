@@ -188,5 +188,50 @@ class FilecontainerTest(unittest.TestCase):
         s = f.read()
         assert(s == 'endcontents')
 
+    def testIndex(self):
+        names = [ "file1", "file2", "" ]
+        data = [ "contents of file1", "file2 gets some contents", "" ]
+        tags = [ "extra data", "tag", "empty" ]
+
+        f = util.ExtendedFile(self.fn, "w+", buffering = False)
+        c = FileContainer(f, index = True)
+        for name, contents, tag in zip(names, data, tags):
+            c.addFile(name, FromString(contents), tag)
+        c.writeIndex()
+        c.close()
+
+        c = FileContainer(util.ExtendedFile(self.fn, 'r', buffering = False))
+        assert(c.hasIndex())
+        # the sequential path skips the index itself
+        checkFiles(c, names, data, tags)
+
+        # look files up out of order; this doesn't move getNextFile()
+        c.reset()
+        for i in (2, 0, 1):
+            name, tag, subfile = c.getFile(names[i])
+            assert(name == names[i])
+            assert(tag == tags[i])
+            s = gzip.GzipFile(None, "r", fileobj = subfile).read()
+            assert(s == data[i])
+        self.assertRaises(KeyError, c.getFile, "missing")
+        checkFiles(c, names, data, tags)
+
+        # dumpIter passes the index through so the sizes match
+        c.reset()
+        dumped = ''.join(c.dumpIter(
+                    lambda name, tag, size, subfile: (tag, size, subfile)))
+        assert(dumped == open(self.fn).read())
+
+        # containers without an index fall back to sequential reads
+        os.unlink(self.fn)
+        f = util.ExtendedFile(self.fn, "w+", buffering = False)
+        c = FileContainer(f)
+        c.addFile(names[0], FromString(data[0]), tags[0])
+        c.close()
+
+        c = FileContainer(util.ExtendedFile(self.fn, 'r', buffering = False))
+        assert(not c.hasIndex())
+        checkFiles(c, names[0:1], data[0:1], tags[0:1])
+
     def tearDown(self):
         os.unlink(self.fn)
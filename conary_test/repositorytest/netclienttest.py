@@ -827,6 +827,36 @@ class NetclientTest(rephelp.RepositoryHelper):
         assert did_truncate[0]
         self.assertEqual(open(clean).read(), open(retry).read())
 
+    def testParallelChangesetDownload(self):
+        self.openRepository()
+        self.openRepository(1)
+        trv1 = self.addComponent('foo:runtime',
+                                 '/localhost@rpl:linux/1-1-1')
+        trv2 = self.addComponent('bar:runtime',
+                                 '/localhost1@rpl:linux/1-1-1')
+        job = [ trv1.getNameVersionFlavor().asJob(),
+                trv2.getNameVersionFlavor().asJob() ]
+
+        repos = self.openRepository()
+        self.cfg.downloadThreads = 1
+        serial = os.path.join(self.workDir, 'serial.ccs')
+        repos.createChangeSetFile(job, serial)
+
+        self.cfg.downloadThreads = 2
+        parallel = os.path.join(self.workDir, 'parallel.ccs')
+        repos.createChangeSetFile(job, parallel)
+        self.cfg.resetToDefault('downloadThreads')
+
+        def _troves(path):
+            cs = changeset.ChangeSetFromFile(path)
+            return sorted(x.getNewNameVersionFlavor()
+                          for x in cs.iterNewTroveList())
+
+        self.assertEqual(_troves(serial), _troves(parallel))
+        self.assertEqual(_troves(parallel),
+                sorted([ trv1.getNameVersionFlavor(),
+                         trv2.getNameVersionFlavor() ]))
+
 
 class ServerProxyTest(rephelp.RepositoryHelper):
     def testBadProtocol(self):
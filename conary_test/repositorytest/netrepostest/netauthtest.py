@@ -242,6 +242,62 @@ class NetAuthTest(dbstoretest.DBStoreTestBase):
         assert(na.check(authToken) != True)
         assert(na.check(authToken2) != False)
 
+    def testAuthCache(self):
+        db = self._setupDB()
+        na = netauth.NetworkAuthorization(db, ["conary.rpath.com"],
+                                          cacheTimeout = 60)
+        na._invalidateCaches()
+        self.addCleanup(na._invalidateCaches)
+
+        self._addUserRole(na, "testuser", "testpass")
+        na.addAcl("testuser", "foo:.*", "conary.rpath.com@rpl:linux",
+                  write = True)
+        authToken = ("testuser", "testpass", [], None)
+        badToken = ("testuser", "badpass", [], None)
+        label = versions.Label("conary.rpath.com@rpl:linux")
+        otherLabel = versions.Label("conary.rpath.com@rpl:devel")
+
+        assert(na.check(authToken, write = True, label = label,
+                        trove = "foo:runtime"))
+        assert(not na.check(authToken, write = True, label = otherLabel,
+                            trove = "foo:runtime"))
+        assert(not na.check(authToken, label = label, trove = "bar:runtime"))
+        assert(not na.check(authToken, remove = True, label = label))
+        assert(not na.check(badToken, label = label, trove = "foo:runtime"))
+        v = versions.VersionFromString("/conary.rpath.com@rpl:linux/1-1")
+        self.assertEqual(na.commitCheck(authToken,
+                                        [ ("foo:runtime", v),
+                                          ("bar:runtime", v) ]),
+                         [ True, False ])
+
+        # changes made behind our back are not seen until the cached
+        # entries time out
+        cu = db.cursor()
+        cu.execute("DELETE FROM Permissions")
+        db.commit()
+        assert(na.check(authToken, write = True, label = label,
+                        trove = "foo:runtime"))
+
+        # but changes made through this object are
+        na.addAcl("testuser", "bar:.*", None)
+        assert(not na.check(authToken, write = True, label = label,
+                            trove = "foo:runtime"))
+        assert(na.check(authToken, label = otherLabel, trove = "bar:runtime"))
+
+        # another repository in the same process has caches of its own
+        otherDb = self.getDB("other")
+        schema.createSchema(otherDb)
+        schema.setupTempTables(otherDb)
+        otherNa = netauth.NetworkAuthorization(otherDb, ["conary.rpath.com"],
+                                               cacheTimeout = 60)
+        self._addUserRole(otherNa, "testuser", "testpass")
+        assert(na.check(authToken, label = otherLabel, trove = "bar:runtime"))
+        assert(not otherNa.check(authToken, label = otherLabel,
+                                 trove = "bar:runtime"))
+
+        na.changePassword("testuser", "newpass")
+        assert(not na.check(authToken, label = label, trove = "bar:runtime"))
+
     def testNetAuthQueries(self):
         db = self._setupDB()
         na = netauth.NetworkAuthorization(db, "conary.rpath.com")
@@ -837,6 +837,23 @@ class NetServerTest(rephelp.RepositoryHelper):
                 False, False)
         self.assertNotEqual(fpList2, fpList)
 
+    def testRemovedTroveFingerprints(self):
+        # changesets cached by fingerprint can't be reused once the trove
+        # (or a trove included in the group) has been removed, even for
+        # troves without signatures or metadata
+        repos = self.openRepository()
+        trv = self.addComponent('foo:runtime', '1')
+        grp = self.addCollection('group-foo', '1', [ 'foo:runtime' ])
+        chL = [ (x.getName(), (None, None),
+                 (x.getVersion(), x.getFlavor()), True) for x in (trv, grp) ]
+        fpList = repos.getChangeSetFingerprints(chL, True, True, True,
+                False, False)
+        self.markRemoved('foo:runtime')
+        fpList2 = repos.getChangeSetFingerprints(chL, True, True, True,
+                False, False)
+        self.assertNotEqual(fpList2[0], fpList[0])
+        self.assertNotEqual(fpList2[1], fpList[1])
+
     def testCreateChangesetOptimizations(self):
         # ensure that if you call createChangeSet on a trove with
         # distributed file contents, the client doesn't have to
@@ -1525,3 +1542,20 @@ foo:runtime
                     resumeOffset=offset)
             actual = rc[0].read()
             self.assertEqual(actual, expected[offset:])
+
+    def testTroveListFilters(self):
+        # several trove names and flavors go through the tmpGTVL and
+        # tmpFlavorMap filter tables
+        repos = self.openRepository()
+        label = versions.Label('localhost@rpl:linux')
+        self.addComponent('foo:runtime', '1.0', flavor = 'is: x86')
+        self.addComponent('foo:runtime', '1.0', flavor = 'is: x86_64')
+        self.addComponent('bar:runtime', '1.0', flavor = 'is: x86')
+        x86 = deps.parseFlavor('is: x86')
+        for name in ('foo:runtime', 'bar:runtime'):
+            d = repos.getTroveLeavesByLabel(
+                    { name : { label : [ x86 ] },
+                      'baz:runtime' : { label : None } }, bestFlavor = True)
+            self.assertEqual(d.keys(), [ name ])
+            self.assertEqual([ str(x) for x in d[name].values()[0] ],
+                             [ 'is: x86' ])
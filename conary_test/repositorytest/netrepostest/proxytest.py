@@ -20,13 +20,15 @@ from testutils import mock
 from testutils.servers import memcache_server
 import copy
 import os
+import StringIO
+import time
 
 from conary_test import rephelp
 
 from conary import conaryclient
 from conary import trove
 from conary.files import ThawFile
-from conary.repository import errors
+from conary.repository import changeset, errors, filecontents
 from conary.repository.netrepos import proxy as netreposproxy
 from conary.repository.netrepos import netserver
 from conary.repository.netrepos.auth_tokens import AuthToken
@@ -181,6 +183,198 @@ class ProxyUnitTest(testcase.TestCaseWithWorkDir):
         # We're not releasing locks we didn't close
         self.assertEqual(len(contents), 2 * len(fingerprints))
 
+    def testChangesetCacheLimit(self):
+        cacheDir = os.path.join(self.workDir, "changesetCache")
+        os.mkdir(cacheDir)
+        dataStore = netreposproxy.datastore.ShallowDataStore(cacheDir)
+        # a changeset which was cached before the limit was turned on
+        oldPath = dataStore.hashToPath('f' * 40 + '-2007022001.1')
+        os.makedirs(os.path.dirname(oldPath))
+        file(oldPath, "w").write("x" * 50)
+
+        now = [ int(time.time()) ]
+        os.utime(oldPath, (now[0] - 1000, now[0] - 1000))
+        self.mock(netreposproxy.time, 'time', lambda: now[0])
+        counters = {}
+        def pokeCounter(name, delta):
+            counters[name] = counters.get(name, 0) + delta
+
+        csCache = netreposproxy.ChangesetCache(dataStore, sizeLimit = 700,
+            pokeCounter = pokeCounter)
+        def add(fingerprint):
+            key = (fingerprint, 2007022001)
+            self.assertEqual(csCache.get(key), None)
+            csInfo = netreposproxy.ChangeSetInfo()
+            csInfo.size = 100
+            csInfo.trovesNeeded = csInfo.filesNeeded = []
+            csInfo.removedTroves = []
+            csCache.set(key, (csInfo, StringIO.StringIO("a" * 100), None))
+            now[0] += 1000
+            return os.stat(csCache.hashKey(key)).st_size
+
+        fingerprints = [ x * 40 for x in 'abcde' ]
+        entrySize = [ add(x) for x in fingerprints ][0]
+        self.assertEqual(counters, { 'cscache_write_bytes' : 5 * entrySize })
+        self.assertTrue(os.path.exists(oldPath))
+
+        # using 'a' makes 'b' the least recently used new entry
+        csCache.get((fingerprints[0], 2007022001))
+        now[0] += 1000
+        add('1' * 40)
+        self.assertFalse(os.path.exists(oldPath))
+        self.assertEqual(
+            [ x[0] for x in fingerprints
+                if os.path.exists(csCache.hashKey((x, 2007022001))) ],
+            [ 'a', 'c', 'd', 'e' ])
+        self.assertEqual(counters, {
+            'cscache_write_bytes' : 6 * entrySize,
+            'cscache_hit_bytes' : entrySize,
+            'cscache_evictions' : 2,
+            'cscache_evicted_bytes' : entrySize + 50,
+            })
+
+    def testChangesetCacheTouchThrottle(self):
+        cacheDir = os.path.join(self.workDir, "changesetCache")
+        os.mkdir(cacheDir)
+        dataStore = netreposproxy.datastore.ShallowDataStore(cacheDir)
+        now = [ 1000000 ]
+        self.mock(netreposproxy.time, 'time', lambda: now[0])
+        csCache = netreposproxy.ChangesetCache(dataStore, sizeLimit = 1000)
+
+        key = ('a' * 40, 2007022001)
+        csInfo = netreposproxy.ChangeSetInfo()
+        csInfo.size = 10
+        csInfo.trovesNeeded = csInfo.filesNeeded = []
+        csInfo.removedTroves = []
+        csCache.set(key, (csInfo, StringIO.StringIO("a" * 10), None))
+
+        def getAtime():
+            cu = csCache.db.cursor()
+            cu.execute("SELECT atime FROM CacheEntries")
+            return cu.fetchone()[0]
+
+        # the first hit is recorded, but further hits are only recorded
+        # once TOUCH_INTERVAL has passed
+        atimes = []
+        for delta in (10, 10, csCache.TOUCH_INTERVAL - 20, 20):
+            now[0] += delta
+            self.assertNotEqual(csCache.get(key), None)
+            atimes.append(getAtime())
+        self.assertEqual([ x - 1000000 for x in atimes ], [ 10, 10, 10, 80 ])
+
+    def _waitForChild(self, childPid):
+        # the child must be blocked until the parent is done fetching
+        time.sleep(0.5)
+        self.assertEqual(os.waitpid(childPid, os.WNOHANG), (0, 0))
+
+    def testCoalescedChangesetMiss(self):
+        cacheDir = os.path.join(self.workDir, "changesetCache")
+        os.mkdir(cacheDir)
+        dataStore = netreposproxy.datastore.ShallowDataStore(cacheDir)
+        csCache = netreposproxy.ChangesetCache(dataStore)
+        key = ('a' * 40, 2007022001)
+        # we are now the process fetching this changeset
+        self.assertEqual(csCache.get(key), None)
+
+        childPid = os.fork()
+        if childPid == 0:
+            try:
+                # even without a lock to spare, the child waits for us
+                # rather than fetching the changeset itself
+                childCache = netreposproxy.ChangesetCache(dataStore)
+                childCache.maxLocks = 0
+                csInfo = childCache.get(key)
+                if csInfo is not None and csInfo.size == 100:
+                    os._exit(0)
+            except:
+                pass
+            os._exit(1)
+
+        self._waitForChild(childPid)
+        csInfo = netreposproxy.ChangeSetInfo()
+        csInfo.size = 100
+        csInfo.trovesNeeded = csInfo.filesNeeded = []
+        csInfo.removedTroves = []
+        csCache.set(key, (csInfo, StringIO.StringIO("a" * 100), None))
+        pid, status = os.waitpid(childPid, 0)
+        self.assertEqual(status, 0)
+
+    def testCoalescedFileContentsMiss(self):
+        cfg = netserver.ServerConfig()
+        cfg.tmpDir = os.path.join(self.workDir, "tmp")
+        cfg.proxyContentsDir = os.path.join(self.workDir, "proxyContents")
+        prs = netreposproxy.ProxyRepositoryServer(cfg, "/someUrl")
+        prs.setBaseUrlOverride('/blah',
+            {'X-Conary-Proxy-Host' : 'repos.example.com'}, isSecure = True)
+
+        fileId = '1' * 20
+        fileList = [ (prs.fromFileId(fileId), 'unused') ]
+        path = prs.contents.hashToPath(
+            netreposproxy.sha1helper.sha1ToString(fileId) + '-c')
+        prs.contents.makeDir(path)
+        lockfile = netreposproxy.util.LockedFile(path)
+        # we are now the process fetching this file
+        self.assertEqual(lockfile.open(), None)
+
+        class Caller(object):
+            _lastProxy = None
+            def getFileContents(slf, clientVersion, fileList, authCheckOnly):
+                if not authCheckOnly:
+                    raise AssertionError("file was fetched twice")
+
+        childPid = os.fork()
+        if childPid == 0:
+            try:
+                prs.getFileContents(Caller(), None, 71, fileList)
+                os._exit(0)
+            except:
+                os._exit(1)
+
+        self._waitForChild(childPid)
+        prs.contents.addFile(StringIO.StringIO("contents"),
+            netreposproxy.sha1helper.sha1ToString(fileId) + '-c',
+            precompressed = True, integrityCheck = False)
+        lockfile.unlock()
+        pid, status = os.waitpid(childPid, 0)
+        self.assertEqual(status, 0)
+
+    def testChangesetProducerSingleFile(self):
+        contentsDir = os.path.join(self.workDir, "contents")
+        os.mkdir(contentsDir)
+        store = netreposproxy.datastore.DataStore(contentsDir)
+        contents = "some file contents"
+        sha1 = netreposproxy.sha1helper.sha1String(contents)
+        store.addFile(StringIO.StringIO(contents), sha1)
+
+        def produce(withReferences, preserveFile, resumeOffset = None):
+            cs = changeset.ChangeSet()
+            cs.addFileContents('0' * 16, '1' * 20,
+                changeset.ChangedFileTypes.file,
+                filecontents.CompressedFromDataStore(store, sha1), False,
+                compressed = True)
+            csPath = os.path.join(self.workDir, "test.ccs")
+            size = cs.writeToFile(csPath, withReferences = withReferences)
+            manifest = netserver.ManifestWriter(self.workDir,
+                resumeOffset = resumeOffset)
+            manifest.append(csPath, expandedSize = size, isChangeset = True,
+                preserveFile = preserveFile, offset = 0)
+            return netreposproxy.ChangesetProducer(
+                os.path.join(self.workDir, manifest.close() + '-out'), store)
+
+        expected = ''.join(produce(False, True))
+
+        # the cached changeset can be sent as it is
+        fobj = produce(False, True).getSingleFile()
+        self.assertEqual(fobj.read(), expected)
+        fobj = produce(False, False, resumeOffset = 10).getSingleFile()
+        self.assertEqual(fobj.read(), expected[10:])
+        self.assertFalse(os.path.exists(fobj.name))
+
+        # references to the contents store have to be expanded first
+        producer = produce(True, True)
+        self.assertEqual(producer.getSingleFile(), None)
+        self.assertEqual(''.join(producer), expected)
+
 class ProxyTest(rephelp.RepositoryHelper):
 
     def _getRepos(self, proxyRepos):
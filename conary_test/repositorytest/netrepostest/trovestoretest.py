@@ -34,7 +34,9 @@ from conary import trove
 
 from conary.deps import deps
 from conary.local import schema as depSchema
-from conary.repository.netrepos import instances, trovestore, netauth
+from conary.repository import changeset, filecontents
+from conary.repository.netrepos import fsrepos, instances, trovestore, netauth
+from conary.repository.netrepos.repo_cfg import CfgContentStore
 from conary.lib.sha1helper import md5FromString, sha1FromString
 from conary.server import schema
 from conary.versions import ThawVersion, VersionFromString
@@ -753,6 +755,80 @@ Some changes just are.
         store.addTroveDone(ti)
         store.commit()
 
+    def testChangeSetStreamCache(self):
+        # relative changesets fetch the file streams they need; streams
+        # cached for earlier jobs have to survive the cache being reset
+        store = self._connect()
+        cu = store.db.cursor()
+        cu.execute("SELECT userGroupId FROM UserGroups "
+                   "WHERE userGroup = 'anonymous'")
+        roleIds = [ x[0] for x in cu ]
+        flavor = deps.Flavor()
+        v1 = ThawVersion("/localhost@test:trunk/10:1.0-1")
+        v2 = ThawVersion("/localhost@test:trunk/20:2.0-1")
+
+        d = tempfile.mkdtemp()
+        try:
+            repos = fsrepos.FilesystemRepository(['localhost'], store,
+                    (CfgContentStore.LEGACY, [d + '/contents']), {})
+
+            def commit(name, version, contents):
+                trv = trove.Trove(name, version, flavor, None)
+                cs = changeset.ChangeSet()
+                for pathId, path, cont in contents:
+                    fullPath = os.path.join(d, 'file')
+                    open(fullPath, 'w').write(cont)
+                    f = files.FileFromFilesystem(fullPath, pathId)
+                    f.inode.mtime.set(1000)
+                    trv.addFile(pathId, path, version, f.fileId())
+                    cs.addFile(None, f.fileId(), f.freeze())
+                    cs.addFileContents(pathId, f.fileId(),
+                            changeset.ChangedFileTypes.file,
+                            filecontents.FromString(cont), False)
+                trv.computeDigests()
+                cs.newTrove(trv.diff(None, absolute = True)[0])
+                cs.writeToFile(d + '/in.ccs')
+                repos.commitChangeSet(
+                        changeset.ChangeSetFromFile(d + '/in.ccs'),
+                        callback = fsrepos.UpdateCallback(None, 0, None))
+
+            # foo and bar share their first file
+            commit('foo:runtime', v1, [ (self.id1, '/a', 'a1'),
+                                        (self.id2, '/b', 'b1') ])
+            commit('foo:runtime', v2, [ (self.id1, '/a', 'a2'),
+                                        (self.id2, '/b', 'b2') ])
+            commit('bar:runtime', v1, [ (self.id1, '/a', 'a1'),
+                                        (self.id3, '/c', 'c1') ])
+            commit('bar:runtime', v2, [ (self.id1, '/a', 'a2'),
+                                        (self.id3, '/c', 'c2') ])
+
+            jobs = [ (name, (v1, flavor), (v2, flavor), False)
+                     for name in ('foo:runtime', 'bar:runtime') ]
+            def changeSets():
+                l = []
+                for cs in repos.createChangeSet(jobs, roleIds = roleIds):
+                    cs[0].writeToFile(d + '/out.ccs')
+                    l.append(open(d + '/out.ccs').read())
+                return l
+
+            expected = changeSets()
+            # the four streams foo needs fill the cache, so bar's two new
+            # ones reset it while it still needs the shared ones
+            oldSize = fsrepos.STREAM_CACHE_SIZE
+            fsrepos.STREAM_CACHE_SIZE = 4
+            try:
+                self.assertEqual(changeSets(), expected)
+            finally:
+                fsrepos.STREAM_CACHE_SIZE = oldSize
+
+            cs = changeset.ChangeSetFromFile(d + '/out.ccs')
+            self.assertEqual(
+                sorted((x.getName(), len(x.getChangedFileList()))
+                       for x in cs.iterNewTroveList()),
+                [ ('bar:runtime', 2), ('foo:runtime', 2) ])
+        finally:
+            shutil.rmtree(d)
+
     def testHidden(self):
         store = self._connect()
         cu = store.db.cursor()
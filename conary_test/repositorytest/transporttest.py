@@ -18,8 +18,10 @@
 import os
 import SimpleHTTPServer
 import socket
+import StringIO
 import time
 import httplib
+import xmlrpclib
 from SimpleHTTPServer import SimpleHTTPRequestHandler
 from SimpleXMLRPCServer import SimpleXMLRPCServer
 
@@ -183,6 +185,95 @@ class TransportTest(rephelp.RepositoryHelper):
         finally:
             server.kill()
 
+    def testBinaryRPC(self):
+        class Response(StringIO.StringIO):
+            def __init__(self, ctype, body):
+                StringIO.StringIO.__init__(self, body)
+                self.headers = { 'content-type' : ctype }
+
+        # servers which only know XML-RPC keep getting XML-RPC requests
+        trans = transport.Transport()
+        trans.verbose = 0
+        body = util.xmlrpcDump(([False, 'result'], ), methodresponse = 1)
+        self.assertEqual(trans.parse_response(Response('text/xml', body)),
+                         ([False, 'result'], ))
+        self.assertEqual(trans.binaryRequests, False)
+
+        body = util.binrpcDump(([False, 'result'], ), methodresponse = 1)
+        self.assertEqual(trans.parse_response(
+                            Response(util.BINRPC_CONTENT_TYPE, body)),
+                         ([False, 'result'], ))
+        self.assertEqual(trans.binaryRequests, True)
+
+        # the first request is XML-RPC; the server answers in the binary
+        # encoding, so the requests which follow are binary too
+        self.openRepository()
+        repos = conaryclient.ConaryClient(self.cfg).getRepos()
+        trans = repos.c['localhost']._transport
+        sent = []
+        origRequest = trans.request
+        def request(url, body, verbose = 0, contentType = None):
+            sent.append(contentType)
+            return origRequest(url, body, verbose = verbose,
+                               contentType = contentType)
+        self.mock(trans, 'request', request)
+
+        trans.binaryRequests = False
+        repos.c['localhost'].checkVersion()
+        self.assertEqual(trans.binaryRequests, True)
+        repos.c['localhost'].checkVersion()
+        self.assertEqual(sent, [ None, util.BINRPC_CONTENT_TYPE ])
+
+    def testBinaryRPCMixedVersions(self):
+        # a client which doesn't list the binary encoding in Accept (and
+        # could not parse it) gets XML-RPC answers from a new server
+        self.openRepository()
+        repos = conaryclient.ConaryClient(self.cfg).getRepos()
+        trans = repos.c['localhost']._transport
+        self.mock(trans, 'binaryType', 'application/x-unknown')
+        trans.binaryRequests = False
+        repos.c['localhost'].checkVersion()
+        repos.c['localhost'].checkVersion()
+        self.assertEqual(trans.binaryRequests, False)
+
+        # an old server which only knows XML-RPC ignores the binary type
+        # in Accept, so a new client keeps sending XML-RPC to it
+        class Server:
+            def ping(self):
+                return [True, xmlrpclib.DateTime('20100102T03:04:05')]
+
+        port = testhelp.findPorts(num = 1)[0]
+        childPid = os.fork()
+        if childPid == 0:
+            try:
+                server = SimpleXMLRPCServer(("127.0.0.1", port),
+                                            logRequests=False)
+                server.register_instance(Server())
+                server.serve_forever()
+            finally:
+                os._exit(1)
+
+        try:
+            sock_utils.tryConnect('127.0.0.1', port)
+            trans = transport.Transport()
+            sent = []
+            origRequest = trans.request
+            def request(url, body, verbose = 0, contentType = None):
+                sent.append(contentType)
+                return origRequest(url, body, verbose = verbose,
+                                   contentType = contentType)
+            self.mock(trans, 'request', request)
+            proxy = util.ServerProxy(url="http://127.0.0.1:%d/" % port,
+                                     transport=trans)
+            for i in range(2):
+                self.assertEqual(proxy.ping(), ([True,
+                        xmlrpclib.DateTime('20100102T03:04:05')], ))
+            self.assertEqual(sent, [ None, None ])
+            self.assertEqual(trans.binaryRequests, False)
+        finally:
+            os.kill(childPid, 15)
+            os.waitpid(childPid, 0)
+
     def testHostnameDoesNotResolve(self):
         # make sure that a hostname that doesn't resolve does not prevent
         # the transport code from working (CNY-1531)
@@ -0,0 +1,82 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from conary import versions
+from conary.deps import deps
+from conary.repository import trovecache
+
+
+class TroveCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def testSaveLoad(self):
+        path = os.path.join(self.workDir, 'modelcache')
+        version = versions.ThawVersion('/localhost@rpl:linux/1.0:1.0-1-1')
+        baseVersion = versions.VersionFromString('/localhost@rpl:linux/1.0-1-1')
+        flavor = deps.parseFlavor('is: x86')
+        prov = deps.parseDep('trove: foo:runtime')
+        depSet = deps.parseDep('soname: ELF32/libc.so.6(x86)')
+        sig = 's' * 20
+        solution = [ [ ('foo:runtime', version, flavor) ], [] ]
+
+        tc = trovecache.TroveCache(None)
+        tc.timeStampCache[('foo:runtime', baseVersion)] = version
+        tc.depCache[('foo:runtime', baseVersion, flavor)] = (prov, None)
+        tc.addDepSolution(sig, depSet, solution)
+        tc.cacheFile('foo.cml', [ 'install foo\n' ])
+        sizes = tc._getSizeTuple()
+        tc.save(path)
+
+        tc = trovecache.TroveCache(None)
+        tc.load(path)
+        self.assertEqual(tc.version, trovecache.TroveCache.VERSION)
+        # nothing has been unpacked yet, but the sizes are known
+        self.assertEqual(sorted(tc._pendingSections),
+            [ 'depCache', 'depSolutionCache', 'fileCache', 'timeStampCache' ])
+        self.assertEqual(tc._startingSizes, sizes)
+
+        self.assertEqual(tc.getCachedFile('foo.cml'), [ 'install foo\n' ])
+        self.assertEqual(sorted(tc._pendingSections),
+            [ 'depCache', 'depSolutionCache', 'timeStampCache' ])
+        self.assertEqual(tc._getSizeTuple(), sizes)
+
+        # dependency solutions which were never used are saved without
+        # being thawed
+        tc.depSolutionCache
+        tc.save(path)
+
+        tc = trovecache.TroveCache(None)
+        tc.load(path)
+        self.assertEqual(tc.getDepSolution(sig, depSet), solution)
+        self.assertEqual(
+            tc.getDepSolution(sig, depSet)[0][0][1].timeStamps(), [ 1.0 ])
+        self.assertEqual(
+            tc.getDepCacheEntry(('foo:runtime', baseVersion, flavor)),
+            (prov, None))
+        self.assertEqual(tc.timeStampCache,
+                         { ('foo:runtime', baseVersion) : version })
+        self.assertEqual(tc._getSizeTuple(), sizes)
@@ -17,7 +17,7 @@
 
 from testrunner import testhelp
 
-import os, tempfile
+import os, tempfile, time
 
 from conary_test import rephelp
 from conary_test import resources
@@ -27,7 +27,7 @@ from conary import versions, conarycfg, trove
 from conary.conaryclient import mirror
 from conary.lib import openpgpfile, openpgpkey
 from conary.build import signtrove
-from conary.repository import errors, netclient
+from conary.repository import changeset, errors, netclient
 
 def skipproxy(fn):
     def noproxy(*args, **kwargs):
@@ -880,3 +880,76 @@ class MirrorTest(rephelp.RepositoryHelper):
         cfg = mirror.MirrorFileConfiguration()
         cfg.host = "myotherhost"
         self._runMirrorCfg(src, dst, cfg)
+
+    def testBundleFetcher(self):
+        class Source:
+            fetched = []
+            def createChangeSetFile(self, jobList, fileName, recurse,
+                                    callback, mirrorMode):
+                names = [ x[0] for x in jobList ]
+                if len(names) > 1 and 'conflict:runtime' in names:
+                    raise changeset.ChangeSetKeyConflictError('0' * 16)
+                if 'broken' in names:
+                    raise errors.RepositoryError('broken')
+                self.fetched.append(names)
+                open(fileName, 'w').write(' '.join(names) + '\n' * 100)
+
+        def bundle(mark, *names):
+            return [ (mark, (x, (None, None), ('1.0', ''), True))
+                     for x in names ]
+
+        src = Source()
+        bundles = [ bundle(1, 'foo:runtime'),
+                    bundle(2, 'conflict:runtime', 'other:runtime'),
+                    bundle(3, 'bar:runtime') ]
+        fetcher = mirror.BundleFetcher(src, bundles, 0,
+                                       mirror.ChangesetCallback())
+        committed = []
+        allFiles = []
+        # fetches needed to get through each bundle; the second is split
+        needed = [ 1, 3, 4 ]
+        try:
+            for i, (b, fileList) in enumerate(fetcher):
+                # with no room for prefetched changesets, only the next
+                # bundle is fetched while this one is committed
+                self.assertTrue(len(src.fetched) <=
+                                len(allFiles) + len(fileList) + 2)
+                if i + 1 < len(needed):
+                    # and it is fetched before this one is released
+                    deadline = time.time() + 10
+                    while (len(src.fetched) < needed[i + 1] and
+                           time.time() < deadline):
+                        time.sleep(0.01)
+                    self.assertEqual(len(src.fetched), needed[i + 1])
+                    self.assertTrue(os.path.exists(fileList[0]))
+                committed.append(b)
+                allFiles.extend(fileList)
+                self.assertEqual(
+                    sorted(' '.join(open(x).read() for x in fileList).split()),
+                    sorted(x[1][0] for x in b))
+        finally:
+            fetcher.close()
+        # bundles come back in order; the conflicting one is split
+        self.assertEqual(committed, bundles)
+        self.assertEqual(len(allFiles), 4)
+        self.assertEqual([ x for x in allFiles if os.path.exists(x) ], [])
+
+        # errors are raised after the bundles fetched before them
+        del src.fetched[:]
+        bundles = [ bundle(1, 'foo:runtime'), bundle(2, 'broken'),
+                    bundle(3, 'bar:runtime') ]
+        fetcher = mirror.BundleFetcher(src, bundles, 1024 * 1024,
+                                       mirror.ChangesetCallback())
+        committed = []
+        try:
+            try:
+                for b, fileList in fetcher:
+                    committed.append(b)
+            except errors.RepositoryError, e:
+                self.assertEqual(str(e), 'broken')
+            else:
+                self.fail('expected RepositoryError')
+        finally:
+            fetcher.close()
+        self.assertEqual(committed, bundles[:1])
+        self.assertEqual(src.fetched, [ ['foo:runtime'] ])
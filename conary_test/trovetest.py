@@ -18,6 +18,7 @@
 from testrunner import testhelp
 from testrunner import testcase
 import itertools
+import threading
 import time
 from conary import changelog, streams, trove, trovetup
 from conary.trove import Trove
@@ -1442,6 +1443,154 @@ Some changes just are.
         p.removeAllFiles()
         assert(len(p.idMap) == 0)
 
+    def testLazyFileList(self):
+        old = ThawVersion("/conary.rpath.com@test:trunk/10:1.2-3")
+        new = ThawVersion("/conary.rpath.com@test:trunk/20:1.2-4")
+        x86 = parseFlavor('is:x86')
+        p = Trove("name", old, x86, None)
+        p.addFile(self.id1, "/path1", old, self.fid1)
+        p.addFile(self.id2, "/dir/path2", new, self.fid2)
+        p.addFile(self.id3, "/dir/path3", old, self.fid3)
+        p.computeDigests()
+
+        frozen = p.diff(None, absolute = True)[0].freeze()
+        trvCs = ThawTroveChangeSet(frozen)
+        # the file list isn't decoded just to thaw the change set and
+        # build a trove from it
+        assert(isinstance(trvCs.newFiles, trove._LazyReferencedFileList))
+        self.assertEqual(trvCs.freeze(), frozen)
+        t = Trove(trvCs)
+        assert(isinstance(t.idMap, trove._LazyTroveRefsFilesStream))
+        self.assertEqual(t.fileCount(), 3)
+        self.assertEqual(sorted(t.iterFileList()), sorted(p.iterFileList()))
+        self.assertEqual(t.idMap.freeze(), p.idMap.freeze())
+        assert(t.verifyDigests())
+        assert(isinstance(t.copy().idMap, trove._LazyTroveRefsFilesStream))
+        assert(isinstance(t.idMap, trove._LazyTroveRefsFilesStream))
+
+        # everything else decodes it
+        self.assertEqual(t.getFile(self.id2), ("/dir/path2", self.fid2, new))
+        assert(t.idMap._getFrozen() is None)
+        self.assertEqual(type(t.idMap._thaw()), trove.TroveRefsFilesStream)
+        self.assertEqual(t.idMap, p.idMap)
+        assert(t == p)
+
+        t = Trove(ThawTroveChangeSet(frozen))
+        t.removeFile(self.id1)
+        self.assertEqual(t.fileCount(), 2)
+        assert(not t.hasFile(self.id1))
+
+        self.assertEqual(Trove(ThawTroveChangeSet(frozen)).idMap, p.idMap)
+        self.assertEqual(p.idMap, Trove(ThawTroveChangeSet(frozen)).idMap)
+        self.assertEqual(sorted(trvCs.getNewFileList()),
+                         sorted(p.diff(None)[0].getNewFileList()))
+        assert(trvCs.newFiles._getFrozen() is None)
+
+        # code which looks straight at dict and list storage sees the
+        # entries of a file list which hasn't been decoded yet
+        trvCs = ThawTroveChangeSet(frozen)
+        self.assertEqual(len(trvCs.newFiles), 3)
+        self.assertEqual(sorted(list(trvCs.newFiles)),
+                         sorted(p.diff(None)[0].getNewFileList(raw = True)))
+        l = []
+        l.extend(ThawTroveChangeSet(frozen).newFiles)
+        self.assertEqual(len(l), 3)
+
+        t = Trove(ThawTroveChangeSet(frozen))
+        self.assertEqual(len(t.idMap), 3)
+        self.assertEqual(dict(t.idMap), dict(p.idMap))
+        d = {}
+        d.update(Trove(ThawTroveChangeSet(frozen)).idMap)
+        self.assertEqual(d, dict(p.idMap))
+        self.assertEqual(sorted(list(Trove(ThawTroveChangeSet(frozen)).idMap)),
+                         sorted(p.idMap))
+
+        # the entries are decoded once no matter how many threads ask
+        t = Trove(ThawTroveChangeSet(frozen))
+        results = []
+        def getFiles():
+            results.append(t.idMap._thaw())
+        threads = [ threading.Thread(target = getFiles) for x in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 8)
+        assert([ x for x in results if x is not results[0] ] == [])
+        self.assertEqual(t.idMap, p.idMap)
+
+    def testCompactFileList(self):
+        old = ThawVersion("/conary.rpath.com@test:trunk/10:1.2-3")
+        new = ThawVersion("/conary.rpath.com@test:trunk/20:1.2-4")
+        x86 = parseFlavor('is:x86')
+
+        def build():
+            p = Trove("name", old, x86, None)
+            p.addFile(self.id1, "/path1", old, self.fid1)
+            p.addFile(self.id2, "/dir/path2", new, self.fid2)
+            p.addFile(self.id3, "/dir/path3", old, self.fid3)
+            p.computeDigests()
+            return p
+
+        p = build()
+        originalSize = trove.COMPACT_FILE_LIST_SIZE
+        try:
+            trove.COMPACT_FILE_LIST_SIZE = 3
+            t = build()
+            self.assertEqual(type(t.idMap), trove._CompactTroveRefsFilesStream)
+            self.assertEqual(t.idMap, p.idMap)
+            self.assertEqual(p.idMap, t.idMap)
+            assert(t == p)
+            # the packed entries aren't visible to code which copies dicts
+            self.assertEqual(dict(t.idMap), dict(p.idMap))
+            d = {}
+            d.update(t.idMap)
+            self.assertEqual(d, dict(p.idMap))
+            self.assertEqual(sorted(t.idMap.items()), sorted(p.idMap.items()))
+            self.assertEqual(sorted(t.idMap.values()),
+                             sorted(p.idMap.values()))
+            self.assertEqual(t.idMap.freeze(), p.idMap.freeze())
+            self.assertEqual(sorted(t.iterFileList()),
+                             sorted(p.iterFileList()))
+            self.assertEqual(t.getFile(self.id2),
+                             ("/dir/path2", self.fid2, new))
+            assert(t.idMap[self.id2][3] is new)
+
+            t.updateFile(self.id2, "/dir/path4", None, None)
+            self.assertEqual(t.getFile(self.id2),
+                             ("/dir/path4", self.fid2, new))
+            t.removeFile(self.id1)
+            self.assertEqual(t.fileCount(), 2)
+            self.assertEqual(sorted(t.idMap.keys()), [ self.id2, self.id3 ])
+
+            c = t.copy()
+            self.assertEqual(type(c.idMap), trove._CompactTroveRefsFilesStream)
+            c.addFile(self.id1, "/path1", old, self.fid1)
+            self.assertEqual(c.fileCount(), 3)
+            self.assertEqual(t.fileCount(), 2)
+            assert(c.idMap._dirs is not t.idMap._dirs)
+
+            # table rows which are no longer used get dropped
+            for i in range(10):
+                c.updateFile(self.id1, "/dir%d/path1" % i, None, None)
+            self.assertEqual(c.getFile(self.id1),
+                             ("/dir9/path1", self.fid1, old))
+            assert(len(c.idMap._dirs) <= 4)
+            self.assertEqual(sorted(c.idMap.items()), sorted(
+                [ (self.id1, ("/dir9", "path1", self.fid1, old)),
+                  (self.id2, ("/dir", "path4", self.fid2, new)),
+                  (self.id3, ("/dir", "path3", self.fid3, old)) ]))
+
+            # thawing a large lazy file list compacts it as well
+            frozen = p.diff(None, absolute = True)[0].freeze()
+            t = Trove(ThawTroveChangeSet(frozen))
+            assert(t.hasFile(self.id1))
+            self.assertEqual(type(t.idMap._thaw()),
+                             trove._CompactTroveRefsFilesStream)
+            self.assertEqual(t.idMap, p.idMap)
+        finally:
+            trove.COMPACT_FILE_LIST_SIZE = originalSize
+
 from conary_test import rephelp
 class TroveTest2(rephelp.RepositoryHelper):
 